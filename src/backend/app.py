@@ -1,29 +1,44 @@
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, jsonify, request, send_from_directory
 from flask_cors import CORS
 import requests
 import json
 import glob
+import re
+import uuid
 import os
 import sys
 import time
 import subprocess
+from datetime import datetime
 import shutil
-import pickle
 import rasterio
-from rasterio.transform import Affine
+from rasterio.transform import Affine, from_bounds
+import yaml
+
+import math
+import numpy as np
+import pyproj
+import shapely
 
-from pyproj import Transformer
 import logging
 
-from PIL import Image, ImageDraw
-from shapely.geometry import shape
-from shapely.ops import unary_union
+from PIL import Image
 
-import geopandas as gpd
 import fiona
 
 from image_providers.provider_factory import get_provider
 from utils.image_processing import process_geotiff_image
+from utils.geo_transform import METERS_PER_DEGREE, pixels_to_lonlat
+from utils.vector_tiles import MAX_ZOOM, VectorTileStore, check_tile
+from utils.damage_analysis import DEFAULT_DAMAGE_BUFFER_M, RoadIndex, find_damaged_roads, road_index_crs
+from utils.prediction_cache import PredictionCache
+from utils.change_detection import align_mask, find_damaged_edges_raster, rasterize_lines, score_ways
+from utils.overpass_cache import OverpassTileCache
+from utils.overpass_client import OverpassClient
+from utils.overpass_stream import RoadElements, stream_feature_collection
+from utils.osm_store import OsmRoadStore
+from utils.geopackage import iter_layer_geojson, list_layers
+from data_processing import graph_utils
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
@@ -32,11 +47,47 @@ SAM_ROAD_CONFIG_PATH = os.path.abspath(os.path.join(CURRENT_DIR, "model_files",
 SAM_ROAD_CHECKPOINT_PATH = os.path.abspath(os.path.join(CURRENT_DIR, "model_files", "spacenet_vitb_256_e10.ckpt"))
 SAM_ROAD_PROJECT_DIR = os.path.abspath(os.path.join(CURRENT_DIR, "data_processing"))
 backend_static_folder = os.path.abspath(os.path.join(CURRENT_DIR, "static"))
+# Simplification tolerances, in image pixels, of the predicted road levels of
+# detail. Level 0 is full resolution.
+ROAD_LOD_TOLERANCES = (0.0, 1.0, 2.0, 4.0, 8.0, 16.0)
+WEB_MERCATOR_EQUATOR_M = 40075016.686
+# Road probability threshold for raster change detection, the ROAD_THRESHOLD
+# inference extracts the graphs with.
+with open(SAM_ROAD_CONFIG_PATH) as f_config:
+    RASTER_ROAD_THRESHOLD = float(yaml.safe_load(f_config)["ROAD_THRESHOLD"])
+# Overpass endpoint and the on-disk cache of its road tiles. Both can be
+# overridden from the environment, e.g. to point at a local Overpass instance.
+OVERPASS_URL = os.environ.get("OVERPASS_URL", "https://overpass-api.de/api/interpreter")
+OVERPASS_CACHE_DIR = os.environ.get(
+    "OVERPASS_CACHE_DIR", os.path.abspath(os.path.join(CURRENT_DIR, "cache", "overpass"))
+)
+OVERPASS_CACHE_TTL_S = float(os.environ.get("OVERPASS_CACHE_TTL_S", 24 * 3600))
+# Cached road tiles not refetched for this long are deleted at startup.
+OVERPASS_CACHE_MAX_AGE_S = float(os.environ.get("OVERPASS_CACHE_MAX_AGE_S", 30 * 24 * 3600))
+OVERPASS_TIMEOUT_S = 25
+# Local road store imported from an OSM extract (python -m utils.osm_store),
+# and where get_roads takes roads from: "auto" uses the store when it covers
+# the query and Overpass otherwise, "local" never calls Overpass and
+# "overpass" ignores the store.
+OSM_STORE_PATH = os.environ.get(
+    "OSM_STORE_PATH", os.path.abspath(os.path.join(CURRENT_DIR, "cache", "osm_roads.sqlite"))
+)
+OSM_ROADS_SOURCE = os.environ.get("OSM_ROADS_SOURCE", "auto")
+# How many days the store's snapshot may be off the date of a dated query.
+OSM_STORE_DATE_TOLERANCE_DAYS = int(os.environ.get("OSM_STORE_DATE_TOLERANCE_DAYS", 0))
+# Parallel Overpass requests when fetching several cache tiles. The public
+# instance gives each client only a couple of slots.
+OVERPASS_CONCURRENCY = int(os.environ.get("OVERPASS_CONCURRENCY", 2))
+# Converted predictions, their spatial indexes and levels of detail.
+prediction_cache = PredictionCache()
+# Latest OSM, predicted and damaged road layers, served as vector tiles.
+tile_store = VectorTileStore()
 
 logging.info("Cleaning up old generated files")
 if os.path.exists(backend_static_folder):
     files_to_delete = glob.glob(os.path.join(backend_static_folder, "*.png"))
     files_to_delete += glob.glob(os.path.join(backend_static_folder, "*.tif"))
+    files_to_delete += glob.glob(os.path.join(backend_static_folder, "*.gpkg"))
     for f_path in files_to_delete:
         try:
             os.remove(f_path)
@@ -55,84 +106,206 @@ logging.info(f"Serving static files from frontend: {frontend_static_folder}")
 def backend_static(filename):
     return send_from_directory(backend_static_folder, filename)
 
-CORS(app, resources={r"/api/*": {"origins": "*"}})
+CORS(app, resources={r"/api/*": {"origins": "*"}, r"/tiles/*": {"origins": "*"}})
 
 def overpass_to_geojson(overpass_json):
-    nodes = {}
-    for element in overpass_json.get("elements", []):
-        if element["type"] == "node":
-            nodes[element["id"]] = [element["lon"], element["lat"]]
+    return RoadElements().extend(overpass_json.get("elements", [])).to_geojson()
+
+overpass_client = OverpassClient(
+    OVERPASS_URL, timeout_s=OVERPASS_TIMEOUT_S, concurrency=OVERPASS_CONCURRENCY
+)
+
+def fetch_overpass_roads(bbox, types, query_date=None):
+    # Fetches the ways of the given highway types intersecting a (min_lon,
+    # min_lat, max_lon, max_lat) bbox from Overpass, as GeoJSON. Queries that
+    # time out are split, and the parts merged by element id.
+    return overpass_client.fetch_roads(bbox, types, query_date).to_geojson()
+
+overpass_cache = OverpassTileCache(
+    OVERPASS_CACHE_DIR,
+    fetch_overpass_roads,
+    ttl_s=OVERPASS_CACHE_TTL_S,
+    concurrency=OVERPASS_CONCURRENCY,
+)
+logging.info("Pruned %d old OSM road tiles", overpass_cache.prune(OVERPASS_CACHE_MAX_AGE_S))
+osm_store = OsmRoadStore(OSM_STORE_PATH)
+
+def create_osm_mask(
+    geojson_data, image_bounds=None, image_size=(512, 512), line_width=3, geotiff_path=None, as_array=False
+):
+    # Burns the OSM roads into a mask, 255 on roads. The mask is on the grid
+    # of geotiff_path when given, which aligns it pixel for pixel with the
+    # image, otherwise image_bounds (lat_min, lat_max, lon_min, lon_max) are
+    # split into image_size (height, width) pixels.
+    # Returns a PIL image, or the uint8 array with as_array.
+    if geotiff_path:
+        with rasterio.open(geotiff_path) as src:
+            shape, transform, crs = (src.height, src.width), src.transform, src.crs
+    else:
+        lat_min, lat_max, lon_min, lon_max = image_bounds
+        if lon_max <= lon_min or lat_max <= lat_min:
+            raise ValueError(f"Empty image bounds: {image_bounds}")
+        shape = tuple(image_size)
+        transform = from_bounds(lon_min, lat_min, lon_max, lat_max, shape[1], shape[0])
+        crs = "EPSG:4326"
+    mask = rasterize_lines(geojson_data, shape, transform, crs, line_width, value=255)
+    return mask if as_array else Image.fromarray(mask)
+
+def load_predicted_graph(graph_path, image_path, transform_json_path=None):
+    # Loads a .rgraph (or legacy .p) graph with the transform and CRS of its
+    # pixel grid. Whatever the graph file doesn't record comes from the legacy
+    # transform JSON, then from the image.
+    road_graph, metadata = graph_utils.load_road_graph(graph_path)
+    with rasterio.open(image_path) as src:
+        crs = src.crs
+        transform = src.transform
+    if metadata["transform"] is not None:
+        transform = Affine.from_gdal(*metadata["transform"])
+    elif transform_json_path and os.path.exists(transform_json_path):
+        try:
+            with open(transform_json_path, 'r') as f_transform:
+                transform = Affine.from_gdal(*json.load(f_transform))
+        except Exception:
+            logging.warning('Could not load transform JSON; falling back to image transform')
+    if metadata["crs"] is not None:
+        crs = metadata["crs"]
+    return road_graph, transform, crs
+
+def find_prediction_graph(graph_dir, stems):
+    # Prefers .rgraph files over legacy pickles for each candidate stem.
+    for stem in stems:
+        for extension in (".rgraph", ".p"):
+            path = os.path.join(graph_dir, stem + extension)
+            if os.path.exists(path):
+                return path
+    return None
+
+def road_graph_lines(road_graph, chain_segments=True):
+    # Pixel (row, col) coordinates of each LineString to draw for the graph.
+    # chain_segments: joins runs of degree-2 nodes into one LineString each.
+    # Otherwise every undirected edge becomes its own two-point LineString.
+    if chain_segments:
+        return [road_graph.nodes[segment] for segment in road_graph.segments()]
+    return list(road_graph.nodes[graph_utils.dedupe_edges(road_graph.edges)])
+
+def simplify_lines(lines, tolerance):
+    # Topology-preserving Douglas-Peucker simplification, tolerance in pixels.
+    # Line endpoints are always kept, so the lines stay joined at junctions.
+    if not lines:
+        return []
+    simplified = shapely.simplify(
+        shapely.linestrings(np.concatenate(lines), indices=np.repeat(np.arange(len(lines)), [len(line) for line in lines])),
+        tolerance,
+        preserve_topology=True,
+    )
+    coords, line_index = shapely.get_coordinates(simplified, return_index=True)
+    return np.split(coords, np.flatnonzero(np.diff(line_index)) + 1)
+
+def lines_to_geojson(lines, transform, crs):
     features = []
-    for element in overpass_json.get("elements", []):
-        if element["type"] == "way":
-            geometry = {
-                "type": "LineString",
-                "coordinates": [
-                    nodes.get(node_id)
-                    for node_id in element.get("nodes", [])
-                    if nodes.get(node_id)
-                ],
+    if lines:
+        # Projects all vertices at once.
+        coords = np.concatenate(lines)
+        lonlat = pixels_to_lonlat(coords[:, 0], coords[:, 1], transform, crs)
+        for coordinates in np.split(lonlat, np.cumsum([len(line) for line in lines])[:-1]):
+            feature = {
+                "type": "Feature",
+                "geometry": {
+                    "type": "LineString",
+                    "coordinates": coordinates.tolist(),
+                },
+                "properties": {},
             }
-            if all(geometry["coordinates"]):
-                features.append(
-                    {
-                        "type": "Feature",
-                        "properties": element.get("tags", {}),
-                        "geometry": geometry,
-                    }
-                )
+            features.append(feature)
     return {"type": "FeatureCollection", "features": features}
 
-def create_osm_mask(geojson_data, image_bounds, image_size=(512, 512), line_width=3):
-    height, width = image_size
-    lat_min, lat_max, lon_min, lon_max = image_bounds
-    mask_image = Image.new("L", (width, height), 0)
-    draw = ImageDraw.Draw(mask_image)
-    def geo_to_pixel(lon, lat):
-        if lon_max == lon_min or lat_max == lat_min:
-            return 0, 0
-        x = (lon - lon_min) * (width / (lon_max - lon_min))
-        y = (lat_max - lat) * (height / (lat_max - lat_min))
-        return int(x), int(y)
-    for feature in geojson_data.get("features", []):
-        if feature["geometry"]["type"] == "LineString":
-            coordinates = feature["geometry"]["coordinates"]
-            pixel_points = [geo_to_pixel(lon, lat) for lon, lat in coordinates]
-            if len(pixel_points) >= 2:
-                draw.line(pixel_points, fill=255, width=line_width)
-    return mask_image
-
-def graph_to_geojson(adjacency_list, transform, crs):
-    features = []
+def graph_to_geojson(road_graph, transform, crs, chain_segments=True, tolerance=0.0):
+    # tolerance: simplification tolerance in pixels, 0 for full resolution.
     try:
-        transformer = Transformer.from_crs(crs, "EPSG:4326", always_xy=True)
-        for source_node_yx, dest_nodes_yx in adjacency_list.items():
-            for dest_node_yx in dest_nodes_yx:
-                source_y_pixel, source_x_pixel = source_node_yx
-                dest_y_pixel, dest_x_pixel = dest_node_yx
-
-                start_x_proj, start_y_proj = (source_x_pixel + 0.5, source_y_pixel + 0.5) * transform
-                end_x_proj, end_y_proj = (dest_x_pixel + 0.5, dest_y_pixel + 0.5) * transform
-
-                start_lon, start_lat = transformer.transform(start_x_proj, start_y_proj)
-                end_lon, end_lat = transformer.transform(end_x_proj, end_y_proj)
-
-                feature = {
-                    "type": "Feature",
-                    "geometry": {
-                        "type": "LineString",
-                        "coordinates": [
-                            [float(start_lon), float(start_lat)],
-                            [float(end_lon), float(end_lat)],
-                        ],
-                    },
-                    "properties": {},
-                }
-                features.append(feature)
+        lines = road_graph_lines(road_graph, chain_segments)
+        if tolerance > 0:
+            lines = simplify_lines(lines, tolerance)
+        geojson = lines_to_geojson(lines, transform, crs)
+        logging.info(f"Converted {road_graph.edge_num} road edges to {len(geojson['features'])} GeoJSON features.")
     except Exception as e:
         logging.error(f"Error during graph to GeoJSON conversion: {e}")
         return {"type": "FeatureCollection", "features": []}
-    return {"type": "FeatureCollection", "features": features}
+    return geojson
+
+def build_road_lods(road_graph, transform, crs):
+    # Chained predicted roads at every level of detail, keyed by tolerance.
+    lines = road_graph_lines(road_graph)
+    lods = {}
+    for tolerance in ROAD_LOD_TOLERANCES:
+        lod_lines = simplify_lines(lines, tolerance) if tolerance > 0 else lines
+        lods[tolerance] = lines_to_geojson(lod_lines, transform, crs)
+    logging.info(
+        "Built road levels of detail: "
+        + ", ".join(f"{t}px: {sum(len(f['geometry']['coordinates']) for f in g['features'])} vertices" for t, g in lods.items())
+    )
+    return lods
+
+def get_road_lods(graph_path, image_path, transform_json_path=None):
+    # Levels of detail are built once per graph file and rebuilt if it changes.
+    def build():
+        road_graph, transform, crs = load_predicted_graph(graph_path, image_path, transform_json_path)
+        # Metres per image pixel and latitude, to match tolerances to zoom levels.
+        pixel_size = math.sqrt(abs(transform.determinant))
+        if pyproj.CRS.from_user_input(str(crs)).is_geographic:
+            pixel_size *= METERS_PER_DEGREE
+        center = road_graph.nodes.mean(axis=0) if road_graph.node_num else np.zeros(2)
+        lat = float(pixels_to_lonlat(center[:1], center[1:], transform, crs)[0, 1])
+        return {
+            "lods": build_road_lods(road_graph, transform, crs),
+            "pixel_size": pixel_size,
+            "lat": lat,
+        }
+
+    return prediction_cache.get(
+        (graph_path, "lods"), [graph_path, image_path, transform_json_path], build
+    )
+
+def predicted_roads_to_geojson(graph_path, image_path, transform_json_path=None, zoom=None, tolerance=None):
+    # Full resolution unless a zoom or tolerance asks for a level of detail.
+    if zoom is None and tolerance is None:
+        road_graph, transform, crs = load_predicted_graph(graph_path, image_path, transform_json_path)
+        return graph_to_geojson(road_graph, transform, crs)
+    return select_road_lod(get_road_lods(graph_path, image_path, transform_json_path), zoom, tolerance)[1]
+
+def predicted_tile_geojson(geojson, graph_path, image_path, transform_json_path=None, zoom=None, tolerance=None):
+    # Tiles simplify per zoom level themselves, so the tile layer always gets
+    # the full resolution lines, whatever level of detail the response used.
+    if zoom is None and tolerance is None:
+        return geojson
+    return get_road_lods(graph_path, image_path, transform_json_path)["lods"][0.0]
+
+def parse_lod_args(args):
+    # Reads the optional zoom and tolerance query parameters.
+    # Raises ValueError on malformed values, zooms outside the web map range
+    # and negative or non-finite tolerances.
+    zoom = args.get("zoom", type=float)
+    tolerance = args.get("tolerance", type=float)
+    if args.get("zoom") is not None and (zoom is None or not 0 <= zoom <= MAX_ZOOM):
+        raise ValueError(f"Invalid 'zoom' parameter, expected a number from 0 to {MAX_ZOOM}.")
+    if args.get("tolerance") is not None and (
+        tolerance is None or not math.isfinite(tolerance) or tolerance < 0
+    ):
+        raise ValueError("Invalid 'tolerance' parameter, expected a non-negative number.")
+    return zoom, tolerance
+
+def select_road_lod(road_lods, zoom=None, tolerance=None):
+    # Picks the coarsest level whose tolerance is at most the requested one.
+    # A zoom level asks for the tolerance of one web map pixel at that zoom.
+    if tolerance is None:
+        if zoom is None:
+            tolerance = 0.0
+        else:
+            screen_pixel_size = (
+                WEB_MERCATOR_EQUATOR_M * math.cos(math.radians(road_lods["lat"])) / (256 * 2 ** zoom)
+            )
+            tolerance = screen_pixel_size / road_lods["pixel_size"]
+    selected = max(t for t in ROAD_LOD_TOLERANCES if t <= max(tolerance, 0.0))
+    return selected, road_lods["lods"][selected]
 
 @app.route("/")
 def index():
@@ -153,31 +326,55 @@ def get_roads():
 
     try:
         min_lon, min_lat, max_lon, max_lat = [float(coord) for coord in bbox.split(",")]
-        overpass_bbox = f"{min_lat},{min_lon},{max_lat},{max_lon}"
+        if not all(math.isfinite(coord) for coord in (min_lon, min_lat, max_lon, max_lat)):
+            raise ValueError("non-finite coordinate")
     except (ValueError, IndexError) as e:
         logging.error(f"Invalid 'bbox' format: {bbox}. Error: {e}")
         return jsonify({"error": "Invalid 'bbox' format."}), 400
+    if query_date:
+        # The date also names the cache directory, so it must be a plain date.
+        try:
+            query_date = datetime.strptime(query_date, "%Y-%m-%d").date().isoformat()
+        except ValueError:
+            return jsonify({"error": "Invalid 'date' format, expected YYYY-MM-DD."}), 400
 
-    overpass_types = "|".join(types_str.split(","))
-    overpass_url = "https://overpass-api.de/api/interpreter"
-    date_setting = f'[date:"{query_date}T23:59:59Z"]' if query_date else ""
+    source = request.args.get("source", OSM_ROADS_SOURCE)
+    if source not in ("auto", "local", "overpass"):
+        return jsonify({"error": "Invalid 'source', expected 'auto', 'local' or 'overpass'."}), 400
 
-    overpass_query = f"""
-        [out:json][timeout:25]{date_setting};
-        (way["highway"~"^({overpass_types})$"]({overpass_bbox}););
-        out body;>;out skel qt;
-    """
+    query_bbox = (min_lon, min_lat, max_lon, max_lat)
     try:
-        response = requests.post(overpass_url, data={"data": overpass_query})
-        logging.info(f"Overpass API response status: {response.status_code}")
-        response.raise_for_status()
-        data = response.json()
+        if source == "local" or (
+            source == "auto" and osm_store.covers(query_bbox, query_date, OSM_STORE_DATE_TOLERANCE_DAYS)
+        ):
+            if not osm_store.exists():
+                return jsonify({"error": "No local OSM road store has been imported."}), 404
+            if not osm_store.matches_date(query_date, OSM_STORE_DATE_TOLERANCE_DAYS):
+                snapshot_date = osm_store.metadata()["snapshot_date"] or "an unknown date"
+                return jsonify(
+                    {"error": f"The local OSM road store holds roads of {snapshot_date}, not of {query_date}."}
+                ), 404
+            start_time = time.time()
+            osm_geojson = osm_store.get_roads(query_bbox, types_str.split(","))
+            logging.info(
+                f"Read {len(osm_geojson['features'])} OSM roads from the local store "
+                f"in {time.time() - start_time:.3f}s"
+            )
+        else:
+            osm_geojson, stats = overpass_cache.get_roads(query_bbox, types_str.split(","), query_date)
+            logging.info(f"OSM road tiles: {stats}")
     except requests.exceptions.RequestException as e:
         return jsonify({"error": f"Failed to fetch data from Overpass API: {e}"}), 502
     except json.JSONDecodeError:
         return jsonify({"error": "Failed to parse response from Overpass API."}), 500
+    except ValueError as e:
+        # Too many cache tiles.
+        return jsonify({"error": str(e)}), 400
 
-    return jsonify(overpass_to_geojson(data))
+    tile_store.set_layer("osm", osm_geojson)
+    # Streamed in batches, large areas would otherwise be encoded into one
+    # string holding every feature.
+    return Response(stream_feature_collection(osm_geojson["features"]), mimetype="application/json")
 
 @app.route("/api/upload_image", methods=["POST"])
 def upload_image():
@@ -302,18 +499,35 @@ def process_satellite_image():
         logging.error(f"Image processing failed: {e}", exc_info=True)
         return jsonify({"error": str(e)}), 500
 
+def satellite_image_path(prefix):
+    # GeoTIFF of the pre or post event image, None for other prefixes.
+    if prefix not in ("pre", "post"):
+        return None
+    return os.path.join(backend_static_folder, f"temp_satellite_{prefix}.tif")
+
 @app.route("/api/generate_osm_mask", methods=["POST"])
 def generate_osm_mask():
     try:
         request_data = request.get_json()
         osm_geojson = request_data.get('osm_data')
         image_bounds_str = request_data.get('image_bounds')
-
-        if not all([osm_geojson, image_bounds_str]):
+        prefix = request_data.get('prefix')
+        geotiff_path = None
+        if prefix:
+            geotiff_path = satellite_image_path(prefix)
+            if geotiff_path is None:
+                return jsonify({"error": "Invalid 'prefix', expected 'pre' or 'post'."}), 400
+
+        if not osm_geojson or not (image_bounds_str or geotiff_path):
             return jsonify({"error": "Missing 'osm_data' or 'image_bounds' in request body"}), 400
-
-        image_bounds = [float(b) for b in image_bounds_str.split(',')]
-        osm_mask_image = create_osm_mask(osm_geojson, image_bounds, image_size=(512, 512))
+        if geotiff_path and os.path.exists(geotiff_path):
+            # On the image's own grid, at its resolution.
+            osm_mask_image = create_osm_mask(osm_geojson, geotiff_path=geotiff_path)
+        elif not image_bounds_str:
+            return jsonify({"error": f"GeoTIFF not found: temp_satellite_{prefix}.tif"}), 404
+        else:
+            image_bounds = [float(b) for b in image_bounds_str.split(',')]
+            osm_mask_image = create_osm_mask(osm_geojson, image_bounds, image_size=(512, 512))
 
         unique_id = int(time.time())
         mask_filename = f"osm_mask_{unique_id}.png"
@@ -332,6 +546,10 @@ def get_predicted_roads():
         prefix = request.args.get("prefix", "pre")
         bbox_str = request.args.get("bbox")
         image_param = request.args.get("image")
+        try:
+            zoom, tolerance = parse_lod_args(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
         default_geotiff = os.path.join(backend_static_folder, f"temp_satellite_{prefix}.tif")
 
@@ -385,12 +603,6 @@ def get_predicted_roads():
 
                 try:
                     case_dir = os.path.dirname(input_geotiff_path)
-                    candidate_graphs = [
-                        os.path.join(case_dir, f"graph_{prefix}.p"),
-                        os.path.join(case_dir, f"{prefix}.p"),
-                        os.path.join(case_dir, "0.p"),
-                        os.path.join(case_dir, "graph.p")
-                    ]
                     candidate_masks = [
                         os.path.join(case_dir, f"predicted_mask_{prefix}.png"),
                         os.path.join(case_dir, f"predicted_mask.png"),
@@ -398,31 +610,23 @@ def get_predicted_roads():
                         os.path.join(case_dir, "mask.png")
                     ]
 
-                    found_graph = next((p for p in candidate_graphs if os.path.exists(p)), None)
+                    found_graph = find_prediction_graph(case_dir, [f"graph_{prefix}", prefix, "0", "graph"])
                     found_mask = next((p for p in candidate_masks if os.path.exists(p)), None)
 
                     if found_graph and found_mask:
                         logging.info(f"Found saved case outputs, returning saved graph+mask from {case_dir}")
-                        with open(found_graph, 'rb') as f:
-                            predicted_graph_data = pickle.load(f)
-
-                        with rasterio.open(image_to_process) as src:
-                            crs = src.crs
-                            transform = src.transform
-
                         transform_json_path = None
                         for candidate in os.listdir(case_dir):
                             if candidate.endswith('_transform.json') or candidate.endswith('transform.json'):
                                 transform_json_path = os.path.join(case_dir, candidate)
                                 break
-                        if transform_json_path and os.path.exists(transform_json_path):
-                            try:
-                                with open(transform_json_path, 'r') as f_t:
-                                    transform = Affine.from_gdal(*json.load(f_t))
-                            except Exception:
-                                logging.warning('Could not load transform JSON; falling back to image transform')
+                        predicted_roads_geojson = predicted_roads_to_geojson(
+                            found_graph, image_to_process, transform_json_path, zoom, tolerance
+                        )
 
-                        predicted_roads_geojson = graph_to_geojson(predicted_graph_data, transform, crs)
+                        tile_store.set_layer(f"predicted_{prefix}", predicted_tile_geojson(
+                            predicted_roads_geojson, found_graph, image_to_process, transform_json_path, zoom, tolerance
+                        ))
 
                         unique_id = f"{prefix}_{int(time.time())}"
                         mask_filename = f"predicted_mask_{unique_id}.png"
@@ -461,30 +665,32 @@ def get_predicted_roads():
 
         logging.info("Executing inference command: %s", ' '.join(command))
 
+        # The run rewrites this prefix's outputs. Stamps would catch that too,
+        # but an aborted run shouldn't leave stale entries behind either.
+        prediction_cache.invalidate(prefix)
         try:
             subprocess.run(command, capture_output=True, text=True, check=True, cwd=SAM_ROAD_PROJECT_DIR)
         except subprocess.CalledProcessError as e:
             logging.error(f"Inference error: {e.stderr}")
             return jsonify({"error": "Failed to run road prediction model.", "details": e.stderr}), 500
 
-        graph_path = os.path.join(model_output_dir, "graph", "0.p")
+        graph_path = find_prediction_graph(os.path.join(model_output_dir, "graph"), ["0"])
         mask_image_path = os.path.join(model_output_dir, "mask", "0_road.png")
         transform_path = os.path.join(model_output_dir, "graph", "0_transform.json")
 
-        if not all(os.path.exists(p) for p in [graph_path, mask_image_path]):
+        if graph_path is None or not os.path.exists(mask_image_path):
             return jsonify({"error": "Model output or georeference file not found."}), 500
 
-        with open(graph_path, "rb") as f:
-            predicted_graph_data = pickle.load(f)
-
-        with rasterio.open(image_to_process) as src:
-            crs = src.crs
-            transform = src.transform
-            if os.path.exists(transform_path):
-                with open(transform_path, 'r') as f_transform:
-                    transform = Affine.from_gdal(*json.load(f_transform))
+        predicted_roads_geojson = predicted_roads_to_geojson(
+            graph_path, image_to_process, transform_path, zoom, tolerance
+        )
 
-        predicted_roads_geojson = graph_to_geojson(predicted_graph_data, transform, crs)
+        tile_store.set_layer(f"predicted_{prefix}", predicted_tile_geojson(
+            predicted_roads_geojson, graph_path, image_to_process, transform_path, zoom, tolerance
+        ))
+        # Decodes the road mask now rather than in the first raster comparison.
+        if os.path.exists(default_geotiff):
+            get_prediction_mask(prefix)
 
         unique_id = f"{prefix}_{int(time.time())}"
         mask_filename = f"predicted_mask_{unique_id}.png"
@@ -498,28 +704,147 @@ def get_predicted_roads():
         logging.error(f"An unexpected error occurred in get_predicted_roads: {e}", exc_info=True)
         return jsonify({"error": "An unexpected server error occurred.", "details": str(e)}), 500
 
-def get_prediction_geojson(prefix):
-    """Helper function to load graph, transform, and convert to GeoJSON."""
+def prediction_paths(prefix):
+    # Graph, GeoTIFF and legacy transform JSON of a detection run. The graph
+    # path is None if the run hasn't produced one.
     geotiff_path = os.path.join(backend_static_folder, f"temp_satellite_{prefix}.tif")
-    model_output_dir = os.path.join(SAM_ROAD_PROJECT_DIR, "save", f"sentinel_test_{prefix}")
-    graph_path = os.path.join(model_output_dir, "graph", "0.p")
-    transform_path = os.path.join(model_output_dir, "graph", "0_transform.json")
+    graph_dir = os.path.join(SAM_ROAD_PROJECT_DIR, "save", f"sentinel_test_{prefix}", "graph")
+    graph_path = find_prediction_graph(graph_dir, ["0"])
+    transform_path = os.path.join(graph_dir, "0_transform.json")
+    return graph_path, geotiff_path, transform_path
 
-    if not os.path.exists(graph_path):
-        raise FileNotFoundError(f"Prediction file not found: {graph_path}")
-
-    with open(graph_path, "rb") as f:
-        graph_data = pickle.load(f)
-
-    with rasterio.open(geotiff_path) as src:
-        crs = src.crs
-        transform = src.transform
+def get_prediction_geojson(prefix, chain_segments=True):
+    """Helper function to load graph, transform, and convert to GeoJSON."""
+    graph_path, geotiff_path, transform_path = prediction_paths(prefix)
+    if graph_path is None:
+        raise FileNotFoundError(f"Prediction file not found for: {prefix}")
+
+    def build():
+        graph, transform, crs = load_predicted_graph(graph_path, geotiff_path, transform_path)
+        return graph_to_geojson(graph, transform, crs, chain_segments)
+
+    return prediction_cache.get(
+        (prefix, "geojson", chain_segments), [graph_path, geotiff_path, transform_path], build
+    )
+
+def get_prediction_index(prefix, chain_segments=True, crs=None):
+    # Spatial index of a prediction for damage analysis, projected to crs or
+    # by default to the UTM zone of its roads.
+    graph_path, geotiff_path, transform_path = prediction_paths(prefix)
+    geojson = get_prediction_geojson(prefix, chain_segments)
+
+    def build():
+        return RoadIndex(geojson, crs or road_index_crs(geojson) or "EPSG:3857")
+
+    return prediction_cache.get(
+        (prefix, "index", chain_segments, crs), [graph_path, geotiff_path, transform_path], build
+    )
+
+
+def prediction_mask_paths(prefix):
+    mask_dir = os.path.join(SAM_ROAD_PROJECT_DIR, "save", f"sentinel_test_{prefix}", "mask")
+    return [
+        os.path.join(mask_dir, "0_road.png"),
+        os.path.join(mask_dir, "0_road_transform.json"),
+        os.path.join(backend_static_folder, f"temp_satellite_{prefix}.tif"),
+    ]
+
+def get_prediction_mask(prefix):
+    # Fused road probability mask of a detection run with its grid. Runs from
+    # before the mask georeference was saved are assumed to cover the whole
+    # GeoTIFF.
+    mask_path, transform_path, geotiff_path = prediction_mask_paths(prefix)
+    if not os.path.exists(mask_path):
+        raise FileNotFoundError(f"Prediction mask not found: {mask_path}")
+
+    def build():
+        mask = np.array(Image.open(mask_path).convert("L"))
+        with rasterio.open(geotiff_path) as src:
+            crs = src.crs
+            transform = src.transform * Affine.scale(src.width / mask.shape[1], src.height / mask.shape[0])
         if os.path.exists(transform_path):
             with open(transform_path, 'r') as f_transform:
                 transform = Affine.from_gdal(*json.load(f_transform))
+        return mask, transform, crs
+
+    return prediction_cache.get((prefix, "mask"), [mask_path, transform_path, geotiff_path], build)
+
+def get_aligned_prediction_masks():
+    # Pre and post road masks on the pre-event grid. Resampling the post mask
+    # is the slowest step of raster change detection when the runs' grids
+    # differ, so it is done once per pair of runs.
+    pre_mask, pre_transform, pre_crs = get_prediction_mask('pre')
+
+    def build():
+        post_mask, post_transform, post_crs = get_prediction_mask('post')
+        return align_mask(post_mask, post_transform, post_crs, pre_mask.shape, pre_transform, pre_crs)
+
+    post_mask = prediction_cache.get(
+        ('post', "aligned_mask"), prediction_mask_paths('pre') + prediction_mask_paths('post'), build
+    )
+    return pre_mask, post_mask, pre_transform, pre_crs
+
+def find_damaged_roads_raster(osm_geojson, buffer_m, road_threshold):
+    # Damaged pre-event road edges from the change between the road masks.
+    graph_path, geotiff_path, transform_path = prediction_paths('pre')
+    if graph_path is None:
+        raise FileNotFoundError("Prediction file not found for: pre")
+    road_graph, graph_transform, crs = load_predicted_graph(graph_path, geotiff_path, transform_path)
+    pre_mask, post_mask, pre_transform, pre_crs = get_aligned_prediction_masks()
+    damaged, stats = find_damaged_edges_raster(
+        road_graph, graph_transform, pre_mask, pre_transform, post_mask, pre_transform, pre_crs,
+        osm_geojson, buffer_m, road_threshold * 255,
+    )
+    logging.info(f"Raster change detection: {stats}")
+    damaged_graph = graph_utils.RoadGraph(road_graph.nodes, road_graph.edges[damaged])
+    return graph_to_geojson(damaged_graph, graph_transform, crs, chain_segments=False)
+
+@app.route("/api/get_predicted_roads_lod", methods=["GET"])
+def get_predicted_roads_lod():
+    # Serves an existing prediction at the level of detail for a map zoom,
+    # without running the model again.
+    prefix = request.args.get("prefix", "pre")
+    try:
+        zoom, tolerance = parse_lod_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    return graph_to_geojson(graph_data, transform, crs)
+    graph_path, geotiff_path, transform_path = prediction_paths(prefix)
+    if graph_path is None:
+        return jsonify({"error": "No prediction found. Please run the detection first."}), 404
 
+    try:
+        road_lods = get_road_lods(graph_path, geotiff_path, transform_path)
+        lod_tolerance, geojson = select_road_lod(road_lods, zoom, tolerance)
+    except Exception as e:
+        logging.error(f"Error building road levels of detail: {e}", exc_info=True)
+        return jsonify({"error": "Could not load prediction data."}), 500
+    return jsonify({"geojson": geojson, "tolerance": lod_tolerance, "levels": list(ROAD_LOD_TOLERANCES)})
+
+@app.route("/tiles/<layer>/<int:z>/<int:x>/<int:y>.pbf", methods=["GET"])
+def get_vector_tile(layer, z, x, y):
+    # Layers: osm, predicted_pre, predicted_post and damaged, each holding the
+    # result of the latest request that produced it.
+    # Tiles are revalidated with their ETag, unchanged ones get a 304 without
+    # being rendered again.
+    versions = tile_store.layer_versions()
+    if layer not in versions:
+        return jsonify({"error": f"Unknown tile layer: {layer}"}), 404
+    try:
+        check_tile(z, x, y)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    etag = f"{layer}-{versions[layer]}-{z}-{x}-{y}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        tile = tile_store.get_tile(layer, z, x, y)
+        if tile is None:
+            return jsonify({"error": f"Unknown tile layer: {layer}"}), 404
+        response = Response(tile, mimetype="application/vnd.mapbox-vector-tile")
+    response.headers["Cache-Control"] = "no-cache"
+    response.set_etag(etag)
+    return response
 
 @app.route("/api/compare_roads", methods=["POST"])
 def compare_roads():
@@ -528,9 +853,22 @@ def compare_roads():
         osm_geojson = request_data.get('osm_data')
         if not osm_geojson:
             return jsonify({"error": "Missing 'osm_data' in request body"}), 400
+        try:
+            buffer_m = float(request_data.get('buffer_m', DEFAULT_DAMAGE_BUFFER_M))
+            road_threshold = float(request_data.get('road_threshold', RASTER_ROAD_THRESHOLD))
+        except (TypeError, ValueError):
+            return jsonify({"error": "Invalid 'buffer_m' or 'road_threshold' value."}), 400
+        # vector compares the vectorised predictions, raster the road masks.
+        mode = request_data.get('mode', 'vector')
+        if mode not in ('vector', 'raster'):
+            return jsonify({"error": "Invalid 'mode', expected 'vector' or 'raster'."}), 400
+        if not any(feature.get("geometry") for feature in osm_geojson.get("features", [])):
+            return jsonify({"error": "No OSM roads found in the data to use as a reference."}), 404
 
-        pre_event_geojson = get_prediction_geojson('pre')
-        post_event_geojson = get_prediction_geojson('post')
+        if mode == 'vector':
+            # Damage is reported per road edge, so pre-event roads are not chained.
+            pre_event_roads = get_prediction_index('pre', chain_segments=False)
+            post_event_roads = get_prediction_index('post', crs=pre_event_roads.crs)
 
     except FileNotFoundError as e:
         logging.error(f"Prediction file not found: {e}")
@@ -540,32 +878,83 @@ def compare_roads():
         return jsonify({"error": "Could not load prediction data."}), 500
 
     try:
-        post_lines = [shape(feature["geometry"]) for feature in post_event_geojson["features"]]
-        osm_lines = [shape(feature["geometry"]) for feature in osm_geojson["features"]]
-        if not osm_lines:
-            return jsonify({"error": "No OSM roads found in the data to use as a reference."}), 404
-
-        post_union = unary_union(post_lines).buffer(0.0001) if post_lines else None
-        osm_union = unary_union(osm_lines).buffer(0.0001)
-
-        damaged_roads = []
-        for feature in pre_event_geojson["features"]:
-            pre_line = shape(feature["geometry"])
-            is_on_osm = pre_line.intersects(osm_union)
-            is_in_post = post_union and pre_line.intersects(post_union)
-
-            if is_on_osm and not is_in_post:
-                damaged_roads.append(feature)
-
-        result_geojson = {"type": "FeatureCollection", "features": damaged_roads}
+        start_time = time.time()
+        if mode == 'raster':
+            result_geojson = find_damaged_roads_raster(osm_geojson, buffer_m, road_threshold)
+        else:
+            result_geojson = find_damaged_roads(
+                pre_event_roads, post_event_roads, osm_geojson, buffer_m
+            )
+        logging.info(
+            f"Found {len(result_geojson['features'])} damaged roads ({mode} mode) "
+            f"in {time.time() - start_time:.2f}s"
+        )
+        tile_store.set_layer("damaged", result_geojson)
         return jsonify({"geojson": result_geojson})
 
+    except FileNotFoundError as e:
+        logging.error(f"Prediction file not found: {e}")
+        return jsonify({"error": "A prediction file was not found. Please run both detections first."}), 404
     except Exception as e:
         logging.error(f"Error during comparison: {e}", exc_info=True)
         return jsonify({"error": f"An unexpected error occurred during analysis: {e}"}), 500
 
+@app.route("/api/score_osm_damage", methods=["POST"])
+def score_osm_damage():
+    # Scores every OSM way by the fraction of its road pixels lost between the
+    # pre and post road masks. Returns the ways with damage_score,
+    # pre_road_fraction and coverage properties added.
+    request_data = request.get_json(silent=True) or {}
+    osm_geojson = request_data.get('osm_data')
+    if not osm_geojson:
+        return jsonify({"error": "Missing 'osm_data' in request body"}), 400
+    try:
+        road_threshold = float(request_data.get('road_threshold', RASTER_ROAD_THRESHOLD))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid 'road_threshold' value."}), 400
+
+    try:
+        pre_mask, pre_transform, pre_crs = get_prediction_mask('pre')
+        post_mask, post_transform, post_crs = get_prediction_mask('post')
+    except FileNotFoundError as e:
+        logging.error(f"Prediction mask not found: {e}")
+        return jsonify({"error": "A prediction mask was not found. Please run both detections first."}), 404
+
+    try:
+        start_time = time.time()
+        scores = score_ways(
+            osm_geojson, pre_mask, pre_transform, post_mask, post_transform, pre_crs,
+            road_threshold * 255, post_crs=post_crs,
+        )
+        features = []
+        for feature, damage_score, pre_road_fraction, coverage in zip(
+            osm_geojson.get("features", []),
+            scores["damage_score"].tolist(),
+            scores["pre_road_fraction"].tolist(),
+            scores["coverage"].tolist(),
+        ):
+            properties = dict(feature.get("properties") or {})
+            # NaN isn't valid JSON, ways never seen as road get null.
+            properties["damage_score"] = None if math.isnan(damage_score) else damage_score
+            properties["pre_road_fraction"] = None if math.isnan(pre_road_fraction) else pre_road_fraction
+            properties["coverage"] = None if math.isnan(coverage) else coverage
+            features.append({**feature, "properties": properties})
+        logging.info(f"Scored {len(features)} OSM ways in {time.time() - start_time:.2f}s")
+        return jsonify({"geojson": {"type": "FeatureCollection", "features": features}})
+    except Exception as e:
+        logging.error(f"Error during OSM damage scoring: {e}", exc_info=True)
+        return jsonify({"error": f"An unexpected error occurred during scoring: {e}"}), 500
+
+def geopackage_path(gpkg_id):
+    # Path of an uploaded GeoPackage, None for ids that aren't upload ids.
+    if not gpkg_id or not re.fullmatch(r"[0-9a-f]{32}", gpkg_id):
+        return None
+    return os.path.join(backend_static_folder, f"gpkg_{gpkg_id}.gpkg")
+
 @app.route("/api/upload_geopackage", methods=["POST"])
 def upload_geopackage():
+    # Stores the GeoPackage and lists its layers. Features are then read per
+    # layer from /api/get_geopackage_features.
     if 'file' not in request.files:
         return jsonify({"error": "No file part in the request"}), 400
 
@@ -576,32 +965,64 @@ def upload_geopackage():
     if not file.filename.lower().endswith('.gpkg'):
         return jsonify({"error": "Invalid file type. Please upload a GeoPackage (.gpkg) file."}), 400
 
-    temp_gpkg_path = os.path.join(backend_static_folder, f"temp_{file.filename}")
+    gpkg_id = uuid.uuid4().hex
+    gpkg_path = geopackage_path(gpkg_id)
 
     try:
-        file.save(temp_gpkg_path)
-
-        layers_data = []
-        for layer_name in fiona.listlayers(temp_gpkg_path):
-            gdf = gpd.read_file(temp_gpkg_path, layer=layer_name)
-
-            if gdf.empty:
-                continue
-
-            if gdf.crs and gdf.crs.to_epsg() != 4326:
-                gdf = gdf.to_crs("EPSG:4326")
-
-            geojson_data = json.loads(gdf.to_json())
-            layers_data.append({"name": layer_name, "geojson": geojson_data})
+        file.save(gpkg_path)
+        return jsonify({"id": gpkg_id, "layers": list_layers(gpkg_path)})
+    except Exception as e:
+        logging.error(f"Failed to process GeoPackage file: {e}", exc_info=True)
+        if os.path.exists(gpkg_path):
+            os.remove(gpkg_path)
+        return jsonify({"error": "Failed to process GeoPackage file.", "details": str(e)}), 500
 
-        return jsonify(layers_data)
+@app.route("/api/get_geopackage_layers", methods=["GET"])
+def get_geopackage_layers():
+    gpkg_path = geopackage_path(request.args.get("id"))
+    if gpkg_path is None or not os.path.exists(gpkg_path):
+        return jsonify({"error": "GeoPackage not found. Please upload it again."}), 404
+    try:
+        return jsonify({"id": request.args.get("id"), "layers": list_layers(gpkg_path)})
+    except Exception as e:
+        logging.error(f"Failed to list GeoPackage layers: {e}", exc_info=True)
+        return jsonify({"error": "Failed to process GeoPackage file.", "details": str(e)}), 500
 
+@app.route("/api/get_geopackage_features", methods=["GET"])
+def get_geopackage_features():
+    # Streams the features of one layer as WGS84 GeoJSON, optionally only
+    # those intersecting bbox (min_lon,min_lat,max_lon,max_lat) and simplified
+    # with a tolerance in metres.
+    gpkg_path = geopackage_path(request.args.get("id"))
+    if gpkg_path is None or not os.path.exists(gpkg_path):
+        return jsonify({"error": "GeoPackage not found. Please upload it again."}), 404
+    layer = request.args.get("layer")
+    if not layer:
+        return jsonify({"error": "Missing 'layer' query parameter"}), 400
+
+    bbox = None
+    bbox_str = request.args.get("bbox")
+    try:
+        if bbox_str:
+            bbox = [float(coord) for coord in bbox_str.split(",")]
+            if len(bbox) != 4:
+                raise ValueError(bbox_str)
+        tolerance_m = float(request.args.get("tolerance", 0.0))
+    except ValueError:
+        return jsonify({"error": "Invalid 'bbox' or 'tolerance' format."}), 400
+
+    # Checked before streaming starts, errors can't change the status after.
+    try:
+        if layer not in fiona.listlayers(gpkg_path):
+            return jsonify({"error": f"Layer not found: {layer}"}), 404
     except Exception as e:
-        logging.error(f"Failed to process GeoPackage file: {e}", exc_info=True)
+        logging.error(f"Failed to open GeoPackage: {e}", exc_info=True)
         return jsonify({"error": "Failed to process GeoPackage file.", "details": str(e)}), 500
-    finally:
-        if os.path.exists(temp_gpkg_path):
-            os.remove(temp_gpkg_path)
+
+    return Response(
+        iter_layer_geojson(gpkg_path, layer, bbox=bbox, tolerance_m=tolerance_m),
+        mimetype="application/json",
+    )
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=4000, debug=True)
\ No newline at end of file
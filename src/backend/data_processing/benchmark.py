@@ -0,0 +1,585 @@
+import glob
+import importlib
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import cv2
+from affine import Affine
+from pyproj import Transformer
+import networkx as nx
+import igraph as ig
+import rtree
+from collections import deque
+from shapely.geometry import LineString, Point, shape
+from shapely.ops import unary_union
+from shapely.strtree import STRtree
+from sklearn.cluster import DBSCAN
+
+import graph_extraction
+import graph_utils
+from utils import load_config
+
+
+DEFAULT_CONFIG_PATH = "../model_files/spacenet_custom.yaml"
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_backend_util(name):
+    # Imports backend/utils/<name>.py. The backend's utils is a namespace
+    # package, which loses to the utils module of this directory, so this
+    # directory is left out of the path while importing.
+    project_dir = os.path.dirname(os.path.abspath(__file__))
+    project_utils = sys.modules.pop("utils", None)
+    path = sys.path
+    sys.path = [BACKEND_DIR] + [p for p in path if os.path.abspath(p or os.curdir) != project_dir]
+    try:
+        return importlib.import_module(f"utils.{name}")
+    finally:
+        sys.path = path
+        if project_utils is not None:
+            sys.modules["utils"] = project_utils
+
+
+def time_call(fn, *args, repeat=3, **kwargs):
+    # Returns the result of the last call and the best wall time in seconds.
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def synthetic_masks(size, num_roads, seed=0):
+    # Random straight roads with blurred, partly saturated road scores and
+    # keypoint blobs at the road ends, as uint8 masks like the fused ones.
+    rng = np.random.default_rng(seed)
+    road = np.zeros((size, size), dtype=np.float32)
+    keypoint = np.zeros((size, size), dtype=np.float32)
+    for _ in range(num_roads):
+        x0, y0, x1, y1 = (int(v) for v in rng.integers(0, size, 4))
+        cv2.line(road, (x0, y0), (x1, y1), 1.0, 9)
+        cv2.circle(keypoint, (x0, y0), 6, 1.0, -1)
+        cv2.circle(keypoint, (x1, y1), 6, 1.0, -1)
+    road = cv2.GaussianBlur(road, (0, 0), 2.5)
+    keypoint = cv2.GaussianBlur(keypoint, (0, 0), 2.0)
+    road = np.clip(road * 1.3 + rng.normal(0.0, 0.03, road.shape), 0.0, 1.0)
+    keypoint_mask = (np.clip(keypoint, 0.0, 1.0) * 255).astype(np.uint8)
+    road_mask = (road * 255).astype(np.uint8)
+    return keypoint_mask, road_mask
+
+
+def extract_graph_points_baseline(keypoint_mask, road_mask, config):
+    # extract_graph_points without the peak stage and with the per-point NMS.
+    kp_candidates, kp_scores = graph_extraction.get_points_and_scores_from_mask(
+        keypoint_mask, config.ITSC_THRESHOLD * 255
+    )
+    kps_0 = graph_utils.nms_points(kp_candidates, kp_scores, config.ITSC_NMS_RADIUS)
+    kp_candidates, kp_scores = graph_extraction.get_points_and_scores_from_mask(
+        road_mask, config.ROAD_THRESHOLD * 255
+    )
+    kps_1 = graph_utils.nms_points(kp_candidates, kp_scores, config.ROAD_NMS_RADIUS)
+    kp_candidates = np.concatenate([kps_0, kps_1], axis=0)
+    kp_scores = np.concatenate(
+        [np.ones((kps_0.shape[0])), np.zeros((kps_1.shape[0]))], axis=0
+    )
+    return graph_utils.nms_points(kp_candidates, kp_scores, config.ROAD_NMS_RADIUS)
+
+
+def benchmark_nms(args, config):
+    keypoint_mask, road_mask = synthetic_masks(args.size, args.num_roads)
+    threshold = config.ROAD_THRESHOLD * 255
+
+    candidates, _ = graph_extraction.get_points_and_scores_from_mask(
+        road_mask, threshold
+    )
+    (peaks, _), peak_seconds = time_call(
+        graph_extraction.get_peak_points_and_scores_from_mask,
+        road_mask,
+        threshold,
+        repeat=args.repeat,
+    )
+    print(
+        f"road candidates: {candidates.shape[0]} above threshold, "
+        f"{peaks.shape[0]} peaks ({peak_seconds:.3f}s)"
+    )
+
+    # Both NMS engines on the same candidates, with random (non-forced) scores
+    # plus a few forced points.
+    rng = np.random.default_rng(0)
+    scores = rng.uniform(0.0, 1.0, size=(peaks.shape[0],))
+    scores[rng.uniform(size=(peaks.shape[0],)) < 0.01] = 2.0
+    (_, gt_indices), seconds_0 = time_call(
+        graph_utils.nms_points,
+        peaks,
+        scores,
+        config.ROAD_NMS_RADIUS,
+        return_indices=True,
+        repeat=args.repeat,
+    )
+    (_, pd_indices), seconds_1 = time_call(
+        graph_utils.nms_points_bulk,
+        peaks,
+        scores,
+        config.ROAD_NMS_RADIUS,
+        return_indices=True,
+        repeat=args.repeat,
+    )
+    print(
+        f"nms_points: {seconds_0:.3f}s, nms_points_bulk: {seconds_1:.3f}s, "
+        f"kept {gt_indices.shape[0]}, identical: {np.array_equal(gt_indices, pd_indices)}"
+    )
+
+    # The full keypoint extraction.
+    base_kps, seconds_0 = time_call(
+        extract_graph_points_baseline, keypoint_mask, road_mask, config, repeat=1
+    )
+    kps, seconds_1 = time_call(
+        graph_extraction.extract_graph_points,
+        keypoint_mask,
+        road_mask,
+        config,
+        repeat=args.repeat,
+    )
+    print(
+        f"extract_graph_points: baseline {seconds_0:.3f}s ({base_kps.shape[0]} points), "
+        f"peaks + bulk NMS {seconds_1:.3f}s ({kps.shape[0]} points)"
+    )
+
+
+def benchmark_engines(args, config):
+    keypoint_mask, road_mask = synthetic_masks(args.size, args.num_roads)
+    engines = {
+        "astar": lambda: graph_extraction.extract_graph_astar(keypoint_mask, road_mask, config),
+        "skeleton": lambda: graph_extraction.extract_graph_skeleton(road_mask, config),
+    }
+    graphs = {}
+    for name, fn in engines.items():
+        graphs[name], seconds = time_call(fn, repeat=1 if name == "astar" else args.repeat)
+        print(f"{name}: {seconds:.3f}s")
+    print(graph_extraction.compare_graphs(graphs["astar"], graphs["skeleton"]))
+
+
+def synthetic_block_graphs(args, config, block_size=512, overlap=64):
+    # Skeleton graphs of overlapping blocks of a synthetic mask, combined
+    # into one graph with duplicated nodes and edges along the seams, like the
+    # input of merge_into_large_graph.
+    _, road_mask = synthetic_masks(args.size, args.num_roads)
+    height, width = road_mask.shape
+    graphs = []
+    for y0, x0, y1, x1 in graph_extraction.get_block_windows(
+        height, width, block_size, overlap
+    ):
+        block_graph = graph_extraction.extract_graph_skeleton(
+            road_mask[y0:y1, x0:x1], config
+        )
+        offset = np.array([y0, x0], dtype=np.float32)
+        graphs.append((block_graph.nodes + offset, block_graph.edges))
+    return graph_utils.combine_graphs(graphs)
+
+
+def remove_isolate_nodes_baseline(nodes, edges):
+    # graph_utils.remove_isolate_nodes before vectorisation.
+    node_indices = np.arange(nodes.shape[0])
+    graph = nx.Graph()
+    graph.add_nodes_from(node_indices)
+    graph.add_edges_from(edges)
+    graph.remove_nodes_from(list(nx.isolates(graph)))
+    remaining_node_indices = sorted(graph.nodes())
+    new_graph = nx.convert_node_labels_to_integers(graph)
+    return nodes[remaining_node_indices, :], list(new_graph.edges())
+
+
+def merge_nodes_baseline(nodes, edges, distance_threshold):
+    # graph_utils.merge_nodes before vectorisation.
+    node_cluster_indices = DBSCAN(eps=distance_threshold, min_samples=1).fit(nodes).labels_
+    num_clusters = len(np.unique(node_cluster_indices))
+    cluster_centers = np.zeros((num_clusters, 2), dtype=np.float32)
+    cluster_size = np.zeros((num_clusters,), dtype=np.float32)
+    for node_index, node in enumerate(nodes):
+        cluster_index = node_cluster_indices[node_index]
+        cluster_centers[cluster_index, :] += node
+        cluster_size[cluster_index] += 1
+    cluster_centers = cluster_centers / cluster_size[:, np.newaxis]
+    unique_edges = set()
+    for start, end in edges:
+        new_start = node_cluster_indices[start]
+        new_end = node_cluster_indices[end]
+        if new_start == new_end:
+            continue
+        unique_edges.add((min(new_start, new_end), max(new_start, new_end)))
+    return cluster_centers, list(unique_edges)
+
+
+def split_edges_baseline(nodes, edges, distance_threshold):
+    # graph_utils.split_edges before vectorisation, one edge at a time.
+    points = [Point(x, y) for x, y in nodes]
+    point_tree = STRtree(points)
+    edge_queue = deque()
+    for edge in edges:
+        edge_queue.appendleft(edge)
+    new_edges = list()
+    while len(edge_queue) > 0:
+        start, end = edge_queue.pop()
+        line_segment = LineString([nodes[start, :], nodes[end, :]])
+        nearby_region = line_segment.buffer(distance=distance_threshold, cap_style="flat")
+        min_dist = distance_threshold + 88.8
+        nearest_point_index = None
+        for index in point_tree.query(nearby_region).tolist():
+            if index == start or index == end:
+                continue
+            dist = line_segment.distance(points[index])
+            if dist < min_dist:
+                min_dist, nearest_point_index = dist, index
+        if nearest_point_index is None or min_dist >= distance_threshold:
+            new_edges.append((start, end))
+        else:
+            edge_queue.appendleft((start, nearest_point_index))
+            edge_queue.appendleft((nearest_point_index, end))
+    return nodes, list({(min(start, end), max(start, end)) for start, end in new_edges})
+
+
+def find_crossover_points_baseline(graph):
+    # graph_utils.find_crossover_points before vectorisation.
+    points = graph.vs["point"]
+    lines = [(points[edge.source], points[edge.target]) for edge in graph.es]
+    line_bboxes = [graph_utils.get_line_bbox(line) for line in lines]
+    line_index = rtree.index.Index()
+    for idx, bbox in enumerate(line_bboxes):
+        line_index.insert(idx, bbox)
+    crossover_points = []
+    tested_pairs = set()
+    for i, line_0 in enumerate(lines):
+        for ni in list(line_index.intersection(line_bboxes[i])):
+            pair = (min(i, ni), max(i, ni))
+            if pair in tested_pairs:
+                continue
+            itsc = graph_utils.find_intersection(line_0, lines[ni])
+            if itsc is not None:
+                crossover_points.append(itsc)
+            tested_pairs.add(pair)
+    return crossover_points
+
+
+def synthetic_sat2graph(size, num_roads, step=20, seed=0):
+    # Straight roads subdivided every step pixels, crossing each other without
+    # shared nodes, in the Sat2Graph (row, col) format.
+    rng = np.random.default_rng(seed)
+    graph = {}
+    for _ in range(num_roads):
+        start, end = rng.uniform(0, size, size=(2, 2))
+        num = max(2, int(np.linalg.norm(end - start) / step))
+        nodes = [tuple(p) for p in np.linspace(start, end, num).round().astype(int).tolist()]
+        for a, b in zip(nodes[:-1], nodes[1:]):
+            if a != b:
+                graph.setdefault(a, []).append(b)
+                graph.setdefault(b, []).append(a)
+    return graph
+
+
+def benchmark_crossover(args, config):
+    # Cityscale ground-truth graphs when they are around, synthetic otherwise.
+    graph_paths = sorted(glob.glob("./cityscale/20cities/region_*_refine_gt_graph.p"))
+    if graph_paths:
+        graphs = [graph_utils.load_sat2graph_pickle(path) for path in graph_paths]
+    else:
+        graphs = [synthetic_sat2graph(args.size, args.num_roads)]
+
+    def rc2xy(v):
+        return v[:, ::-1]
+
+    total_0, total_1, same = 0.0, 0.0, True
+    for graph in graphs:
+        g = graph_utils.igraph_from_adj_dict(graph, rc2xy)
+        gt_points, seconds_0 = time_call(find_crossover_points_baseline, g, repeat=1)
+        pd_points, seconds_1 = time_call(
+            graph_utils.find_crossover_points, g, repeat=args.repeat
+        )
+        total_0, total_1 = total_0 + seconds_0, total_1 + seconds_1
+        same = same and len(gt_points) == len(pd_points) and np.allclose(
+            np.array(sorted(gt_points)).reshape(-1, 2), np.array(sorted(pd_points)).reshape(-1, 2)
+        )
+    print(
+        f"find_crossover_points on {len(graphs)} graphs: baseline {total_0:.3f}s, "
+        f"vectorised {total_1:.3f}s, same: {same}"
+    )
+
+
+def subdivide_graph_baseline(graph, resolution):
+    # graph_utils.subdivide_graph before vectorisation.
+    new_points = [p for p in graph.vs["point"]]
+    new_edges = []
+    for edge in graph.es:
+        p0, p1 = graph.vs["point"][edge.source], graph.vs["point"][edge.target]
+        length = np.linalg.norm(p1 - p0)
+        sample_pieces = max(1, int(length / resolution))
+        samples = np.linspace(0.0, 1.0, sample_pieces + 1, endpoint=True)
+        sampled_pts = np.expand_dims(np.array(p0), axis=0) + np.expand_dims(
+            samples, axis=1
+        ) @ np.expand_dims(p1 - p0, axis=0)
+        new_point_indices = []
+        for new_pt in sampled_pts[1:-1, :]:
+            new_point_indices.append(len(new_points))
+            new_points.append(new_pt)
+        new_edges += list(
+            zip([edge.source] + new_point_indices, new_point_indices + [edge.target])
+        )
+    new_graph = ig.Graph(len(new_points), new_edges)
+    new_graph.vs["point"] = np.array(new_points)
+    return new_graph
+
+
+def get_resampled_polylines_baseline(coords, segments, num_points):
+    # graph_utils.get_resampled_polylines before vectorisation.
+    resampled_polylines = []
+    for segment in segments:
+        polyline = LineString(coords[segment])
+        dists = np.linspace(0, polyline.length, num_points)
+        resampled_polylines.append(
+            np.array([list(polyline.interpolate(d).coords)[0] for d in dists])
+        )
+    return resampled_polylines
+
+
+def get_polyline_connectivity_baseline(polylines, dist_threhsold):
+    # graph_utils.get_polyline_connectivity before the KD-tree join.
+    connected_pairs = []
+    connected_point_indices = []
+    polyline_num = len(polylines)
+    for i in range(polyline_num):
+        for j in range(i + 1, polyline_num):
+            a, b = polylines[i], polylines[j]
+            endpoint_indices = [
+                (0, 0),
+                (0, b.shape[0] - 1),
+                (a.shape[0] - 1, 0),
+                (a.shape[0] - 1, b.shape[0] - 1),
+            ]
+            for a_idx, b_idx in endpoint_indices:
+                if np.linalg.norm(a[a_idx] - b[b_idx]) < dist_threhsold:
+                    connected_pairs.append((i, j))
+                    connected_pairs.append((j, i))
+                    connected_point_indices.append((a_idx, b_idx))
+                    connected_point_indices.append((b_idx, a_idx))
+    return connected_pairs, connected_point_indices
+
+
+def edge_set(edges):
+    return {(min(src, dst), max(src, dst)) for src, dst in np.asarray(edges).tolist()}
+
+
+def benchmark_merge(args, config):
+    nodes, edges = synthetic_block_graphs(args, config)
+    print(f"block graphs: {nodes.shape[0]} nodes, {edges.shape[0]} edges")
+    # Adds isolated nodes as left behind by the extraction.
+    rng = np.random.default_rng(0)
+    nodes = np.concatenate([nodes, rng.uniform(0, args.size, size=(nodes.shape[0] // 10, 2))])
+
+    (gt_nodes, gt_edges), seconds_0 = time_call(
+        remove_isolate_nodes_baseline, nodes, edges, repeat=args.repeat
+    )
+    (pd_nodes, pd_edges), seconds_1 = time_call(
+        graph_utils.remove_isolate_nodes, nodes, edges, repeat=args.repeat
+    )
+    same = np.array_equal(gt_nodes, pd_nodes) and edge_set(gt_edges) == edge_set(pd_edges)
+    print(f"remove_isolate_nodes: baseline {seconds_0:.3f}s, vectorised {seconds_1:.3f}s, same: {same}")
+
+    merge_dist = 0.75 * config.ROAD_NMS_RADIUS
+    (gt_nodes, gt_edges), seconds_0 = time_call(
+        merge_nodes_baseline, pd_nodes, pd_edges, merge_dist, repeat=args.repeat
+    )
+    (merged_nodes, merged_edges), seconds_1 = time_call(
+        graph_utils.merge_nodes, pd_nodes, pd_edges, merge_dist, repeat=args.repeat
+    )
+    same = np.allclose(gt_nodes, merged_nodes, atol=1e-3) and edge_set(gt_edges) == edge_set(merged_edges)
+    print(
+        f"merge_nodes: baseline {seconds_0:.3f}s, vectorised {seconds_1:.3f}s, "
+        f"{merged_nodes.shape[0]} nodes, same: {same}"
+    )
+
+
+def benchmark_split(args, config):
+    nodes, edges = synthetic_block_graphs(args, config)
+    nodes, edges = graph_utils.remove_isolate_nodes(nodes, edges)
+    nodes, edges = graph_utils.merge_nodes(nodes, edges, 0.75 * config.ROAD_NMS_RADIUS)
+    print(f"merged block graphs: {nodes.shape[0]} nodes, {edges.shape[0]} edges")
+
+    split_dist = config.ITSC_NMS_RADIUS / 2
+    (_, gt_edges), seconds_0 = time_call(
+        split_edges_baseline, nodes, edges, split_dist, repeat=1
+    )
+    (_, pd_edges), seconds_1 = time_call(
+        graph_utils.split_edges, nodes, edges, split_dist, repeat=args.repeat
+    )
+    print(
+        f"split_edges: baseline {seconds_0:.3f}s, bulk {seconds_1:.3f}s, "
+        f"{pd_edges.shape[0]} edges, same: {edge_set(gt_edges) == edge_set(pd_edges)}"
+    )
+
+
+def benchmark_resample(args, config):
+    graph = synthetic_sat2graph(args.size, args.num_roads)
+
+    def rc2xy(v):
+        return v[:, ::-1]
+
+    g = graph_utils.igraph_from_adj_dict(graph, rc2xy)
+    print(f"graph: {len(g.vs)} nodes, {len(g.es)} edges")
+    gt_graph, seconds_0 = time_call(subdivide_graph_baseline, g, 4, repeat=1)
+    pd_graph, seconds_1 = time_call(graph_utils.subdivide_graph, g, 4, repeat=args.repeat)
+    same = np.array_equal(
+        np.array(gt_graph.vs["point"]), np.array(pd_graph.vs["point"])
+    ) and gt_graph.get_edgelist() == pd_graph.get_edgelist()
+    print(f"subdivide_graph: baseline {seconds_0:.3f}s, vectorised {seconds_1:.3f}s, identical: {same}")
+
+    coords = np.array(g.vs["point"])
+    edges = np.array(g.get_edgelist())
+    adj_table = graph_utils.edge_list_to_adj_table(np.concatenate([edges, edges[:, ::-1]]))
+    segments = graph_utils.find_segments_in_road_graph(adj_table)
+    gt_polylines, seconds_0 = time_call(
+        get_resampled_polylines_baseline, coords, segments, 16, repeat=1
+    )
+    pd_polylines, seconds_1 = time_call(
+        graph_utils.get_resampled_polylines, coords, segments, 16, repeat=args.repeat
+    )
+    same = all(np.array_equal(a, b) for a, b in zip(gt_polylines, pd_polylines))
+    print(
+        f"get_resampled_polylines ({len(segments)} polylines): baseline {seconds_0:.3f}s, "
+        f"vectorised {seconds_1:.3f}s, identical: {same}"
+    )
+
+
+def benchmark_connectivity(args, config):
+    # Short polylines whose endpoints fall on a grid, so that endpoints meet
+    # about as often as at road junctions. The density stays constant.
+    rng = np.random.default_rng(0)
+    for polyline_num in [500, 1000, 2000, 4000, 100000]:
+        extent = np.sqrt(polyline_num) * 8
+        polylines = [
+            np.round(rng.uniform(0, extent, size=(rng.integers(2, 8), 2)) / 4) * 4
+            for _ in range(polyline_num)
+        ]
+        result, seconds_1 = time_call(
+            graph_utils.get_polyline_connectivity, polylines, 2.0, repeat=args.repeat
+        )
+        if polyline_num <= 4000:
+            gt, seconds_0 = time_call(
+                get_polyline_connectivity_baseline, polylines, 2.0, repeat=1
+            )
+            baseline = f"baseline {seconds_0:.3f}s, identical: {gt == result}, "
+        else:
+            baseline = ""
+        print(
+            f"{polyline_num} polylines, {len(result[0])} pairs: {baseline}"
+            f"kd-tree {seconds_1:.3f}s"
+        )
+
+
+def pixels_to_lonlat_baseline(rows, cols, transform, crs):
+    # Projects one pixel centre at a time.
+    transformer = Transformer.from_crs(crs, "EPSG:4326", always_xy=True)
+    lonlat = []
+    for row, col in zip(rows.tolist(), cols.tolist()):
+        x_proj, y_proj = transform * (col + 0.5, row + 0.5)
+        lonlat.append(transformer.transform(x_proj, y_proj))
+    return np.array(lonlat)
+
+
+def benchmark_project(args, config):
+    geo_transform = import_backend_util("geo_transform")
+    transform = Affine(10.0, 0.0, 500000.0, 0.0, -10.0, 4000000.0)
+    crs = "EPSG:32630"
+    rng = np.random.default_rng(0)
+    for point_num in [1000, 10000, 100000, 1000000]:
+        rows, cols = rng.uniform(0, 8192, size=(2, point_num))
+        lonlat, seconds_1 = time_call(
+            geo_transform.pixels_to_lonlat, rows, cols, transform, crs, repeat=args.repeat
+        )
+        if point_num <= 100000:
+            gt, seconds_0 = time_call(pixels_to_lonlat_baseline, rows, cols, transform, crs, repeat=1)
+            baseline = f"per point {seconds_0:.3f}s, identical: {np.array_equal(gt, lonlat)}, "
+        else:
+            baseline = ""
+        print(f"{point_num} points: {baseline}vectorised {seconds_1:.4f}s")
+
+
+def find_damaged_roads_union(pre_geojson, post_geojson, osm_geojson):
+    # Buffers the union of all OSM and post-event lines by 0.0001 degrees and
+    # tests each pre-event line against them.
+    post_lines = [shape(f["geometry"]) for f in post_geojson["features"]]
+    osm_lines = [shape(f["geometry"]) for f in osm_geojson["features"]]
+    post_union = unary_union(post_lines).buffer(0.0001) if post_lines else None
+    osm_union = unary_union(osm_lines).buffer(0.0001)
+    damaged = []
+    for feature in pre_geojson["features"]:
+        pre_line = shape(feature["geometry"])
+        if pre_line.intersects(osm_union) and not (post_union and pre_line.intersects(post_union)):
+            damaged.append(feature)
+    return {"type": "FeatureCollection", "features": damaged}
+
+
+def random_roads(rng, road_num, extent, jitter=0.0):
+    # Short five-vertex GeoJSON roads scattered over extent degrees.
+    starts = rng.uniform(0, extent, size=(road_num, 2))
+    ends = starts + rng.normal(0, 0.002, size=(road_num, 2))
+    features = []
+    for start, end in zip(starts, ends):
+        coords = np.linspace(start, end, 5) + rng.normal(0, jitter, size=(5, 2))
+        features.append(
+            {
+                "type": "Feature",
+                "geometry": {"type": "LineString", "coordinates": (coords + [30.0, 40.0]).tolist()},
+                "properties": {},
+            }
+        )
+    return {"type": "FeatureCollection", "features": features}
+
+
+def benchmark_damage(args, config):
+    damage_analysis = import_backend_util("damage_analysis")
+    rng = np.random.default_rng(0)
+    for road_num in [1000, 10000, 100000]:
+        extent = 0.0005 * np.sqrt(road_num)
+        osm = random_roads(rng, road_num, extent)
+        pre = {"type": "FeatureCollection", "features": osm["features"][: road_num // 2]}
+        pre["features"] += random_roads(rng, road_num // 2, extent)["features"]
+        post = {"type": "FeatureCollection", "features": osm["features"][::3]}
+        damaged, seconds_1 = time_call(
+            damage_analysis.find_damaged_roads, pre, post, osm, repeat=args.repeat
+        )
+        # The union takes over a minute already at 1000 roads.
+        if road_num <= 1000:
+            gt, seconds_0 = time_call(find_damaged_roads_union, pre, post, osm, repeat=1)
+            baseline = f"union {seconds_0:.3f}s ({len(gt['features'])} damaged), "
+        else:
+            baseline = ""
+        print(f"{road_num} roads, {len(damaged['features'])} damaged: {baseline}strtree {seconds_1:.3f}s")
+
+
+BENCHMARKS = {
+    "connectivity": benchmark_connectivity,
+    "crossover": benchmark_crossover,
+    "damage": benchmark_damage,
+    "engines": benchmark_engines,
+    "merge": benchmark_merge,
+    "nms": benchmark_nms,
+    "project": benchmark_project,
+    "resample": benchmark_resample,
+    "split": benchmark_split,
+}
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument("--config", default=DEFAULT_CONFIG_PATH, help="model config.")
+    parser.add_argument("--size", type=int, default=2048, help="synthetic mask size.")
+    parser.add_argument("--num_roads", type=int, default=40)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](args, load_config(args.config))
@@ -1,10 +1,13 @@
 import numpy as np
 import cv2
 import tcod
+import scipy
+import shapely
 from sklearn.neighbors import KDTree
 from skimage.draw import line
-import networkx as nx
-from graph_utils import nms_points
+from skimage.morphology import skeletonize
+from concurrent.futures import ProcessPoolExecutor
+from graph_utils import nms_points_bulk, combine_graphs, merge_into_large_graph, RoadGraph
 
 
 IMAGE_SIZE = 2048
@@ -19,9 +22,27 @@ def read_rgb_img(path):
 
 # returns (x, y)
 def get_points_and_scores_from_mask(mask, threshold):
-    rcs = np.column_stack(np.where(mask > threshold))
-    xys = rcs[:, ::-1]
-    scores = mask[mask > threshold]
+    rows, cols = np.nonzero(mask > threshold)
+    xys = np.column_stack((cols, rows))
+    scores = mask[rows, cols]
+    return xys, scores
+
+
+# returns (x, y)
+def get_peak_points_and_scores_from_mask(mask, threshold, window=3):
+    # Like get_points_and_scores_from_mask, but only keeps pixels that are the
+    # maximum of their window x window neighbourhood, so NMS only sees ridge
+    # and peak pixels instead of every above-threshold pixel.
+    # Saturated plateaus have no single maximum. Ties are broken by the
+    # (normalized, < 1) distance to the thresholded region border, which peaks
+    # along the centerline of the plateau.
+    above = (mask > threshold).astype(np.uint8)
+    dist = cv2.distanceTransform(above, cv2.DIST_L2, 3)
+    ridge = mask.astype(np.float32) + dist / (np.max(dist) + 1.0)
+    local_max = cv2.dilate(ridge, np.ones((window, window), dtype=np.uint8))
+    rows, cols = np.nonzero((ridge >= local_max) & (above > 0))
+    xys = np.column_stack((cols, rows))
+    scores = mask[rows, cols]
     return xys, scores
 
 
@@ -125,20 +146,22 @@ def create_cost_field_astar(sample_pts, road_mask, block_threshold=200):
 
 
 def extract_graph_points(keypoint_mask, road_mask, config):
-    kp_candidates, kp_scores = get_points_and_scores_from_mask(
-        keypoint_mask, config.ITSC_THRESHOLD * 255
+    # window 1 disables the peak stage and keeps every above-threshold pixel
+    peak_window = config.get("KEYPOINT_PEAK_WINDOW", 3)
+    kp_candidates, kp_scores = get_peak_points_and_scores_from_mask(
+        keypoint_mask, config.ITSC_THRESHOLD * 255, peak_window
     )
-    kps_0 = nms_points(kp_candidates, kp_scores, config.ITSC_NMS_RADIUS)
-    kp_candidates, kp_scores = get_points_and_scores_from_mask(
-        road_mask, config.ROAD_THRESHOLD * 255
+    kps_0 = nms_points_bulk(kp_candidates, kp_scores, config.ITSC_NMS_RADIUS)
+    kp_candidates, kp_scores = get_peak_points_and_scores_from_mask(
+        road_mask, config.ROAD_THRESHOLD * 255, peak_window
     )
-    kps_1 = nms_points(kp_candidates, kp_scores, config.ROAD_NMS_RADIUS)
+    kps_1 = nms_points_bulk(kp_candidates, kp_scores, config.ROAD_NMS_RADIUS)
     # prioritize intersection points
     kp_candidates = np.concatenate([kps_0, kps_1], axis=0)
     kp_scores = np.concatenate(
         [np.ones((kps_0.shape[0])), np.zeros((kps_1.shape[0]))], axis=0
     )
-    kps = nms_points(kp_candidates, kp_scores, config.ROAD_NMS_RADIUS)
+    kps = nms_points_bulk(kp_candidates, kp_scores, config.ROAD_NMS_RADIUS)
     return kps
 
 
@@ -151,9 +174,9 @@ def extract_graph_astar(keypoint_mask, road_mask, config):
     pathfinder = tcod.path.AStar(cost_field)
 
     tree = KDTree(kps)
-    graph = nx.Graph()
+    edges = []
     checked = set()
-    for p in kps:
+    for p_idx, p in enumerate(kps):
         neighbor_indices = tree.query_radius(
             p[np.newaxis, :], r=config.NEIGHBOR_RADIUS
         )[0]
@@ -165,28 +188,408 @@ def extract_graph_astar(keypoint_mask, road_mask, config):
             if is_connected_astar(
                 pathfinder, cost_field, p, n, max_path_len=config.NEIGHBOR_RADIUS
             ):
-                graph.add_edge(start, end)
+                edges.append((p_idx, n_idx))
             checked.add((start, end))
-    return graph
-
+    return RoadGraph.from_xy(kps, edges)
+
+
+def get_block_windows(height, width, block_size, overlap):
+    # Splits an image into the fewest overlapping blocks no larger than
+    # block_size x block_size. Blocks are evenly sized so that no block only
+    # re-covers its neighbour.
+    # Returns:
+    # list of (y0, x0, y1, x1) windows.
+    def positions(length):
+        if length <= block_size:
+            return [(0, length)]
+        num = int(np.ceil((length - overlap) / max(1, block_size - overlap)))
+        size = int(np.ceil((length + (num - 1) * overlap) / num))
+        starts = [min(i * (size - overlap), length - size) for i in range(num)]
+        return [(start, start + size) for start in starts]
+
+    windows = []
+    for y0, y1 in positions(height):
+        for x0, x1 in positions(width):
+            windows.append((y0, x0, y1, x1))
+    return windows
+
+
+def get_block_core(window, height, width, overlap):
+    # The core of a block is the block minus half of the overlap on every side
+    # that borders another block. Cores of neighbouring blocks cover the image
+    # without gaps.
+    y0, x0, y1, x1 = window
+    margin = overlap // 2
+    core_y0 = y0 + margin if y0 > 0 else 0
+    core_x0 = x0 + margin if x0 > 0 else 0
+    core_y1 = y1 - margin if y1 < height else height
+    core_x1 = x1 - margin if x1 < width else width
+    return core_y0, core_x0, core_y1, core_x1
+
+
+def _extract_block_graph(keypoint_block, road_block, config, window, core):
+    # Runs A* extraction on one block. Returns (nodes, edges) with nodes in
+    # full-image xy coords. Only edges with at least one endpoint inside the
+    # block core are kept, so each seam is covered by the blocks on both sides
+    # and the duplicates are merged afterwards.
+    road_graph = extract_graph_astar(keypoint_block, road_block, config)
+    y0, x0, _, _ = window
+    nodes = road_graph.nodes[:, ::-1] + np.array([x0, y0], dtype=np.float32)
+    edges = road_graph.edges.astype(np.int64)
+
+    core_y0, core_x0, core_y1, core_x1 = core
+    in_core = (
+        (nodes[:, 0] >= core_x0)
+        & (nodes[:, 0] < core_x1)
+        & (nodes[:, 1] >= core_y0)
+        & (nodes[:, 1] < core_y1)
+    )
+    edges = edges[np.any(in_core[edges], axis=1)]
+    return nodes, edges
+
+
+def extract_graph_astar_partitioned(keypoint_mask, road_mask, config):
+    # Splits the masks into overlapping blocks, runs extract_graph_astar on each
+    # block in a process pool and stitches the block graphs back together.
+    # The overlap shall be at least 2 * NEIGHBOR_RADIUS so that every edge
+    # crossing a seam is fully contained in one of the blocks.
+    block_size = config.get("EXTRACTION_BLOCK_SIZE", 1024)
+    overlap = config.get("EXTRACTION_BLOCK_OVERLAP", 2 * config.NEIGHBOR_RADIUS)
+    num_workers = config.get("EXTRACTION_WORKERS", 1) or None
+
+    height, width = road_mask.shape[:2]
+    windows = get_block_windows(height, width, block_size, overlap)
+    if len(windows) == 1:
+        return extract_graph_astar(keypoint_mask, road_mask, config)
+
+    keypoint_blocks, road_blocks, cores = [], [], []
+    for window in windows:
+        y0, x0, y1, x1 = window
+        keypoint_blocks.append(keypoint_mask[y0:y1, x0:x1])
+        road_blocks.append(road_mask[y0:y1, x0:x1])
+        cores.append(get_block_core(window, height, width, overlap))
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        block_graphs = list(
+            executor.map(
+                _extract_block_graph,
+                keypoint_blocks,
+                road_blocks,
+                [config] * len(windows),
+                windows,
+                cores,
+            )
+        )
 
-# takes xys
+    nodes, edges = combine_graphs(block_graphs)
+    if edges.shape[0] == 0:
+        return RoadGraph()
+
+    # Stitches the seams: duplicated keypoints from overlapping blocks are
+    # merged, and edges passing right by another node are split at it.
+    nodes, edges = merge_into_large_graph(
+        nodes,
+        edges,
+        merge_node_dist_thresh=config.get(
+            "EXTRACTION_MERGE_NODE_DIST", 0.75 * config.ROAD_NMS_RADIUS
+        ),
+        split_edge_dist_thresh=config.get(
+            "EXTRACTION_SPLIT_EDGE_DIST", config.ITSC_NMS_RADIUS / 2
+        ),
+    )
+    return RoadGraph.from_xy(nodes, edges)
+
+
+def get_topo_pairs(points, radius, max_neighbors):
+    # Candidate pairs for TopoNet: each point is paired with up to max_neighbors
+    # nearest other points within radius.
+    # points: [N_points, 2]
+    # Returns:
+    # pairs: [N_points, max_neighbors, 2] (src_idx, tgt_idx), padded with (src, src).
+    # valid: [N_points, max_neighbors], valid pairs come first in each row.
+    point_num = points.shape[0]
+    tree = scipy.spatial.KDTree(points)
+    # k+1 because the nearest one is always self
+    _, knn_idx = tree.query(
+        points, k=max_neighbors + 1, distance_upper_bound=radius
+    )
+    knn_idx = knn_idx[:, 1:]
+    valid = knn_idx < point_num
+    src_idx = np.repeat(np.arange(point_num)[:, np.newaxis], max_neighbors, axis=1)
+    tgt_idx = np.where(valid, knn_idx, src_idx)
+    pairs = np.stack([src_idx, tgt_idx], axis=-1)
+    return pairs, valid
+
+
+def extract_graph_toponet(
+    keypoint_mask, road_mask, tile_features, tile_origins, topo_scorer, config
+):
+    # Keypoints come from the fused masks as for A*, but connectivity is
+    # predicted by TopoNet from the image embeddings of the inference tiles.
+    # Every pair of keypoints within NEIGHBOR_RADIUS is scored in each tile
+    # that contains both points, and the averaged score is thresholded.
+    # tile_features: list of [D, h, w] image embeddings, one per tile.
+    # tile_origins: list of (x, y) tile corners in mask pixels.
+    # topo_scorer: callable(features [B, D, h, w], points [B, N, 2],
+    # pairs [B, N, K, 2], valid [B, N, K]) -> scores [B, N, K'], K' <= K.
+    kps = extract_graph_points(keypoint_mask, road_mask, config)
+    if kps.shape[0] < 2 or len(tile_features) == 0:
+        return RoadGraph()
+
+    tile_size = config.PATCH_SIZE
+    batch_size = config.INFER_BATCH_SIZE
+    max_neighbors = config.MAX_NEIGHBOR_QUERIES
+    all_src, all_tgt, all_scores = [], [], []
+    for batch_start in range(0, len(tile_features), batch_size):
+        batch_end = min(batch_start + batch_size, len(tile_features))
+        batch_point_indices = []
+        for x0, y0 in tile_origins[batch_start:batch_end]:
+            in_tile = (
+                (kps[:, 0] >= x0)
+                & (kps[:, 0] < x0 + tile_size)
+                & (kps[:, 1] >= y0)
+                & (kps[:, 1] < y0 + tile_size)
+            )
+            batch_point_indices.append(np.nonzero(in_tile)[0])
+        max_point_num = max(indices.shape[0] for indices in batch_point_indices)
+        if max_point_num < 2:
+            continue
+
+        # Pads every tile to the same number of points.
+        tile_num = batch_end - batch_start
+        points = np.zeros((tile_num, max_point_num, 2), dtype=np.float32)
+        pairs = np.zeros((tile_num, max_point_num, max_neighbors, 2), dtype=np.int64)
+        valid = np.zeros((tile_num, max_point_num, max_neighbors), dtype=bool)
+        for i, indices in enumerate(batch_point_indices):
+            point_num = indices.shape[0]
+            if point_num < 2:
+                continue
+            x0, y0 = tile_origins[batch_start + i]
+            points[i, :point_num] = kps[indices] - np.array([x0, y0])
+            pairs[i, :point_num], valid[i, :point_num] = get_topo_pairs(
+                points[i, :point_num], config.NEIGHBOR_RADIUS, max_neighbors
+            )
+        if not np.any(valid):
+            continue
+
+        features = np.stack(tile_features[batch_start:batch_end], axis=0)
+        scores = topo_scorer(features, points, pairs, valid)
+        # TopoNet may drop trailing all-padding pairs
+        pair_num = scores.shape[-1]
+        pairs, valid = pairs[..., :pair_num, :], valid[..., :pair_num]
+        for i, indices in enumerate(batch_point_indices):
+            tile_valid = valid[i, : indices.shape[0]]
+            tile_pairs = pairs[i, : indices.shape[0]][tile_valid]
+            all_src.append(indices[tile_pairs[:, 0]])
+            all_tgt.append(indices[tile_pairs[:, 1]])
+            all_scores.append(scores[i, : indices.shape[0]][tile_valid])
+
+    if len(all_scores) == 0:
+        return RoadGraph()
+
+    # Averages all scores of each undirected pair, from both directions and
+    # all tiles.
+    src, tgt = np.concatenate(all_src), np.concatenate(all_tgt)
+    undirected = np.stack([np.minimum(src, tgt), np.maximum(src, tgt)], axis=1)
+    unique_pairs, inverse = np.unique(undirected, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    score_sum = np.bincount(inverse, weights=np.concatenate(all_scores))
+    score_count = np.bincount(inverse)
+    connected = score_sum / score_count > config.TOPO_THRESHOLD
+    return RoadGraph.from_xy(kps, unique_pairs[connected])
+
+
+def get_skeleton_pixel_graph(skeleton):
+    # Connects 8-neighbouring skeleton pixels. Diagonal links are dropped where
+    # the two pixels are already connected through a shared 4-neighbour, so
+    # staircase corners don't show up as junctions.
+    # Returns:
+    # rows, cols: [N_pixel, ] skeleton pixel coords, in raster order.
+    # links: [N_link, 2] pixel index pairs.
+    rows, cols = np.nonzero(skeleton)
+    pixel_num = rows.shape[0]
+    # pads by one pixel so that offsets never wrap around a row
+    width = skeleton.shape[1] + 2
+    linear = (rows + 1) * width + (cols + 1)
+
+    def lookup(dr, dc):
+        target = linear + dr * width + dc
+        pos = np.minimum(np.searchsorted(linear, target), pixel_num - 1)
+        return linear[pos] == target, pos
+
+    found = {offset: lookup(*offset) for offset in [(0, 1), (1, 0), (1, 1), (1, -1), (0, -1)]}
+    keep = {
+        (0, 1): found[(0, 1)][0],
+        (1, 0): found[(1, 0)][0],
+        (1, 1): found[(1, 1)][0] & ~found[(0, 1)][0] & ~found[(1, 0)][0],
+        (1, -1): found[(1, -1)][0] & ~found[(0, -1)][0] & ~found[(1, 0)][0],
+    }
+    pixel_indices = np.arange(pixel_num)
+    links = [
+        np.stack([pixel_indices[mask], found[offset][1][mask]], axis=1)
+        for offset, mask in keep.items()
+    ]
+    return rows, cols, np.concatenate(links, axis=0)
+
+
+def extract_graph_skeleton(road_mask, config):
+    # Fast extraction for coarse imagery: thins the thresholded road mask to a
+    # one-pixel skeleton and traces it with array operations only.
+    # Skeleton pixels with degree != 2 are nodes (touching ones are merged into
+    # one node at their centroid), runs of degree-2 pixels between two nodes
+    # become polylines, which are simplified with Douglas-Peucker.
+    # Dangling runs and loops shorter than SKELETON_MIN_SPUR_LENGTH pixels are
+    # dropped.
+    skeleton = skeletonize(road_mask > config.ROAD_THRESHOLD * 255)
+    if np.count_nonzero(skeleton) < 2:
+        return RoadGraph()
+    rows, cols, links = get_skeleton_pixel_graph(skeleton)
+    pixel_num = rows.shape[0]
+    pixel_xy = np.stack([cols, rows], axis=1).astype(np.float64)
+    degree = np.bincount(links.ravel(), minlength=pixel_num)
+    is_node = degree != 2
+
+    def components(link_mask):
+        adj = scipy.sparse.coo_matrix(
+            (np.ones(np.count_nonzero(link_mask)), (links[link_mask, 0], links[link_mask, 1])),
+            shape=(pixel_num, pixel_num),
+        )
+        return scipy.sparse.csgraph.connected_components(adj, directed=False)[1]
+
+    # Node clusters
+    node_link = is_node[links[:, 0]] & is_node[links[:, 1]]
+    node_pixels = np.nonzero(is_node)[0]
+    _, cluster_of_node = np.unique(components(node_link)[node_pixels], return_inverse=True)
+    cluster = np.full((pixel_num,), -1, dtype=np.int64)
+    cluster[node_pixels] = cluster_of_node.reshape(-1)
+    cluster_num = int(cluster.max()) + 1
+    cluster_size = np.bincount(cluster[node_pixels], minlength=cluster_num)
+    cluster_xy = np.stack(
+        [
+            np.bincount(cluster[node_pixels], weights=pixel_xy[node_pixels, i], minlength=cluster_num)
+            for i in range(2)
+        ],
+        axis=1,
+    ) / np.maximum(cluster_size, 1)[:, np.newaxis]
+    is_tip = np.zeros((cluster_num,), dtype=bool)
+    is_tip[cluster[node_pixels[degree[node_pixels] == 1]]] = True
+    is_tip &= cluster_size == 1
+
+    # Chains of degree-2 pixels and the node clusters at their ends
+    chain_link = ~is_node[links[:, 0]] & ~is_node[links[:, 1]]
+    chain = components(chain_link)
+    attach_link = is_node[links[:, 0]] != is_node[links[:, 1]]
+    attach_chain_pixel = np.where(is_node[links[:, 0]], links[:, 1], links[:, 0])[attach_link]
+    attach_cluster = np.where(is_node[links[:, 0]], cluster[links[:, 0]], cluster[links[:, 1]])[attach_link]
+    attachments = np.unique(
+        np.stack([chain[attach_chain_pixel], attach_chain_pixel, attach_cluster], axis=1), axis=0
+    )
+    chain_pixels = np.nonzero(~is_node)[0]
+    chain_ids = np.unique(chain[chain_pixels])
+    attach_count = np.bincount(attachments[:, 0], minlength=pixel_num)
+    # open chains have one node at each end, loops have none
+    first_attachment = np.searchsorted(attachments[:, 0], chain_ids)
+    is_open = attach_count[chain_ids] == 2
+    is_loop = attach_count[chain_ids] == 0
+    open_ids = chain_ids[is_open]
+    start_cluster = attachments[first_attachment[is_open], 2]
+    end_cluster = attachments[first_attachment[is_open] + 1, 2]
+    chain_length = np.bincount(chain[chain_pixels], minlength=pixel_num)
+    min_spur_length = config.get("SKELETON_MIN_SPUR_LENGTH", config.ROAD_NMS_RADIUS)
+    is_spur = (is_tip[start_cluster] | is_tip[end_cluster]) & (
+        chain_length[open_ids] < min_spur_length
+    )
+    open_ids, start_cluster, end_cluster = open_ids[~is_spur], start_cluster[~is_spur], end_cluster[~is_spur]
+    start_pixel = attachments[first_attachment[is_open][~is_spur], 1]
+    # small loops are holes in the mask rather than roundabouts
+    loop_ids = chain_ids[is_loop]
+    loop_ids = loop_ids[chain_length[loop_ids] >= min_spur_length]
+    loop_start_pixel = np.full((pixel_num,), pixel_num, dtype=np.int64)
+    np.minimum.at(loop_start_pixel, chain[chain_pixels], chain_pixels)
+    loop_start_pixel = loop_start_pixel[loop_ids]
+
+    # Orders the pixels of all chains with one depth-first walk from a virtual
+    # root linked to the first pixel of every chain.
+    root = pixel_num
+    start_pixels = np.concatenate([start_pixel, loop_start_pixel])
+    walk_src = np.concatenate([links[chain_link, 0], np.full(start_pixels.shape, root)])
+    walk_dst = np.concatenate([links[chain_link, 1], start_pixels])
+    walk = scipy.sparse.coo_matrix(
+        (np.ones(walk_src.shape[0]), (walk_src, walk_dst)), shape=(pixel_num + 1, pixel_num + 1)
+    ).tocsr()
+    ordered = scipy.sparse.csgraph.depth_first_order(
+        walk, root, directed=False, return_predecessors=False
+    )[1:]
+    segment_ids = np.concatenate([open_ids, loop_ids])
+    segment_of_chain = np.full((pixel_num,), -1, dtype=np.int64)
+    segment_of_chain[segment_ids] = np.arange(segment_ids.shape[0])
+    ordered_segment = segment_of_chain[chain[ordered]]
+    order = np.argsort(ordered_segment, kind="stable")
+    ordered, ordered_segment = ordered[order], ordered_segment[order]
+
+    # Polylines: start node, chain pixels, end node (loops close on their first pixel)
+    segment_num = segment_ids.shape[0]
+    if segment_num == 0:
+        return RoadGraph()
+    open_num = open_ids.shape[0]
+    pixel_count = np.bincount(ordered_segment, minlength=segment_num)
+    head_count = np.where(np.arange(segment_num) < open_num, 1, 0)
+    coord_count = head_count + pixel_count + 1
+    coord_offset = np.concatenate([[0], np.cumsum(coord_count)[:-1]])
+    coords = np.zeros((int(coord_count.sum()), 2), dtype=np.float64)
+    rank_in_segment = np.arange(ordered.shape[0]) - np.repeat(
+        np.concatenate([[0], np.cumsum(pixel_count)[:-1]]), pixel_count
+    )
+    coords[coord_offset[ordered_segment] + head_count[ordered_segment] + rank_in_segment] = pixel_xy[ordered]
+    coords[coord_offset[:open_num]] = cluster_xy[start_cluster]
+    tail = coord_offset + coord_count - 1
+    coords[tail[:open_num]] = cluster_xy[end_cluster]
+    coords[tail[open_num:]] = pixel_xy[loop_start_pixel]
+    lines = shapely.linestrings(coords, indices=np.repeat(np.arange(segment_num), coord_count))
+    lines = shapely.simplify(lines, config.get("SKELETON_SIMPLIFY_TOLERANCE", 2.0))
+    coords, line_index = shapely.get_coordinates(lines, return_index=True)
+
+    # Polyline vertices become graph nodes: ends map to their node cluster,
+    # loop ends to one new node, interior vertices to new nodes.
+    is_first = np.concatenate([[True], line_index[1:] != line_index[:-1]])
+    is_last = np.concatenate([line_index[1:] != line_index[:-1], [True]])
+    node_ids = cluster_num + np.arange(coords.shape[0])
+    is_open_line = line_index < open_num
+    node_ids[is_first & is_open_line] = start_cluster[line_index[is_first & is_open_line]]
+    node_ids[is_last & is_open_line] = end_cluster[line_index[is_last & is_open_line]]
+    node_ids[is_last & ~is_open_line] = node_ids[np.nonzero(is_first & ~is_open_line)[0]]
+    node_xy = np.concatenate([cluster_xy, coords], axis=0)
+    same_line = ~is_last[:-1]
+    edges = np.stack([node_ids[:-1][same_line], node_ids[1:][same_line]], axis=1)
+    return RoadGraph.from_xy(node_xy, edges)
+
+
+def compare_graphs(graph_a, graph_b):
+    # Topology comparison of two RoadGraphs extracted from the same image.
+    # Edges are matched by their endpoint coordinates.
+    def edge_set(road_graph):
+        ends = road_graph.nodes[road_graph.edges].reshape(-1, 4).tolist()
+        return {tuple(sorted([tuple(end[:2]), tuple(end[2:])])) for end in ends}
+
+    edges_a, edges_b = edge_set(graph_a), edge_set(graph_b)
+    all_edges = edges_a | edges_b
+    return {
+        "nodes": [graph_a.node_num, graph_b.node_num],
+        "edges": [len(edges_a), len(edges_b)],
+        "components": [graph_a.num_components(), graph_b.num_components()],
+        "shared_edges": len(edges_a & edges_b),
+        "edge_jaccard": len(edges_a & edges_b) / len(all_edges) if all_edges else 1.0,
+    }
+
+
+# takes a RoadGraph in (row, col)
 def visualize_image_and_graph(img, graph):
+    xys = graph.nodes[:, ::-1].astype(np.int32)
     # Draw nodes as green squares
-    for node in graph.nodes():
-        x, y = node
-        cv2.rectangle(
-            img, (int(x) - 2, int(y) - 2), (int(x) + 2, int(y) + 2), (0, 255, 0), -1
-        )
+    for x, y in xys.tolist():
+        cv2.rectangle(img, (x - 2, y - 2), (x + 2, y + 2), (0, 255, 0), -1)
     # Draw edges as white lines
-    for start_node, end_node in graph.edges():
-        cv2.line(
-            img,
-            (int(start_node[0]), int(start_node[1])),
-            (int(end_node[0]), int(end_node[1])),
-            (255, 255, 255),
-            1,
-        )
+    cv2.polylines(img, xys[graph.edges], False, (255, 255, 255), 1)
     return img
 
 
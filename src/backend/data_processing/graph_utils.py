@@ -7,10 +7,16 @@ from sklearn.cluster import DBSCAN
 from shapely.geometry import Point
 from shapely.strtree import STRtree
 from collections import deque
+import shapely
+import json
+import math
+import pickle
+import struct
+import tempfile
+import os
 import unittest
 
 import igraph as ig
-import rtree
 import scipy
 
 
@@ -162,28 +168,92 @@ def normalize_segments(coords, segments):
 
 def get_resampled_polylines(coords, segments, num_points):
     # Uniformly resamples each polyline defined by segments to num_points.
+    # All polylines are resampled at once, with the arithmetic of shapely's
+    # interpolate (GEOS) so that the points are the same.
     # coords: [N_node, 2] node coords.
     # segments: [list_of_segment_node_indices, ...]
     # Returns:
     # list of [num_points, 2].
-
-    resampled_polylines = []
-
-    for segment in segments:
-        polyline_coords = coords[segment]
-        polyline = LineString(polyline_coords)
-
-        # Uniform parameter values
-        dists = np.linspace(0, polyline.length, num_points)
-
-        # Resample polyline
-        resampled_polyline = np.array(
-            [list(polyline.interpolate(d).coords)[0] for d in dists]
+    if len(segments) == 0:
+        return []
+    coords = np.asarray(coords, dtype=np.float64)
+    polyline_num = len(segments)
+    point_count = np.array([len(segment) for segment in segments])
+    pts = coords[np.concatenate([np.asarray(segment) for segment in segments])]
+
+    # Segments of all polylines, flattened.
+    seg_count = point_count - 1
+    seg_start = np.concatenate([[0], np.cumsum(seg_count)[:-1]])
+    is_seg_start = np.ones((pts.shape[0],), dtype=bool)
+    is_seg_start[np.cumsum(point_count) - 1] = False
+    seg_p0_indices = np.nonzero(is_seg_start)[0]
+    p0, p1 = pts[seg_p0_indices], pts[seg_p0_indices + 1]
+    delta = p1 - p0
+    seg_len = np.sqrt(delta[:, 0] * delta[:, 0] + delta[:, 1] * delta[:, 1])
+    # Lengths are summed segment by segment within each polyline, as GEOS does,
+    # by a cumsum along zero-padded rows. Polylines are padded in groups of
+    # similar segment counts, so that one long polyline doesn't pad them all.
+    seg_end_len = np.zeros_like(seg_len)
+    group = np.ceil(np.log2(np.maximum(seg_count, 1))).astype(np.int64)
+    for g in np.unique(group):
+        members = np.nonzero(group == g)[0]
+        offsets = np.arange(seg_count[members].max())
+        valid = offsets[np.newaxis, :] < seg_count[members][:, np.newaxis]
+        flat = (seg_start[members][:, np.newaxis] + offsets[np.newaxis, :])[valid]
+        padded = np.zeros(valid.shape, dtype=np.float64)
+        padded[valid] = seg_len[flat]
+        seg_end_len[flat] = np.cumsum(padded, axis=1)[valid]
+    total_len = np.zeros((polyline_num,), dtype=np.float64)
+    has_segs = seg_count > 0
+    total_len[has_segs] = seg_end_len[seg_start[has_segs] + seg_count[has_segs] - 1]
+
+    # Uniform parameter values, as np.linspace(0, length, num_points)
+    dists = np.zeros((polyline_num, num_points), dtype=np.float64)
+    if num_points > 1:
+        dists = np.arange(num_points, dtype=np.float64)[np.newaxis, :] * (
+            total_len / (num_points - 1)
+        )[:, np.newaxis]
+        dists[:, -1] = total_len
+    dists = dists.reshape(-1)
+    query_polyline = np.repeat(np.arange(polyline_num), num_points)
+
+    # Segment of each distance: the first one ending past it, counted by
+    # merging segment ends and distances per polyline.
+    seg_polyline = np.repeat(np.arange(polyline_num), seg_count)
+    is_query = np.concatenate(
+        [np.zeros(seg_len.shape, dtype=bool), np.ones(dists.shape, dtype=bool)]
+    )
+    order = np.lexsort(
+        (
+            is_query,
+            np.concatenate([seg_end_len, dists]),
+            np.concatenate([seg_polyline, query_polyline]),
         )
-
-        resampled_polylines.append(resampled_polyline)
-
-    return resampled_polylines
+    )
+    segs_before = np.cumsum(~is_query[order])
+    query_rank = np.empty((dists.shape[0],), dtype=np.int64)
+    query_rank[order[is_query[order]] - seg_len.shape[0]] = segs_before[is_query[order]]
+    seg_in_polyline = query_rank - seg_start[query_polyline]
+
+    is_end = seg_in_polyline >= seg_count[query_polyline]
+    seg_index = seg_start[query_polyline] + np.minimum(
+        seg_in_polyline, seg_count[query_polyline] - 1
+    )
+    len_before = np.where(
+        seg_in_polyline > 0, seg_end_len[np.maximum(seg_index - 1, 0)], 0.0
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        frac = (dists - len_before) / seg_len[seg_index]
+    seg_p0, seg_p1 = p0[seg_index], p1[seg_index]
+    resampled = (seg_p1 - seg_p0) * frac[:, np.newaxis] + seg_p0
+    resampled = np.where((frac <= 0.0)[:, np.newaxis], seg_p0, resampled)
+    resampled = np.where((frac >= 1.0)[:, np.newaxis], seg_p1, resampled)
+    polyline_ends = pts[np.cumsum(point_count) - 1]
+    resampled[is_end] = polyline_ends[query_polyline[is_end]]
+    resampled[dists <= 0.0] = pts[np.cumsum(point_count) - point_count][
+        query_polyline[dists <= 0.0]
+    ]
+    return list(resampled.reshape(polyline_num, num_points, 2))
 
 
 def get_polylines_from_road_graph(coords, edges, num_points_per_segment):
@@ -204,25 +274,34 @@ def get_polyline_connectivity(polylines, dist_threhsold):
     # here.
     # connected_point_indices: [N_pairs, 2] indices of overlapping points in
     # their polylines.
-    connected_pairs = []
-    connected_point_indices = []
     polyline_num = len(polylines)
-    for i in range(polyline_num):
-        for j in range(i + 1, polyline_num):
-            a, b = polylines[i], polylines[j]
-            endpoint_indices = [
-                (0, 0),
-                (0, b.shape[0] - 1),
-                (a.shape[0] - 1, 0),
-                (a.shape[0] - 1, b.shape[0] - 1),
-            ]
-            for a_idx, b_idx in endpoint_indices:
-                if np.linalg.norm(a[a_idx] - b[b_idx]) < dist_threhsold:
-                    connected_pairs.append((i, j))
-                    connected_pairs.append((j, i))
-                    connected_point_indices.append((a_idx, b_idx))
-                    connected_point_indices.append((b_idx, a_idx))
-    return connected_pairs, connected_point_indices
+    if polyline_num < 2:
+        return [], []
+    # Endpoint 2 * i is the first point of polyline i, 2 * i + 1 its last.
+    last_indices = np.array([p.shape[0] - 1 for p in polylines])
+    endpoints = np.array(
+        [p[k] for p in polylines for k in (0, -1)], dtype=np.float64
+    ).reshape(-1, 2)
+    pairs = scipy.spatial.cKDTree(endpoints).query_pairs(
+        r=dist_threhsold, output_type="ndarray"
+    )
+    # query_pairs is inclusive and also pairs both ends of one polyline.
+    pairs = pairs[pairs[:, 0] // 2 != pairs[:, 1] // 2]
+    dists = np.linalg.norm(endpoints[pairs[:, 0]] - endpoints[pairs[:, 1]], axis=1)
+    pairs = pairs[dists < dist_threhsold]
+    # Keeps the order of the pairwise scan: by polyline pair, then endpoints.
+    src, dst = pairs.min(axis=1), pairs.max(axis=1)
+    order = np.lexsort((dst % 2, src % 2, dst // 2, src // 2))
+    src, dst = src[order], dst[order]
+    i, j = src // 2, dst // 2
+    a_idx = np.where(src % 2 == 1, last_indices[i], 0)
+    b_idx = np.where(dst % 2 == 1, last_indices[j], 0)
+    connected_pairs = np.stack([i, j, j, i], axis=1).reshape(-1, 2)
+    connected_point_indices = np.stack([a_idx, b_idx, b_idx, a_idx], axis=1).reshape(-1, 2)
+    return (
+        [tuple(p) for p in connected_pairs.tolist()],
+        [tuple(p) for p in connected_point_indices.tolist()],
+    )
 
 
 def visualize_polylines(image, polylines):
@@ -265,92 +344,157 @@ def visualize_polyline_graph(
 
 ## Utils for aggregating the large map.
 def remove_isolate_nodes(nodes, edges):
-    node_indices = np.arange(nodes.shape[0])
-    graph = nx.Graph()
-    graph.add_nodes_from(node_indices)
-    graph.add_edges_from(edges)
-
-    isolated_nodes = list(nx.isolates(graph))
-    graph.remove_nodes_from(isolated_nodes)
-
-    remaining_node_indices = list(graph.nodes())
-    remaining_node_indices.sort()
-    remaining_nodes = nodes[remaining_node_indices, :]
-
-    new_graph = nx.convert_node_labels_to_integers(graph)
-    new_edges = list(new_graph.edges())
-
-    return remaining_nodes, new_edges
+    # Drops nodes without edges and relabels the remaining ones, keeping their
+    # order. Repeated undirected edges are merged.
+    # Returns:
+    # nodes: [N_node', 2]
+    # edges: [N_edge', 2] (min_idx, max_idx) pairs, sorted.
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    degree = np.bincount(edges.ravel(), minlength=nodes.shape[0])
+    remaining_nodes, new_edges = filter_nodes(nodes, edges, degree > 0)
+    return remaining_nodes, np.unique(np.sort(new_edges, axis=1), axis=0)
 
 
 def merge_nodes(nodes, edges, distance_threshold):
-    clustering = DBSCAN(eps=distance_threshold, min_samples=1).fit(nodes)
-    node_cluster_indices = clustering.labels_
-    num_clusters = len(np.unique(node_cluster_indices))
-    cluster_centers = np.zeros((num_clusters, 2), dtype=np.float32)
-    cluster_size = np.zeros((num_clusters,), dtype=np.float32)
-    for node_index, node in enumerate(nodes):
-        cluster_index = node_cluster_indices[node_index]
-        cluster_centers[cluster_index, :] += node
-        cluster_size[cluster_index] += 1
-    cluster_centers = cluster_centers / cluster_size[:, np.newaxis]
-    unique_edges = set()
-    for start, end in edges:
-        new_start = node_cluster_indices[start]
-        new_end = node_cluster_indices[end]
-
-        # Removes self-loops
-        if new_start == new_end:
-            continue
-
-        new_edge = (min(new_start, new_end), max(new_start, new_end))
-        unique_edges.add(new_edge)
-    return cluster_centers, list(unique_edges)
+    # Merges nodes chained within distance_threshold of each other into their
+    # centre, like DBSCAN with min_samples=1. Clusters are numbered by their
+    # first node, as DBSCAN does.
+    node_num = nodes.shape[0]
+    pairs = scipy.spatial.cKDTree(nodes).query_pairs(
+        r=distance_threshold, output_type="ndarray"
+    )
+    adjacency = scipy.sparse.coo_matrix(
+        (np.ones(pairs.shape[0], dtype=np.int8), (pairs[:, 0], pairs[:, 1])),
+        shape=(node_num, node_num),
+    )
+    _, labels = scipy.sparse.csgraph.connected_components(adjacency, directed=False)
+    _, first_node, node_cluster_indices = np.unique(
+        labels, return_index=True, return_inverse=True
+    )
+    cluster_order = np.argsort(first_node)
+    cluster_rank = np.empty_like(cluster_order)
+    cluster_rank[cluster_order] = np.arange(cluster_order.shape[0])
+    node_cluster_indices = cluster_rank[node_cluster_indices.reshape(-1)]
+
+    num_clusters = cluster_order.shape[0]
+    cluster_size = np.bincount(node_cluster_indices, minlength=num_clusters)
+    cluster_centers = np.stack(
+        [
+            np.bincount(node_cluster_indices, weights=nodes[:, i], minlength=num_clusters)
+            for i in range(2)
+        ],
+        axis=1,
+    ) / cluster_size[:, np.newaxis]
+    new_edges = node_cluster_indices[np.asarray(edges, dtype=np.int64).reshape(-1, 2)]
+    return cluster_centers.astype(np.float32), dedupe_edges(new_edges)
 
 
 def split_edges(nodes, edges, distance_threshold):
-    points = [Point(x, y) for x, y in nodes]
+    # Splits every edge passing closer than distance_threshold to another node
+    # at the nearest such node, until no edge does. A node counts if it lies
+    # within the envelope of the flat-capped buffer of the edge. All pending
+    # edges are split at once in each round; ties go to the node with the
+    # smallest index.
+    # An edge always splits the same way, so each undirected edge is processed
+    # once. Edges whose splits lead back to themselves are kept unsplit.
+    # Returns the nodes unchanged and the de-duplicated edges.
+    nodes = np.asarray(nodes)
+    node_num = nodes.shape[0]
+    points = shapely.points(nodes)
     point_tree = STRtree(points)
 
-    edge_queue = deque()
-    for edge in edges:
-        edge_queue.appendleft(edge)
-
-    new_edges = list()
-
-    while len(edge_queue) > 0:
-        start, end = edge_queue.pop()
-        start_pt, end_pt = nodes[start, :], nodes[end, :]
-        line_segment = LineString([start_pt, end_pt])
-        nearby_region = line_segment.buffer(
-            distance=distance_threshold, cap_style="flat"
+    def edge_keys(edge_array):
+        return np.minimum(edge_array[:, 0], edge_array[:, 1]) * node_num + np.maximum(
+            edge_array[:, 0], edge_array[:, 1]
         )
-        nearby_point_indices = point_tree.query(nearby_region).tolist()
-        min_dist = distance_threshold + 88.8
-        nearest_point_index = None
-        for index in nearby_point_indices:
-            if index == start or index == end:
-                continue
-            point = points[index]
-            dist = line_segment.distance(point)
-            if dist < min_dist:
-                min_dist, nearest_point_index = dist, index
 
-        if nearest_point_index is None or min_dist >= distance_threshold:
-            new_edges.append((start, end))
-            continue
-        else:
-            e1, e2 = (start, nearest_point_index), (nearest_point_index, end)
-            edge_queue.appendleft(e1)
-            edge_queue.appendleft(e2)
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    processed_edges = [np.zeros((0, 2), dtype=np.int64)]
+    processed_keys = np.zeros((0,), dtype=np.int64)
+    split_parents, split_children = [], []
+
+    while edges.shape[0] > 0:
+        keys, first_edge = np.unique(edge_keys(edges), return_index=True)
+        is_new = ~np.isin(keys, processed_keys)
+        edges = edges[first_edge[is_new]]
+        if edges.shape[0] == 0:
+            break
+        processed_keys = np.concatenate([processed_keys, keys[is_new]])
+        processed_edges.append(edges)
 
-    # TODO(congrui): share the edge dedup logic
-    unique_edges = set()
-    for start, end in new_edges:
-        new_edge = (min(start, end), max(start, end))
-        unique_edges.add(new_edge)
+        start_pts, end_pts = nodes[edges[:, 0]], nodes[edges[:, 1]]
+        line_segments = shapely.linestrings(np.stack([start_pts, end_pts], axis=1))
+        edge_indices, point_indices = point_tree.query(
+            line_segments, predicate="dwithin", distance=distance_threshold
+        )
+        not_endpoint = (point_indices != edges[edge_indices, 0]) & (
+            point_indices != edges[edge_indices, 1]
+        )
+        edge_indices, point_indices = edge_indices[not_endpoint], point_indices[not_endpoint]
+
+        # Envelope of the flat-capped buffer: the segment offset by the
+        # threshold on both sides.
+        direction = end_pts - start_pts
+        length = np.linalg.norm(direction, axis=1)
+        normal = np.stack([-direction[:, 1], direction[:, 0]], axis=1) * (
+            distance_threshold / np.maximum(length, 1e-12)
+        )[:, np.newaxis]
+        corners = np.stack(
+            [start_pts + normal, start_pts - normal, end_pts + normal, end_pts - normal],
+            axis=1,
+        )
+        lower, upper = corners.min(axis=1), corners.max(axis=1)
+        candidate_pts = nodes[point_indices]
+        in_envelope = np.all(
+            (candidate_pts >= lower[edge_indices]) & (candidate_pts <= upper[edge_indices]),
+            axis=1,
+        ) & (length[edge_indices] > 0)
+        edge_indices, point_indices = edge_indices[in_envelope], point_indices[in_envelope]
+        dists = shapely.distance(line_segments[edge_indices], points[point_indices])
+        is_close = dists < distance_threshold
+        edge_indices, point_indices, dists = (
+            edge_indices[is_close],
+            point_indices[is_close],
+            dists[is_close],
+        )
 
-    return nodes, list(unique_edges)
+        # Nearest node for each edge that gets split.
+        order = np.lexsort((point_indices, dists, edge_indices))
+        edge_indices, point_indices = edge_indices[order], point_indices[order]
+        is_first = np.ones(edge_indices.shape, dtype=bool)
+        is_first[1:] = edge_indices[1:] != edge_indices[:-1]
+        split_edge_indices, split_points = edge_indices[is_first], point_indices[is_first]
+
+        split = edges[split_edge_indices]
+        edges = np.concatenate(
+            [
+                np.stack([split[:, 0], split_points], axis=1),
+                np.stack([split_points, split[:, 1]], axis=1),
+            ],
+            axis=0,
+        )
+        split_parents.append(np.tile(edge_keys(split), 2))
+        split_children.append(edge_keys(edges))
+
+    # Edges never split are kept, and so are edges on cycles of splits.
+    processed_edges = np.concatenate(processed_edges, axis=0)
+    keys = edge_keys(processed_edges)
+    key_order = np.argsort(keys)
+    parents = np.concatenate([np.zeros((0,), dtype=np.int64)] + split_parents)
+    children = np.concatenate([np.zeros((0,), dtype=np.int64)] + split_children)
+    parent_indices = key_order[np.searchsorted(keys, parents, sorter=key_order)]
+    child_indices = key_order[np.searchsorted(keys, children, sorter=key_order)]
+    is_split = np.zeros((processed_edges.shape[0],), dtype=bool)
+    is_split[parent_indices] = True
+    split_graph = scipy.sparse.coo_matrix(
+        (np.ones(parent_indices.shape[0], dtype=np.int8), (parent_indices, child_indices)),
+        shape=(processed_edges.shape[0], processed_edges.shape[0]),
+    )
+    _, cycle_labels = scipy.sparse.csgraph.connected_components(
+        split_graph, directed=True, connection="strong"
+    )
+    on_cycle = np.bincount(cycle_labels)[cycle_labels] > 1
+    return nodes, dedupe_edges(processed_edges[~is_split | on_cycle])
 
 
 def combine_graphs(graphs):
@@ -453,6 +597,274 @@ def convert_from_nx(graph):
     return np.array(nodes), np.array(edges)
 
 
+## Compact road graph
+def dedupe_edges(edges):
+    # Undirected edge de-duplication: drops self-loops and repeated edges.
+    # edges: [N_edge, 2] (src_idx, dst_idx) pairs.
+    # Returns:
+    # [N_unique_edge, 2] (min_idx, max_idx) pairs, sorted.
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    edges = np.sort(edges, axis=1)
+    edges = edges[edges[:, 0] != edges[:, 1]]
+    return np.unique(edges, axis=0)
+
+
+class RoadGraph:
+    # Undirected road graph backed by arrays, without per-node Python objects.
+    # nodes: [N_node, 2] float32 (row, col) image coordinates.
+    # edges: [N_edge, 2] int32 (src_idx, dst_idx) pairs, each edge stored once.
+    # The CSR adjacency is built on first use.
+    __slots__ = ("nodes", "edges", "_adjacency")
+
+    def __init__(self, nodes=None, edges=None):
+        if nodes is None:
+            nodes = np.zeros((0, 2))
+        if edges is None:
+            edges = np.zeros((0, 2))
+        self.nodes = np.asarray(nodes, dtype=np.float32).reshape(-1, 2)
+        self.edges = np.asarray(edges, dtype=np.int32).reshape(-1, 2)
+        self._adjacency = None
+
+    def __repr__(self):
+        return f"RoadGraph(node_num={self.node_num}, edge_num={self.edge_num})"
+
+    @property
+    def node_num(self):
+        return self.nodes.shape[0]
+
+    @property
+    def edge_num(self):
+        return self.edges.shape[0]
+
+    def adjacency(self):
+        # Symmetric [N_node, N_node] scipy CSR matrix.
+        if self._adjacency is None:
+            src = np.concatenate([self.edges[:, 0], self.edges[:, 1]])
+            dst = np.concatenate([self.edges[:, 1], self.edges[:, 0]])
+            self._adjacency = scipy.sparse.csr_matrix(
+                (np.ones(src.shape[0], dtype=np.int8), (src, dst)),
+                shape=(self.node_num, self.node_num),
+            )
+        return self._adjacency
+
+    def degrees(self):
+        return np.bincount(self.edges.ravel(), minlength=self.node_num)
+
+    def neighbors(self, node_idx):
+        adjacency = self.adjacency()
+        return adjacency.indices[adjacency.indptr[node_idx] : adjacency.indptr[node_idx + 1]]
+
+    def num_components(self):
+        if self.node_num == 0:
+            return 0
+        return scipy.sparse.csgraph.connected_components(
+            self.adjacency(), directed=False
+        )[0]
+
+    def filter_nodes(self, keep_node):
+        return RoadGraph(*filter_nodes(self.nodes, self.edges, keep_node))
+
+    def segments(self):
+        # Chains runs of degree-2 nodes into segments that cover every
+        # undirected edge exactly once.
+        # Returns: list of lists of node indices, see find_segments_in_road_graph.
+        # Isolated loops come back closed, with the first node repeated last.
+        if self.edge_num == 0:
+            return []
+        edges = self.edges.astype(np.int64)
+        adj_table = edge_list_to_adj_table(np.concatenate([edges, edges[:, ::-1]]))
+        edge_set = set(unique_edge(src, dst) for src, dst in edges.tolist() if src != dst)
+        segments = []
+        visited_edges = set()
+
+        def add_segment(segment):
+            # Drops edges already covered, splitting the segment around them.
+            run = segment[:1]
+            for node in segment[1:]:
+                edge = unique_edge(run[-1], node)
+                if edge in visited_edges or edge not in edge_set:
+                    if len(run) > 1:
+                        segments.append(run)
+                    run = [node]
+                    continue
+                visited_edges.add(edge)
+                run.append(node)
+            if len(run) > 1:
+                segments.append(run)
+
+        for segment in find_segments_in_road_graph(adj_table):
+            add_segment(segment)
+        # find_segments_in_road_graph leaves out loops without a junction or
+        # dead end on them, and the closing edge of loops that have one.
+        for edge in sorted(edge_set - visited_edges):
+            if edge in visited_edges:
+                continue
+            segment = trace_segment(edge, adj_table)
+            if len(segment) > 2 and edge[0] in adj_table[segment[-1]]:
+                segment.append(edge[0])
+            add_segment(segment)
+        return [[int(node) for node in segment] for segment in segments]
+
+    @classmethod
+    def from_xy(cls, points, edges):
+        # Builds a graph the way the extraction engines used to with networkx
+        # nodes: points are rounded to integer pixels and coincident ones are
+        # merged, self-loops and repeated edges are dropped and nodes without
+        # edges are left out. Nodes keep the order in which edges first use them.
+        # points: [N_points, 2] (x, y) coordinates.
+        # edges: [N_edge, 2] pairs of point indices.
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        int_points = np.round(np.asarray(points, dtype=np.float64)).astype(np.int64).reshape(-1, 2)
+        endpoints = int_points[edges.ravel()]
+        unique_points, first_use, node_of_endpoint = np.unique(
+            endpoints, axis=0, return_index=True, return_inverse=True
+        )
+        # np.unique sorts, this restores the order of first use
+        order = np.argsort(first_use, kind="stable")
+        rank = np.empty_like(order)
+        rank[order] = np.arange(order.shape[0])
+        edges = rank[node_of_endpoint.reshape(-1)].reshape(-1, 2)
+        edges = edges[edges[:, 0] != edges[:, 1]]
+        # undirected duplicates, keeping the first occurrence
+        _, first_edge = np.unique(np.sort(edges, axis=1), axis=0, return_index=True)
+        edges = edges[np.sort(first_edge)]
+        keep_node = np.zeros((order.shape[0],), dtype=bool)
+        keep_node[edges.ravel()] = True
+        return cls(*filter_nodes(unique_points[order][:, ::-1], edges, keep_node))
+
+    @classmethod
+    def from_nx(cls, graph):
+        # graph: nx graph with (x, y) nodes.
+        nodes, edges = convert_from_nx(graph)
+        return cls(nodes, edges)
+
+    def to_nx(self):
+        # Returns an nx graph with (x, y) nodes, including isolated ones.
+        graph = nx.Graph()
+        keys = [tuple(xy) for xy in self.nodes[:, ::-1].tolist()]
+        graph.add_nodes_from(keys)
+        graph.add_edges_from((keys[src], keys[dst]) for src, dst in self.edges.tolist())
+        return graph
+
+    @classmethod
+    def from_sat2graph(cls, graph):
+        # graph: dict in the Sat2Graph label format, see
+        # convert_from_sat2graph_format.
+        nodes, edges = convert_from_sat2graph_format(graph)
+        if len(nodes) == 0:
+            return cls()
+        return cls(nodes, dedupe_edges(edges))
+
+    def to_sat2graph(self):
+        if self.edge_num == 0:
+            return dict()
+        return convert_to_sat2graph_format(self.nodes, self.edges)
+
+
+## Road graph files
+# A .rgraph file is an 8-byte magic, a uint32 format version and a uint32
+# header length, followed by a JSON header and the raw little-endian node and
+# edge arrays. The arrays start at 64-byte aligned offsets so they can be
+# memory mapped. The header holds the array layout, the GDAL geotransform of
+# the node (row, col) pixel grid and its CRS as WKT.
+RGRAPH_MAGIC = b"RGRAPH\x00\x00"
+RGRAPH_VERSION = 1
+RGRAPH_ALIGNMENT = 64
+
+
+def _align(offset):
+    return -(-offset // RGRAPH_ALIGNMENT) * RGRAPH_ALIGNMENT
+
+
+def save_road_graph(path, road_graph, transform=None, crs=None):
+    # transform: GDAL geotransform coefficients (6 floats), or None.
+    # crs: CRS of the geotransform as a WKT string, or None.
+    arrays = {
+        "nodes": np.ascontiguousarray(road_graph.nodes, dtype="<f4"),
+        "edges": np.ascontiguousarray(road_graph.edges, dtype="<i4"),
+    }
+    layout, offset = {}, 0
+    for name, array in arrays.items():
+        layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset = _align(offset + array.nbytes)
+    header = json.dumps(
+        {
+            "node_num": road_graph.node_num,
+            "edge_num": road_graph.edge_num,
+            "transform": None if transform is None else [float(v) for v in transform],
+            "crs": None if crs is None else str(crs),
+            "arrays": layout,
+        }
+    ).encode("utf-8")
+    data_start = _align(len(RGRAPH_MAGIC) + 8 + len(header))
+    with open(path, "wb") as f:
+        f.write(RGRAPH_MAGIC)
+        f.write(struct.pack("<II", RGRAPH_VERSION, len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name]["offset"])
+            f.write(array.tobytes())
+
+
+class _Sat2GraphUnpickler(pickle.Unpickler):
+    # Sat2Graph dicts only hold tuples of ints, possibly numpy scalars. Any
+    # other global is refused so that loading a graph file can't run code.
+    allowed_globals = {
+        ("numpy", "dtype"),
+        ("numpy.core.multiarray", "scalar"),
+        ("numpy._core.multiarray", "scalar"),
+    }
+
+    def find_class(self, module, name):
+        if (module, name) not in self.allowed_globals:
+            raise pickle.UnpicklingError(f"{module}.{name} is not allowed in a graph file.")
+        return super().find_class(module, name)
+
+
+def load_sat2graph_pickle(path):
+    with open(path, "rb") as f:
+        return _Sat2GraphUnpickler(f).load()
+
+
+def load_road_graph(path, mmap=True):
+    # Loads a .rgraph file, with the arrays memory mapped unless mmap is False.
+    # Legacy .p files (pickled Sat2Graph dicts) are read too, without
+    # georeference.
+    # Returns:
+    # road_graph: RoadGraph.
+    # metadata: dict with "transform" (GDAL coefficients) and "crs" (WKT),
+    # both None when unknown.
+    if path.endswith(".p"):
+        road_graph = RoadGraph.from_sat2graph(load_sat2graph_pickle(path))
+        return road_graph, {"transform": None, "crs": None}
+
+    with open(path, "rb") as f:
+        prefix = f.read(len(RGRAPH_MAGIC) + 8)
+        if prefix[: len(RGRAPH_MAGIC)] != RGRAPH_MAGIC:
+            raise ValueError(f"Not a road graph file: {path}")
+        version, header_len = struct.unpack("<II", prefix[len(RGRAPH_MAGIC) :])
+        if version > RGRAPH_VERSION:
+            raise ValueError(f"Unsupported road graph file version {version}: {path}")
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    data_start = _align(len(RGRAPH_MAGIC) + 8 + header_len)
+
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        shape = tuple(spec["shape"])
+        offset = data_start + spec["offset"]
+        if math.prod(shape) == 0:
+            # empty arrays can't be mapped
+            arrays[name] = np.zeros(shape, dtype=spec["dtype"])
+        elif mmap:
+            arrays[name] = np.memmap(path, dtype=spec["dtype"], mode="r", offset=offset, shape=shape)
+        else:
+            arrays[name] = np.fromfile(
+                path, dtype=spec["dtype"], count=math.prod(shape), offset=offset
+            ).reshape(shape)
+    road_graph = RoadGraph(arrays["nodes"], arrays["edges"])
+    return road_graph, {"transform": header["transform"], "crs": header["crs"]}
+
+
 ### igraph utils for performance
 
 
@@ -518,63 +930,92 @@ def find_intersection(segment1, segment2):
     return None
 
 
-def find_crossover_points(graph):
+def find_crossover_points(graph, deduplicate=False):
     # takes igraph
-    # y axis shall point upwards for rtree to work properly
-    # crossover points are counted twice: A cross B, B cross A
-    # - which is fine for now just be aware
-    points = graph.vs["point"]
-    edges = graph.es
-    lines = [(points[edge.source], points[edge.target]) for edge in edges]
-    line_bboxes = [get_line_bbox(line) for line in lines]
-    line_index = rtree.index.Index()
-    for idx, bbox in enumerate(line_bboxes):
-        line_index.insert(idx, bbox)
-
-    crossover_points = []
-    tested_pairs = set()
-    for i, line_0 in enumerate(lines):
-        bbox = line_bboxes[i]
-        nearby_indices = list(line_index.intersection(bbox))
-        for ni in nearby_indices:
-            pair = (min(i, ni), max(i, ni))
-            if pair in tested_pairs:
-                continue
-            line_1 = lines[ni]
-            itsc = find_intersection(line_0, line_1)
-            if itsc is not None:
-                crossover_points.append(itsc)
-            tested_pairs.add(pair)
-
-    return crossover_points
+    # Finds where edges cross without a node: points strictly inside two
+    # edges. Touching at an endpoint and collinear overlaps don't count.
+    # Candidate pairs come from one bulk query of padded edge bboxes and are
+    # tested with orientation signs in numpy.
+    # Each crossing edge pair is reported once. With deduplicate, crossings
+    # of several edge pairs at the same point are reported once.
+    # Returns:
+    # list of (x, y) crossover points.
+    edge_array = np.array(graph.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+    if edge_array.shape[0] < 2:
+        return []
+    points = np.array(graph.vs["point"], dtype=np.float64).reshape(-1, 2)
+    starts, ends = points[edge_array[:, 0]], points[edge_array[:, 1]]
+    lower = np.minimum(starts, ends) - 1
+    upper = np.maximum(starts, ends) + 1
+    boxes = shapely.box(lower[:, 0], lower[:, 1], upper[:, 0], upper[:, 1])
+    first, second = STRtree(boxes).query(boxes)
+    is_pair = first < second
+    first, second = first[is_pair], second[is_pair]
+
+    p1, p2 = starts[first], ends[first]
+    p3, p4 = starts[second], ends[second]
+
+    def cross(u, v):
+        return u[:, 0] * v[:, 1] - u[:, 1] * v[:, 0]
+
+    d1, d2 = p2 - p1, p4 - p3
+    is_crossing = (np.sign(cross(d1, p3 - p1)) * np.sign(cross(d1, p4 - p1)) < 0) & (
+        np.sign(cross(d2, p1 - p3)) * np.sign(cross(d2, p2 - p3)) < 0
+    )
+    p1, d1, d2, p3 = p1[is_crossing], d1[is_crossing], d2[is_crossing], p3[is_crossing]
+    t = cross(p3 - p1, d2) / cross(d1, d2)
+    crossover_points = p1 + t[:, np.newaxis] * d1
+    if deduplicate:
+        _, first_index = np.unique(
+            np.round(crossover_points, 6), axis=0, return_index=True
+        )
+        crossover_points = crossover_points[np.sort(first_index)]
+    return [tuple(p) for p in crossover_points.tolist()]
 
 
 def subdivide_graph(graph, resolution):
     # takes igraph
-    new_points = [p for p in graph.vs["point"]]
-    new_edges = []
-    for edge in graph.es:
-        p0, p1 = graph.vs["point"][edge.source], graph.vs["point"][edge.target]
-        length = np.linalg.norm(p1 - p0)
-        sample_pieces = max(1, int(length / resolution))
-        # [N, ]
-        samples = np.linspace(0.0, 1.0, sample_pieces + 1, endpoint=True)
-        # [N, 2] = [1, 2] + [N, 1] @ [1, 2]
-        sampled_pts = np.expand_dims(np.array(p0), axis=0) + np.expand_dims(
-            samples, axis=1
-        ) @ np.expand_dims(p1 - p0, axis=0)
-        # [N-2, 2]
-        sampled_pts = sampled_pts[1:-1, :]
-        new_point_indices = []
-        for new_pt in sampled_pts:
-            new_point_indices.append(len(new_points))
-            new_points.append(new_pt)
-        new_edges_sources = [edge.source] + new_point_indices
-        new_edges_targets = new_point_indices + [edge.target]
-        new_edges += list(zip(new_edges_sources, new_edges_targets))
-
-    new_graph = ig.Graph(len(new_points), new_edges)
-    new_graph.vs["point"] = np.array(new_points)
+    # Splits every edge into max(1, int(length / resolution)) equal pieces.
+    # New points are appended after the existing ones, edge by edge, and
+    # computed for all edges at once with the same arithmetic as np.linspace.
+    points = np.array(graph.vs["point"])
+    edge_array = np.array(graph.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+    point_num = len(graph.vs)
+    if edge_array.shape[0] == 0:
+        new_graph = ig.Graph(point_num)
+        new_graph.vs["point"] = points
+        return new_graph
+    p0, p1 = points[edge_array[:, 0]], points[edge_array[:, 1]]
+    lengths = np.linalg.norm(p1 - p0, axis=1)
+    sample_pieces = np.maximum(1, (lengths / resolution).astype(np.int64))
+
+    # Interior samples k / pieces, k = 1 .. pieces - 1, of every edge.
+    new_point_counts = sample_pieces - 1
+    new_point_edges = np.repeat(np.arange(edge_array.shape[0]), new_point_counts)
+    new_point_starts = np.cumsum(new_point_counts) - new_point_counts
+    k = np.arange(new_point_edges.shape[0]) - new_point_starts[new_point_edges] + 1
+    samples = k * (1.0 / sample_pieces[new_point_edges])
+    new_points = (
+        p0[new_point_edges]
+        + samples[:, np.newaxis] * (p1 - p0)[new_point_edges]
+    )
+
+    # Chains source, new points, target for every edge.
+    chain_lengths = sample_pieces + 1
+    chain_starts = np.cumsum(chain_lengths) - chain_lengths
+    chains = np.empty((int(chain_lengths.sum()),), dtype=np.int64)
+    new_point_positions = chain_starts[new_point_edges] + k
+    chains[new_point_positions] = point_num + np.arange(new_point_edges.shape[0])
+    chains[chain_starts] = edge_array[:, 0]
+    chains[chain_starts + chain_lengths - 1] = edge_array[:, 1]
+    is_chain_end = np.zeros(chains.shape, dtype=bool)
+    is_chain_end[chain_starts + chain_lengths - 1] = True
+    new_edges = np.stack([chains[:-1], chains[1:]], axis=1)[~is_chain_end[:-1]]
+
+    new_graph = ig.Graph(point_num + new_points.shape[0], new_edges.tolist())
+    if new_points.shape[0] > 0:
+        points = np.concatenate([points.reshape(-1, 2), new_points], axis=0)
+    new_graph.vs["point"] = points
     return new_graph
 
 
@@ -600,6 +1041,53 @@ def nms_points(points, scores, radius, return_indices=False):
         return sorted_points[kept]
 
 
+def nms_points_bulk(points, scores, radius, return_indices=False):
+    # Same result as nms_points, but all neighbour pairs come from one bulk
+    # KD-tree query and the greedy suppression is resolved in vectorised rounds:
+    # in each round, every undecided point without an undecided higher-ranked
+    # neighbour is kept and suppresses its lower-ranked neighbours.
+    # if score > 1.0, the point is forced to be kept regardless
+    sorted_indices = np.argsort(scores)[::-1]
+    sorted_points = points[sorted_indices, :]
+    sorted_scores = scores[sorted_indices]
+    point_num = sorted_indices.shape[0]
+    # 0: undecided, 1: kept, 2: suppressed
+    state = np.zeros((point_num,), dtype=np.int8)
+
+    forced = sorted_scores > 1.0
+    state[forced] = 1
+    if np.any(forced) and not np.all(forced):
+        # forced points suppress all non-forced points within radius
+        forced_tree = scipy.spatial.KDTree(sorted_points[forced])
+        dists, _ = forced_tree.query(
+            sorted_points[~forced], distance_upper_bound=np.nextafter(radius, np.inf)
+        )
+        suppressed = np.zeros((point_num,), dtype=bool)
+        suppressed[~forced] = dists <= radius
+        state[suppressed] = 2
+
+    undecided = state == 0
+    if np.any(undecided):
+        undecided_indices = np.where(undecided)[0]
+        tree = scipy.spatial.KDTree(sorted_points[undecided_indices])
+        # (i, j) with i < j, so i always ranks higher than j
+        pairs = undecided_indices[tree.query_pairs(r=radius, output_type="ndarray")]
+        while np.any(undecided):
+            blocked = np.zeros((point_num,), dtype=bool)
+            blocked[pairs[:, 1]] = True
+            newly_kept = undecided & ~blocked
+            state[newly_kept] = 1
+            state[pairs[newly_kept[pairs[:, 0]], 1]] = 2
+            undecided = state == 0
+            pairs = pairs[undecided[pairs[:, 0]] & undecided[pairs[:, 1]]]
+
+    kept = state == 1
+    if return_indices:
+        return sorted_points[kept], sorted_indices[kept]
+    else:
+        return sorted_points[kept]
+
+
 def bfs_with_conditions(graph, start_node, stop_nodes, max_depth):
     """
     Perform BFS on an igraph graph (directed or undirected) from a given start node.
@@ -661,6 +1149,44 @@ class TestGraphUtils(unittest.TestCase):
         np.testing.assert_almost_equal(new_nodes, gt_new_nodes)
         np.testing.assert_array_equal(np.array(new_edges), gt_new_edges)
 
+    def test_remove_isolated_nodes_large(self):
+        # Same results as with networkx on random graphs.
+        rng = np.random.default_rng(0)
+        for node_num, edge_num in [(1, 0), (100, 30), (5000, 4000)]:
+            nodes = rng.uniform(0, 1000, size=(node_num, 2))
+            edges = rng.integers(0, node_num, size=(edge_num, 2))
+            graph = nx.Graph()
+            graph.add_nodes_from(np.arange(node_num))
+            graph.add_edges_from(edges.tolist())
+            graph.remove_nodes_from(list(nx.isolates(graph)))
+            gt_nodes = nodes[sorted(graph.nodes()), :]
+            gt_edges = {
+                tuple(sorted(edge))
+                for edge in nx.convert_node_labels_to_integers(graph).edges()
+            }
+            new_nodes, new_edges = remove_isolate_nodes(nodes, edges)
+            np.testing.assert_array_equal(new_nodes, gt_nodes)
+            self.assertSetEqual(set(map(tuple, new_edges.tolist())), gt_edges)
+
+    def test_merge_nodes_large(self):
+        # Same clusters and numbering as DBSCAN on random graphs.
+        rng = np.random.default_rng(0)
+        for node_num in [1, 100, 5000]:
+            nodes = rng.uniform(0, 1000, size=(node_num, 2))
+            edges = rng.integers(0, node_num, size=(2 * node_num, 2))
+            labels = DBSCAN(eps=8.0, min_samples=1).fit(nodes).labels_
+            gt_centers = np.stack(
+                [nodes[labels == label].mean(axis=0) for label in range(labels.max() + 1)]
+            )
+            gt_edges = {
+                (min(labels[src], labels[dst]), max(labels[src], labels[dst]))
+                for src, dst in edges
+                if labels[src] != labels[dst]
+            }
+            new_nodes, new_edges = merge_nodes(nodes, edges, 8.0)
+            np.testing.assert_almost_equal(new_nodes, gt_centers, decimal=3)
+            self.assertSetEqual(set(map(tuple, new_edges.tolist())), gt_edges)
+
     def test_split_edges(self):
         nodes = np.array([[0.0, 0.0], [1.01, 1.01], [2.0, 2.0], [2.0, 0.0]])
         edges = [[0, 1], [1, 2], [0, 2], [2, 3]]
@@ -670,6 +1196,35 @@ class TestGraphUtils(unittest.TestCase):
         np.testing.assert_almost_equal(new_nodes, gt_new_nodes)
         np.testing.assert_array_equal(np.array(new_edges), gt_new_edges)
 
+    def test_split_edges_invariant(self):
+        # On a random merged graph, no output edge passes closer than the
+        # threshold to another node, and input edges stay connected.
+        rng = np.random.default_rng(0)
+        nodes = rng.uniform(0, 200, size=(600, 2))
+        edges = rng.integers(0, 600, size=(300, 2))
+        nodes, edges = merge_nodes(nodes, edges, 4.0)
+        new_nodes, new_edges = split_edges(nodes, edges, 2.0)
+        np.testing.assert_array_equal(new_nodes, nodes)
+        self.assertGreater(new_edges.shape[0], edges.shape[0])
+        lines = shapely.linestrings(nodes[new_edges])
+        regions = shapely.envelope(shapely.buffer(lines, 2.0, cap_style="flat"))
+        points = shapely.points(nodes)
+        is_candidate = shapely.contains(regions[:, np.newaxis], points[np.newaxis, :])
+        is_candidate[np.arange(new_edges.shape[0])[:, np.newaxis], new_edges] = False
+        dists = shapely.distance(lines[:, np.newaxis], points[np.newaxis, :])
+        self.assertTrue(np.all(dists[is_candidate] >= 2.0))
+        graph = nx.Graph()
+        graph.add_edges_from(new_edges.tolist())
+        for start, end in edges:
+            self.assertTrue(nx.has_path(graph, start, end))
+
+    def test_split_edges_cycle(self):
+        # 0-1 splits at 2, and both halves split back at 0 or 1. The cycle is
+        # kept as a triangle.
+        nodes = np.array([[0.0, 0.0], [1.0, 0.0], [0.5, 1.5]])
+        new_nodes, new_edges = split_edges(nodes, [[0, 1]], 2.0)
+        np.testing.assert_array_equal(new_edges, np.array([[0, 1], [0, 2], [1, 2]]))
+
     def test_combine_graphs(self):
         nodes0 = np.array([[0.0, 0.0], [1.0, 0.0]])
         edges0 = [[0, 1]]
@@ -761,6 +1316,195 @@ class TestGraphUtils(unittest.TestCase):
         pd = np.array(pts[0])
         np.testing.assert_almost_equal(gt, pd)
 
+    def test_find_crossover_points_random(self):
+        # Same crossings as testing every edge pair with find_intersection.
+        rng = np.random.default_rng(0)
+        points = rng.integers(0, 100, size=(200, 2)).astype(np.float64)
+        g = ig.Graph(200, rng.integers(0, 200, size=(150, 2)).tolist())
+        g.vs["point"] = points
+        lines = [(points[e.source], points[e.target]) for e in g.es]
+        gt = []
+        for i in range(len(lines)):
+            for j in range(i + 1, len(lines)):
+                itsc = find_intersection(lines[i], lines[j])
+                if itsc is not None:
+                    gt.append(itsc)
+        pd = find_crossover_points(g)
+        self.assertGreater(len(gt), 0)
+        np.testing.assert_almost_equal(np.array(sorted(pd)), np.array(sorted(gt)))
+
+    def test_find_crossover_points_deduplicate(self):
+        # Three edges crossing at (1, 1), and a T-junction which doesn't count:
+        # the end (3, 1) of the fourth edge lies inside the fifth.
+        g = ig.Graph(10, [(0, 1), (2, 3), (4, 5), (6, 7), (8, 9)])
+        g.vs["point"] = np.array(
+            [[0, 0], [2, 2], [0, 2], [2, 0], [1, 0], [1, 2], [2, 1], [3, 1], [3, 0], [3, 2]],
+            dtype=np.float64,
+        )
+        self.assertEqual(len(find_crossover_points(g)), 3)
+        pts = find_crossover_points(g, deduplicate=True)
+        self.assertEqual(len(pts), 1)
+        np.testing.assert_almost_equal(np.array(pts[0]), np.array([1.0, 1.0]))
+
+    def test_road_graph_segments(self):
+        # A T-junction, a run with a repeated edge and an isolated loop.
+        g = RoadGraph(
+            np.zeros((10, 2)),
+            [[0, 1], [1, 2], [1, 3], [4, 5], [5, 6], [6, 5], [7, 8], [8, 9], [9, 7]],
+        )
+        segments = g.segments()
+        self.assertEqual(segments[:4], [[0, 1], [1, 2], [1, 3], [4, 5, 6]])
+        self.assertEqual(sorted(segments[4][:-1]), [7, 8, 9])
+        self.assertEqual(segments[4][0], segments[4][-1])
+        self.assertEqual(RoadGraph().segments(), [])
+
+    def test_get_polyline_connectivity(self):
+        rng = np.random.default_rng(0)
+        # Snaps endpoints to a coarse grid so many of them coincide.
+        polylines = [
+            np.round(rng.uniform(0, 20, size=(rng.integers(1, 5), 2)) / 2) * 2
+            for _ in range(200)
+        ]
+        gt_pairs, gt_indices = [], []
+        for i in range(len(polylines)):
+            for j in range(i + 1, len(polylines)):
+                a, b = polylines[i], polylines[j]
+                for a_idx in (0, a.shape[0] - 1):
+                    for b_idx in (0, b.shape[0] - 1):
+                        if np.linalg.norm(a[a_idx] - b[b_idx]) < 2.0:
+                            gt_pairs += [(i, j), (j, i)]
+                            gt_indices += [(a_idx, b_idx), (b_idx, a_idx)]
+        pairs, indices = get_polyline_connectivity(polylines, 2.0)
+        self.assertGreater(len(gt_pairs), 0)
+        self.assertEqual(pairs, gt_pairs)
+        self.assertEqual(indices, gt_indices)
+        self.assertEqual(get_polyline_connectivity(polylines[:1], 2.0), ([], []))
+
+    def test_nms_points_bulk(self):
+        points = np.array([[0.0, 0.0], [1.0, 0.0], [3.0, 0.0], [4.5, 0.0], [0.5, 0.5]])
+        scores = np.array([0.9, 0.8, 0.7, 0.95, 2.0])
+        kept_points, kept_indices = nms_points_bulk(
+            points, scores, radius=1.6, return_indices=True
+        )
+        # 4 is forced and suppresses 0 and 1, then 3 suppresses 2.
+        np.testing.assert_array_equal(kept_indices, np.array([4, 3]))
+        np.testing.assert_array_equal(kept_points, points[[4, 3]])
+
+    def test_nms_points_bulk_matches_nms_points(self):
+        rng = np.random.default_rng(0)
+        for point_num in [0, 1, 50, 2000]:
+            points = rng.uniform(0, 256, size=(point_num, 2))
+            scores = rng.uniform(0, 1, size=(point_num,))
+            scores[rng.uniform(size=(point_num,)) < 0.05] = 2.0
+            gt_points, gt_indices = nms_points(points, scores, 8, return_indices=True)
+            pd_points, pd_indices = nms_points_bulk(
+                points, scores, 8, return_indices=True
+            )
+            np.testing.assert_array_equal(pd_indices, gt_indices)
+            np.testing.assert_array_equal(pd_points, gt_points)
+
+    def test_dedupe_edges(self):
+        edges = [[2, 1], [1, 2], [0, 0], [0, 1], [1, 0]]
+        np.testing.assert_array_equal(dedupe_edges(edges), np.array([[0, 1], [1, 2]]))
+        self.assertEqual(dedupe_edges([]).shape, (0, 2))
+
+    def test_road_graph_from_xy(self):
+        # 1 and 3 round to the same pixel, 4 is left without edges.
+        points = np.array([[1.2, 2.0], [3.0, 4.0], [5.0, 6.0], [3.4, 3.8], [9.0, 9.0]])
+        edges = np.array([[1, 2], [2, 0], [0, 3], [3, 1], [2, 1]])
+        road_graph = RoadGraph.from_xy(points, edges)
+        np.testing.assert_array_equal(road_graph.nodes, np.array([[4, 3], [6, 5], [2, 1]]))
+        np.testing.assert_array_equal(road_graph.edges, np.array([[0, 1], [1, 2], [2, 0]]))
+        np.testing.assert_array_equal(road_graph.degrees(), np.array([2, 2, 2]))
+        np.testing.assert_array_equal(np.sort(road_graph.neighbors(0)), np.array([1, 2]))
+        self.assertEqual(road_graph.num_components(), 1)
+
+        graph = road_graph.to_nx()
+        self.assertSetEqual(set(graph.nodes()), {(3, 4), (5, 6), (1, 2)})
+        self.assertEqual(graph.number_of_edges(), 3)
+        round_trip = RoadGraph.from_nx(graph)
+        np.testing.assert_array_equal(round_trip.nodes, road_graph.nodes)
+        np.testing.assert_array_equal(
+            dedupe_edges(round_trip.edges), dedupe_edges(road_graph.edges)
+        )
+
+    def test_road_graph_sat2graph_round_trip(self):
+        graph = {(0, 0): [(1, 1)], (1, 1): [(0, 0), (2, 2)], (2, 2): [(1, 1)]}
+        road_graph = RoadGraph.from_sat2graph(graph)
+        self.assertEqual(road_graph.node_num, 3)
+        self.assertEqual(road_graph.edge_num, 2)
+        result = road_graph.to_sat2graph()
+        self.assertSetEqual(set(result.keys()), set(graph.keys()))
+        for k, v in result.items():
+            self.assertSetEqual(set(v), set(graph[k]))
+        self.assertEqual(RoadGraph.from_sat2graph({}).node_num, 0)
+        self.assertDictEqual(RoadGraph().to_sat2graph(), {})
+
+    def test_road_graph_file_round_trip(self):
+        road_graph = RoadGraph(
+            np.array([[0.0, 0.0], [1.5, 2.5], [3.0, 4.0]]), np.array([[0, 1], [1, 2]])
+        )
+        transform = (500000.0, 10.0, 0.0, 4000000.0, 0.0, -10.0)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "0.rgraph")
+            save_road_graph(path, road_graph, transform=transform, crs="EPSG:32630")
+            for mmap in [True, False]:
+                loaded, metadata = load_road_graph(path, mmap=mmap)
+                np.testing.assert_array_equal(loaded.nodes, road_graph.nodes)
+                np.testing.assert_array_equal(loaded.edges, road_graph.edges)
+                self.assertEqual(loaded.nodes.dtype, np.float32)
+                self.assertEqual(loaded.edges.dtype, np.int32)
+                self.assertListEqual(metadata["transform"], list(transform))
+                self.assertEqual(metadata["crs"], "EPSG:32630")
+                del loaded
+
+            empty_path = os.path.join(tmp_dir, "empty.rgraph")
+            save_road_graph(empty_path, RoadGraph())
+            loaded, metadata = load_road_graph(empty_path)
+            self.assertEqual(loaded.node_num, 0)
+            self.assertIsNone(metadata["transform"])
+
+            with open(os.path.join(tmp_dir, "bad.rgraph"), "wb") as f:
+                f.write(b"not a graph")
+            with self.assertRaises(ValueError):
+                load_road_graph(os.path.join(tmp_dir, "bad.rgraph"))
+
+    def test_load_road_graph_from_sat2graph_pickle(self):
+        graph = {(0, 0): [(1, 1)], (1, np.int64(1)): [(0, 0), (2, 2)], (2, 2): [(1, 1)]}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "0.p")
+            with open(path, "wb") as f:
+                pickle.dump(graph, f)
+            road_graph, metadata = load_road_graph(path)
+            self.assertEqual(road_graph.node_num, 3)
+            self.assertEqual(road_graph.edge_num, 2)
+            self.assertIsNone(metadata["crs"])
+
+            # anything but plain data is refused
+            with open(path, "wb") as f:
+                pickle.dump({(0, 0): [os.getcwd]}, f)
+            with self.assertRaises(pickle.UnpicklingError):
+                load_road_graph(path)
+
+    def test_get_resampled_polylines(self):
+        # Same points as shapely's interpolate, including zero-length pieces.
+        rng = np.random.default_rng(0)
+        coords = rng.uniform(0, 1000, size=(100, 2))
+        segments = [list(rng.integers(0, 100, size=n)) for n in [2, 3, 10, 30]]
+        segments += [[3, 3, 3], [5, 6, 6, 7]]
+        for num_points in [1, 2, 17]:
+            resampled = get_resampled_polylines(coords, segments, num_points)
+            for segment, pd in zip(segments, resampled):
+                polyline = LineString(coords[segment])
+                gt = np.array(
+                    [
+                        list(polyline.interpolate(d).coords)[0]
+                        for d in np.linspace(0, polyline.length, num_points)
+                    ]
+                )
+                np.testing.assert_array_equal(pd, gt)
+        self.assertListEqual(get_resampled_polylines(coords, [], 5), [])
+
     def test_subdivide_graph(self):
         adj = {
             (0, 0): [
@@ -779,6 +1523,26 @@ class TestGraphUtils(unittest.TestCase):
         self.assertEqual(len(g1.vs["point"]), 11)
         self.assertEqual(len(g1.es), 10)
 
+    def test_subdivide_graph_matches_linspace(self):
+        rng = np.random.default_rng(0)
+        points = rng.uniform(0, 100, size=(30, 2))
+        g = ig.Graph(30, rng.integers(0, 30, size=(40, 2)).tolist())
+        g.vs["point"] = points
+        g1 = subdivide_graph(g, resolution=3.0)
+        new_points = np.array(g1.vs["point"])
+        np.testing.assert_array_equal(new_points[:30], points)
+        offset = 30
+        for edge_idx, (src, dst) in enumerate(g.get_edgelist()):
+            p0, p1 = points[src], points[dst]
+            pieces = max(1, int(np.linalg.norm(p1 - p0) / 3.0))
+            samples = np.linspace(0.0, 1.0, pieces + 1)[1:-1]
+            gt = p0[np.newaxis, :] + samples[:, np.newaxis] @ (p1 - p0)[np.newaxis, :]
+            np.testing.assert_array_equal(new_points[offset : offset + pieces - 1], gt)
+            chain = [src] + list(range(offset, offset + pieces - 1)) + [dst]
+            self.assertIn((chain[0], chain[1]), g1.get_edgelist())
+            offset += pieces - 1
+        self.assertEqual(len(g1.vs), offset)
+
 
 if __name__ == "__main__":
     unittest.main()
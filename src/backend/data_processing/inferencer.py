@@ -12,13 +12,13 @@ from model import SAMRoad
 import graph_extraction
 import graph_utils
 
-import pickle
 import time
 from argparse import ArgumentParser
 
 import math
 from tqdm import tqdm
 from rasterio.windows import from_bounds
+from rasterio.transform import Affine
 
 parser = ArgumentParser()
 parser.add_argument("--checkpoint", default=None, help="checkpoint of the model to test.")
@@ -27,6 +27,8 @@ parser.add_argument("--output_dir", default=None, help="Name of the output dir,
 parser.add_argument("--device", default="cuda", help="device to use for training")
 parser.add_argument("--bbox", type=float, nargs=4, default=None, help="Bounding box to crop in min_lon min_lat max_lon max_lat format.")
 parser.add_argument("--images", type=str, nargs="+", required=True, help="List of image paths to process")
+parser.add_argument("--engine", default=None, choices=["astar", "toponet", "skeleton"], help="Graph extraction engine, overrides GRAPH_EXTRACTION_ENGINE in the config.")
+parser.add_argument("--compare_engines", action="store_true", help="Also run a second extraction engine (A*, or TopoNet when extracting with A*) and report timing and topology differences.")
 
 args = parser.parse_args()
 logging.info("Parsed arguments: %s", args)
@@ -48,9 +50,36 @@ def _pad_to_size(patch, target_h, target_w):
         return patch
     return cv2.copyMakeBorder(patch, 0, pad_bottom, 0, pad_right, borderType=cv2.BORDER_REPLICATE)
 
-def infer_one_img(net, img_path, config, bbox=None, target_resolution_m=10.0, overlap_hr=64):
+def make_topo_scorer(net, device):
+    def score_pairs(features, points, pairs, valid):
+        with torch.no_grad():
+            topo_scores = net.infer_toponet(
+                torch.from_numpy(features).to(device),
+                torch.from_numpy(points).to(device),
+                torch.from_numpy(pairs).to(device),
+                torch.from_numpy(valid).to(device),
+            )
+        return topo_scores[..., 0].cpu().numpy()
+    return score_pairs
+
+def extract_graph(engine, net, keypoint_mask, road_mask, tile_features, tile_origins, config):
+    if engine == "toponet":
+        return graph_extraction.extract_graph_toponet(
+            keypoint_mask, road_mask, tile_features, tile_origins, make_topo_scorer(net, args.device), config
+        )
+    if engine == "skeleton":
+        return graph_extraction.extract_graph_skeleton(road_mask, config)
+    if config.get("EXTRACTION_WORKERS", 1) == 1:
+        return graph_extraction.extract_graph_astar(keypoint_mask, road_mask, config)
+    return graph_extraction.extract_graph_astar_partitioned(keypoint_mask, road_mask, config)
+
+def get_comparison_engine(engine):
+    return "toponet" if engine == "astar" else "astar"
+
+def infer_one_img(net, img_path, config, bbox=None, target_resolution_m=10.0, overlap_hr=64, engine="astar", compare_engines=False):
     TILE_SIZE = config.PATCH_SIZE
     BATCH_SIZE = config.INFER_BATCH_SIZE
+    keep_features = engine == "toponet" or (compare_engines and get_comparison_engine(engine) == "toponet")
 
     with rasterio.open(img_path) as src:
         window = None
@@ -104,18 +133,31 @@ def infer_one_img(net, img_path, config, bbox=None, target_resolution_m=10.0, ov
     fused_road_mask = np.zeros((H_hr, W_hr), dtype=np.float32)
     weight_mask     = np.zeros((H_hr, W_hr), dtype=np.float32)
     batch_tiles, batch_paste_xy_hr = [], []
+    tile_features, tile_origins = [], []
 
     def flush_batch():
         if not batch_tiles: return
         batch_array = np.stack(batch_tiles, axis=0)
         batch_tensor = torch.from_numpy(batch_array).to(args.device)
         with torch.no_grad():
-            mask_scores, _ = net.infer_masks_and_img_features(batch_tensor)
+            mask_scores, img_features = net.infer_masks_and_img_features(batch_tensor)
             mask_scores = mask_scores.cpu().numpy()
 
         keypoint_scores = mask_scores[..., 0]
         road_scores = mask_scores[..., 1]
 
+        if keep_features:
+            # TopoNet only scores tiles holding keypoints, which lie above the
+            # keypoint or road threshold, so features of tiles without any
+            # road aren't kept. They are most tiles of a large scene.
+            has_roads = np.any(keypoint_scores > config.ITSC_THRESHOLD, axis=(1, 2)) | np.any(
+                road_scores > config.ROAD_THRESHOLD, axis=(1, 2)
+            )
+            road_tiles = np.nonzero(has_roads)[0]
+            if road_tiles.shape[0]:
+                tile_features.extend(img_features[torch.from_numpy(road_tiles).to(img_features.device)].cpu().numpy())
+                tile_origins.extend((batch_paste_xy_hr[i][1], batch_paste_xy_hr[i][0]) for i in road_tiles)
+
         for i, (y_hr, x_hr) in enumerate(batch_paste_xy_hr):
             h_valid, w_valid = min(TILE_SIZE, H_hr - y_hr), min(TILE_SIZE, W_hr - x_hr)
             if h_valid > 0 and w_valid > 0:
@@ -140,22 +182,28 @@ def infer_one_img(net, img_path, config, bbox=None, target_resolution_m=10.0, ov
     fused_keypoint_mask_uint8 = (np.clip(fused_keypoint_mask, 0.0, 1.0) * 255).astype(np.uint8)
     fused_road_mask_uint8 = (np.clip(fused_road_mask, 0.0, 1.0) * 255).astype(np.uint8)
 
-    graph = graph_extraction.extract_graph_astar(fused_keypoint_mask_uint8, fused_road_mask_uint8, config)
-
-    if len(graph.nodes()) == 0:
-        return np.zeros((0, 2), dtype=np.float32), np.zeros((0, 2), dtype=np.int32), fused_keypoint_mask_uint8, fused_road_mask_uint8, transform_lr
+    extraction_report = {"engine": engine}
+    start_seconds = time.time()
+    graph = extract_graph(engine, net, fused_keypoint_mask_uint8, fused_road_mask_uint8, tile_features, tile_origins, config)
+    extraction_report["seconds"] = time.time() - start_seconds
 
-    pred_nodes_hr_xy = np.array([[x, y] for (y, x) in graph.nodes()], dtype=np.float32)
-    pred_nodes_lr_xy = pred_nodes_hr_xy / scale_factor
+    if compare_engines:
+        other_engine = get_comparison_engine(engine)
+        start_seconds = time.time()
+        other_graph = extract_graph(other_engine, net, fused_keypoint_mask_uint8, fused_road_mask_uint8, tile_features, tile_origins, config)
+        extraction_report["comparison"] = {
+            "engines": [engine, other_engine],
+            "seconds": [extraction_report["seconds"], time.time() - start_seconds],
+            **graph_extraction.compare_graphs(graph, other_graph),
+        }
+        logging.info("Graph extraction comparison: %s", extraction_report["comparison"])
 
-    node_list = list(graph.nodes())
-    node_index = {node: idx for idx, node in enumerate(node_list)}
-    pred_edges = np.array(
-        [(node_index[u], node_index[v]) for u, v in graph.edges()],
-        dtype=np.int32
-    )
+    # (row, col) nodes back to the resolution of the GeoTIFF
+    pred_graph = graph_utils.RoadGraph(graph.nodes / scale_factor, graph.edges)
+    # The fused masks are at the upsampled resolution.
+    mask_transform = transform_lr * Affine.scale(W_lr / W_hr, H_lr / H_hr)
 
-    return pred_nodes_lr_xy, pred_edges, fused_keypoint_mask_uint8, fused_road_mask_uint8, transform_lr
+    return pred_graph, fused_keypoint_mask_uint8, fused_road_mask_uint8, transform_lr, mask_transform, extraction_report
 
 
 if __name__ == "__main__":
@@ -175,34 +223,40 @@ if __name__ == "__main__":
     else:
         output_dir = create_output_dir_and_save_config(output_dir_prefix, config)
 
+    engine = args.engine or config.get("GRAPH_EXTRACTION_ENGINE", "astar")
     total_inference_seconds = 0.0
+    extraction_reports = []
 
     for img_id, img_path in enumerate(args.images):
         print(f"Processing {img_path}")
         start_seconds = time.time()
-        pred_nodes, pred_edges, itsc_mask, road_mask, geo_transform = infer_one_img(net, img_path, config, bbox=args.bbox)
+        pred_graph, itsc_mask, road_mask, geo_transform, mask_transform, extraction_report = infer_one_img(
+            net, img_path, config, bbox=args.bbox, engine=engine, compare_engines=args.compare_engines
+        )
         total_inference_seconds += time.time() - start_seconds
+        extraction_reports.append({"image": img_path, **extraction_report})
 
         mask_save_dir = os.path.join(output_dir, "mask")
         os.makedirs(mask_save_dir, exist_ok=True)
         cv2.imwrite(os.path.join(mask_save_dir, f"{img_id}_road.png"), road_mask)
         cv2.imwrite(os.path.join(mask_save_dir, f"{img_id}_itsc.png"), itsc_mask)
+        # Georeferences the masks for raster change detection.
+        with open(os.path.join(mask_save_dir, f"{img_id}_road_transform.json"), "w") as f:
+            json.dump(mask_transform.to_gdal(), f)
 
         graph_save_dir = os.path.join(output_dir, "graph")
         os.makedirs(graph_save_dir, exist_ok=True)
 
-        large_map_sat2graph_format = graph_utils.convert_to_sat2graph_format(pred_nodes, pred_edges)
-        graph_save_path = os.path.join(graph_save_dir, f"{img_id}.p")
-        with open(graph_save_path, "wb") as file:
-            pickle.dump(large_map_sat2graph_format, file)
-
-        transform_save_path = os.path.join(graph_save_dir, f"{img_id}_transform.json")
-        with open(transform_save_path, "w") as f:
-            json.dump(geo_transform.to_gdal(), f)
+        with rasterio.open(img_path) as src:
+            crs_wkt = src.crs.to_wkt() if src.crs else None
+        graph_save_path = os.path.join(graph_save_dir, f"{img_id}.rgraph")
+        graph_utils.save_road_graph(graph_save_path, pred_graph, transform=geo_transform.to_gdal(), crs=crs_wkt)
 
         print(f"Done for {img_id}.")
 
     time_txt = f"Inference completed in {total_inference_seconds:.2f} seconds."
     print(time_txt)
     with open(os.path.join(output_dir, "inference_time.txt"), "w") as f:
-        f.write(time_txt)
\ No newline at end of file
+        f.write(time_txt)
+    with open(os.path.join(output_dir, "graph_extraction.json"), "w") as f:
+        json.dump(extraction_reports, f, indent=2)
\ No newline at end of file
@@ -0,0 +1,301 @@
+# backend/utils/change_detection.py
+# Damage detection on the fused road probability masks instead of the
+# vectorised predictions. The post-event mask is resampled onto the pre-event
+# grid, the per-pixel loss (road before, no road after, on an OSM road) is
+# computed with numpy, and only the pre-event road edges running through lost
+# pixels are turned back into geometry.
+import time
+import unittest
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import rasterio.warp
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+
+from utils.geo_transform import METERS_PER_DEGREE, geojson_line_arrays, get_transformer
+
+
+def align_mask(mask, transform, crs, dst_shape, dst_transform, dst_crs):
+    # Resamples a mask onto another grid. Pixels outside the source are 0.
+    # Pre and post runs over the same AOI usually share their grid already.
+    same_crs = CRS.from_user_input(crs) == CRS.from_user_input(dst_crs)
+    if same_crs and mask.shape == tuple(dst_shape) and transform.almost_equals(dst_transform):
+        return mask
+    if same_crs:
+        # Grids in one CRS are related by an affine map, which OpenCV applies
+        # an order of magnitude faster than GDAL. cv2 puts pixel centres on
+        # integer coordinates, rasterio puts pixel corners there.
+        to_src = Affine.translation(-0.5, -0.5) * ~transform * dst_transform * Affine.translation(0.5, 0.5)
+        return cv2.warpAffine(
+            mask,
+            np.array(to_src[:6]).reshape(2, 3),
+            (dst_shape[1], dst_shape[0]),
+            flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=0,
+        )
+    aligned = np.zeros(dst_shape, dtype=mask.dtype)
+    rasterio.warp.reproject(
+        source=mask,
+        destination=aligned,
+        src_transform=transform,
+        src_crs=crs,
+        dst_transform=dst_transform,
+        dst_crs=dst_crs,
+        resampling=Resampling.bilinear,
+    )
+    return aligned
+
+
+def rasterize_lines(geojson, shape, transform, crs, width_px, value=1):
+    # Draws the LineStrings of a WGS84 GeoJSON onto a grid, width_px wide.
+    # All vertices are projected in one call and drawn by OpenCV in another.
+    mask = np.zeros(shape, dtype=np.uint8)
+    coords, line_index, _ = geojson_line_arrays(geojson.get("features", []))
+    if coords.shape[0] == 0:
+        return mask
+    x, y = get_transformer("EPSG:4326", crs).transform(coords[:, 0], coords[:, 1])
+    cols, rows = ~transform * (np.asarray(x), np.asarray(y))
+    # cv2 draws through pixel centres, at 1/16 pixel precision.
+    pixels = np.round((np.stack([cols, rows], axis=-1) - 0.5) * 16).astype(np.int32)
+    lines = np.split(pixels, np.flatnonzero(np.diff(line_index)) + 1)
+    # OpenCV's thick lines come out about one pixel wider than thickness.
+    thickness = max(1, int(round(width_px)) - 1)
+    cv2.polylines(mask, lines, False, value, thickness=thickness, shift=4)
+    return mask
+
+
+def loss_map(pre_mask, post_mask, osm_mask, threshold):
+    # Pixels that were road before the event, aren't after, and lie on OSM.
+    # uint8 masks go through OpenCV, which is several times faster than numpy
+    # boolean ops on full-size masks.
+    # Returns: uint8 mask, 255 where lost.
+    was_road = cv2.compare(pre_mask, float(threshold), cv2.CMP_GE)
+    not_road = cv2.compare(post_mask, float(threshold), cv2.CMP_LT)
+    return cv2.bitwise_and(was_road, not_road, mask=osm_mask)
+
+
+def densify_lines(coords, line_index, spacing=1.0):
+    # Evenly spaced points along polylines, at most spacing apart, including
+    # every vertex.
+    # coords: [N_vertex, 2] points, grouped by line.
+    # line_index: [N_vertex] line of each vertex.
+    # Returns: [N_sample, 2] points and [N_sample] line of each point.
+    starts = np.flatnonzero(line_index[1:] == line_index[:-1])
+    p0, p1 = coords[starts], coords[starts + 1]
+    pieces = np.maximum(np.ceil(np.linalg.norm(p1 - p0, axis=1) / spacing), 1).astype(np.int64)
+    segment_of_sample = np.repeat(np.arange(starts.shape[0]), pieces)
+    first_sample = np.cumsum(pieces) - pieces
+    t = (np.arange(segment_of_sample.shape[0]) - first_sample[segment_of_sample]) / pieces[segment_of_sample]
+    samples = p0[segment_of_sample] + t[:, None] * (p1 - p0)[segment_of_sample]
+    # Each segment sample excludes its end, so the last vertex of each line
+    # is added separately.
+    line_ends = np.flatnonzero(np.diff(line_index, append=-1) != 0)
+    line_ends = line_ends[np.isin(line_ends, starts + 1)]
+    samples = np.concatenate([samples, coords[line_ends]])
+    sample_line = np.concatenate([line_index[starts][segment_of_sample], line_index[line_ends]])
+    return samples, sample_line
+
+
+def sample_mask(mask, rows, cols):
+    # Values of the pixels containing continuous (row, col) points, 0 and
+    # False in the second array for points outside the mask.
+    pixel_rows = np.floor(rows).astype(np.int64)
+    pixel_cols = np.floor(cols).astype(np.int64)
+    inside = (
+        (pixel_rows >= 0) & (pixel_rows < mask.shape[0]) & (pixel_cols >= 0) & (pixel_cols < mask.shape[1])
+    )
+    values = np.zeros(rows.shape[0], dtype=mask.dtype)
+    values[inside] = mask[pixel_rows[inside], pixel_cols[inside]]
+    return values, inside
+
+
+def damaged_edges(road_graph, graph_transform, loss, loss_transform, min_fraction=0.5):
+    # Pre-event edges with at least min_fraction of their length on lost
+    # pixels. Edges are sampled about once per loss map pixel.
+    # graph_transform, loss_transform: pixel to CRS affines, in one CRS.
+    # Returns: [N_edge] bool.
+    if road_graph.edge_num == 0:
+        return np.zeros(0, dtype=bool)
+    # Graph (row, col) to loss map (row, col).
+    to_loss = ~loss_transform * graph_transform
+    rows, cols = road_graph.nodes[:, 0] + 0.5, road_graph.nodes[:, 1] + 0.5
+    loss_cols, loss_rows = to_loss * (cols.astype(np.float64), rows.astype(np.float64))
+    nodes = np.stack([loss_rows, loss_cols], axis=-1)
+    samples, edge_of_sample = densify_lines(
+        nodes[road_graph.edges.ravel()], np.repeat(np.arange(road_graph.edge_num), 2)
+    )
+    lost = sample_mask(loss, samples[:, 0], samples[:, 1])[0] > 0
+    lost_fraction = np.bincount(edge_of_sample, weights=lost, minlength=road_graph.edge_num) / np.bincount(
+        edge_of_sample, minlength=road_graph.edge_num
+    )
+    return lost_fraction >= min_fraction
+
+
+def score_ways(osm_geojson, pre_mask, pre_transform, post_mask, post_transform, crs, threshold, post_crs=None):
+    # Damage score of each OSM way: the fraction of its length that was road
+    # in the pre-event mask and isn't in the post-event one, out of the length
+    # that was road before. Ways are sampled about once per pre-event pixel.
+    # crs: CRS of the pre-event mask. post_crs defaults to it.
+    # threshold: road probability threshold, 0-255.
+    # Returns a dict of [N_feature] arrays: damage_score (nan where the way
+    # wasn't seen as road before), pre_road_fraction, coverage (fraction of
+    # samples inside both masks) and samples.
+    features = osm_geojson.get("features", [])
+    feature_num = len(features)
+    coords, line_index, line_feature = geojson_line_arrays(features)
+    x, y = get_transformer("EPSG:4326", crs).transform(coords[:, 0], coords[:, 1])
+    cols, rows = ~pre_transform * (np.asarray(x), np.asarray(y))
+    samples, sample_line = densify_lines(np.stack([rows, cols], axis=-1), line_index)
+    feature_of_sample = line_feature[sample_line]
+
+    pre_values, pre_inside = sample_mask(pre_mask, samples[:, 0], samples[:, 1])
+    # Pre-event pixel to post-event pixel, through the CRS coordinates.
+    x, y = pre_transform * (samples[:, 1], samples[:, 0])
+    if post_crs is not None and CRS.from_user_input(post_crs) != CRS.from_user_input(crs):
+        x, y = get_transformer(crs, post_crs).transform(x, y)
+    post_cols, post_rows = ~post_transform * (np.asarray(x), np.asarray(y))
+    post_values, post_inside = sample_mask(post_mask, post_rows, post_cols)
+
+    inside = pre_inside & post_inside
+    was_road = inside & (pre_values >= threshold)
+    lost = was_road & (post_values < threshold)
+
+    def per_feature(weights):
+        return np.bincount(feature_of_sample, weights=weights, minlength=feature_num)
+
+    sample_num = per_feature(None)
+    inside_num = per_feature(inside)
+    road_num = per_feature(was_road)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return {
+            "damage_score": per_feature(lost) / road_num,
+            "pre_road_fraction": road_num / inside_num,
+            "coverage": inside_num / sample_num,
+            "samples": sample_num.astype(np.int64),
+        }
+
+
+def find_damaged_edges_raster(
+    road_graph, graph_transform, pre_mask, pre_transform, post_mask, post_transform, crs,
+    osm_geojson, buffer_m, threshold, post_crs=None,
+):
+    # Raster counterpart of damage_analysis.find_damaged_roads.
+    # road_graph: pre-event graph, on the graph_transform grid.
+    # pre_mask, post_mask: uint8 road probability masks with their grids.
+    # crs: CRS of the pre-event graph and mask. post_crs defaults to it.
+    # buffer_m: OSM roads are drawn 2 * buffer_m wide.
+    # threshold: road probability threshold, 0-255.
+    # Returns: [N_edge] bool of damaged pre-event edges, and a dict of stats.
+    start_time = time.time()
+    post_mask = align_mask(
+        post_mask, post_transform, post_crs or crs, pre_mask.shape, pre_transform, crs
+    )
+    pixel_size = np.sqrt(abs(pre_transform.determinant))
+    if CRS.from_user_input(crs).is_geographic:
+        pixel_size *= METERS_PER_DEGREE
+    osm_mask = rasterize_lines(
+        osm_geojson, pre_mask.shape, pre_transform, crs, 2 * buffer_m / pixel_size
+    )
+    loss = loss_map(pre_mask, post_mask, osm_mask, threshold)
+    damaged = damaged_edges(road_graph, graph_transform, loss, pre_transform)
+    return damaged, {
+        "lost_pixels": cv2.countNonZero(loss),
+        "damaged_edges": int(damaged.sum()),
+        "seconds": time.time() - start_time,
+    }
+
+
+class TestChangeDetection(unittest.TestCase):
+    # A 200 x 200 grid of 1 m pixels with a 5 pixel wide east-west road on
+    # rows 98-102. The post-event mask loses it from column 120 on.
+    crs = "EPSG:32636"
+    transform = Affine(1.0, 0.0, 500000.0, 0.0, -1.0, 4000000.0)
+
+    def setUp(self):
+        self.pre = np.zeros((200, 200), dtype=np.uint8)
+        self.pre[98:103, :] = 255
+        self.post = self.pre.copy()
+        self.post[:, 120:] = 0
+        # Edges from column 10 to 100, 100 to 130 and 130 to 190.
+        self.graph = SimpleNamespace(
+            nodes=np.array([[100, 10], [100, 100], [100, 130], [100, 190]]),
+            edges=np.array([[0, 1], [1, 2], [2, 3]]),
+            edge_num=3,
+        )
+
+    def osm_road(self):
+        x, y = self.transform * (np.array([0.0, 200.0]), np.array([100.5, 100.5]))
+        lon, lat = get_transformer(self.crs, "EPSG:4326").transform(x, y)
+        coords = np.stack([lon, lat], axis=-1).tolist()
+        return {
+            "type": "FeatureCollection",
+            "features": [{"type": "Feature", "properties": {}, "geometry": {"type": "LineString", "coordinates": coords}}],
+        }
+
+    def test_loss_map(self):
+        pre = np.array([[200, 200, 50, 200]], dtype=np.uint8)
+        post = np.array([[0, 200, 0, 0]], dtype=np.uint8)
+        osm = np.array([[1, 1, 1, 0]], dtype=np.uint8)
+        # Lost, still road, never road, and off OSM.
+        self.assertEqual(loss_map(pre, post, osm, 128).tolist(), [[255, 0, 0, 0]])
+
+    def test_damaged_edges(self):
+        loss = loss_map(self.pre, self.post, np.ones_like(self.pre), 128)
+        # Only the last edge lies mostly on lost pixels; the second one is
+        # a third lost.
+        damaged = damaged_edges(self.graph, self.transform, loss, self.transform)
+        self.assertEqual(damaged.tolist(), [False, False, True])
+
+    def test_find_damaged_edges_raster(self):
+        damaged, stats = find_damaged_edges_raster(
+            self.graph, self.transform, self.pre, self.transform, self.post, self.transform,
+            self.crs, self.osm_road(), 3.0, 128,
+        )
+        self.assertEqual(damaged.tolist(), [False, False, True])
+        self.assertEqual(stats["lost_pixels"], 5 * 80)
+        self.assertEqual(stats["damaged_edges"], 1)
+
+    def test_align_mask_half_pixel(self):
+        # The destination grid is shifted by half a pixel, so each of its
+        # pixels is the mean of two neighbouring source columns.
+        mask = np.tile(np.arange(0, 100, 10, dtype=np.uint8), (10, 1))
+        dst_transform = self.transform * Affine.translation(0.5, 0.0)
+        aligned = align_mask(mask, self.transform, self.crs, mask.shape, dst_transform, self.crs)
+        np.testing.assert_array_equal(aligned[:, :9], mask[:, :9] + 5)
+        # Same result as GDAL's bilinear resampling.
+        expected = np.zeros_like(mask)
+        rasterio.warp.reproject(
+            source=mask, destination=expected, src_transform=self.transform, src_crs=self.crs,
+            dst_transform=dst_transform, dst_crs=self.crs, resampling=Resampling.bilinear,
+        )
+        np.testing.assert_array_equal(aligned[:, :9], expected[:, :9])
+
+    def test_densify_lines(self):
+        # A 3 pixel segment, a single vertex line and a short segment.
+        coords = np.array([[0.0, 0.0], [3.0, 0.0], [5.0, 5.0], [6.0, 0.0], [6.0, 0.5]])
+        samples, sample_line = densify_lines(coords, np.array([0, 0, 1, 2, 2]))
+        self.assertEqual(samples.tolist(), [[0, 0], [1, 0], [2, 0], [6, 0], [3, 0], [6, 0.5]])
+        self.assertEqual(sample_line.tolist(), [0, 0, 0, 2, 0, 2])
+
+    def test_score_ways(self):
+        osm = self.osm_road()
+        osm["features"].append({"type": "Feature", "properties": {}, "geometry": None})
+        scores = score_ways(osm, self.pre, self.transform, self.post, self.transform, self.crs, 128)
+        # 80 of the 200 pixels the way crosses are lost. Its end lies on the
+        # grid edge, so that sample is outside.
+        self.assertAlmostEqual(scores["damage_score"][0], 0.4)
+        self.assertEqual(scores["pre_road_fraction"][0], 1.0)
+        self.assertAlmostEqual(scores["coverage"][0], 200 / 201)
+        # The way without geometry has no samples and no score.
+        self.assertTrue(np.isnan(scores["damage_score"][1]))
+        self.assertEqual(scores["samples"].tolist(), [201, 0])
+
+    def test_score_ways_empty(self):
+        empty = {"type": "FeatureCollection", "features": []}
+        scores = score_ways(empty, self.pre, self.transform, self.post, self.transform, self.crs, 128)
+        for values in scores.values():
+            self.assertEqual(values.shape, (0,))
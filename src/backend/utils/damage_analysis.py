@@ -0,0 +1,162 @@
+# backend/utils/damage_analysis.py
+# Flags pre-event predicted roads that lie on an OSM road but have no
+# post-event predicted road nearby. Lines are projected to a UTM zone so that
+# distances are in metres, and proximity is tested with bulk STRtree queries
+# instead of buffering the union of every line. Other geometries, e.g. OSM
+# area highways mapped as polygons, are compared as they are.
+import unittest
+
+import numpy as np
+import shapely
+from shapely.geometry import shape
+
+from utils.geo_transform import geojson_line_arrays, get_transformer
+
+# About the 0.0001 degree buffer the comparison used before.
+DEFAULT_DAMAGE_BUFFER_M = 10.0
+
+
+def utm_crs_for(lon, lat):
+    # EPSG code of the WGS84 UTM zone containing (lon, lat).
+    zone = min(int((lon + 180.0) // 6.0) + 1, 60)
+    return f"EPSG:{(32600 if lat >= 0 else 32700) + zone}"
+
+
+def non_line_geometries(features):
+    # WGS84 shapely geometries of the features that geojson_line_arrays
+    # skips: polygons, points and collections.
+    # Returns: [N] feature indices and [N] geometries.
+    indices = [
+        i
+        for i, feature in enumerate(features)
+        if (feature.get("geometry") or {}).get("type") not in (None, "LineString", "MultiLineString")
+    ]
+    geometries = np.array([shape(features[i]["geometry"]) for i in indices], dtype=object)
+    keep = ~shapely.is_empty(geometries) if indices else np.zeros(0, dtype=bool)
+    return np.array(indices, dtype=np.int64)[keep], geometries[keep]
+
+
+class RoadIndex:
+    # Road features projected to a metric CRS. The STRtree holds the
+    # individual two-point segments, as long chained roads would otherwise
+    # have bounding boxes covering most of the area. Other geometries go in
+    # the STRtree whole.
+    # Built once per layer, it can be reused across comparisons.
+    def __init__(self, geojson, crs):
+        self.features = geojson.get("features", [])
+        self.crs = crs
+        coords, line_index, line_feature = geojson_line_arrays(self.features)
+        self.geometries = np.full(len(self.features), None, dtype=object)
+        if coords.shape[0]:
+            x, y = get_transformer("EPSG:4326", crs).transform(coords[:, 0], coords[:, 1])
+            coords = np.stack([x, y], axis=-1)
+            lines = shapely.linestrings(coords, indices=line_index)
+            feature_ids, feature_of_line = np.unique(line_feature, return_inverse=True)
+            self.geometries[feature_ids] = shapely.multilinestrings(lines, indices=feature_of_line)
+        other_ids, others = non_line_geometries(self.features)
+        if other_ids.shape[0]:
+            transformer = get_transformer("EPSG:4326", crs)
+            self.geometries[other_ids] = shapely.transform(
+                others, lambda xy: np.stack(transformer.transform(xy[:, 0], xy[:, 1]), axis=-1)
+            )
+        self.valid = np.flatnonzero(self.geometries != None)  # noqa: E711
+        starts = np.flatnonzero(line_index[1:] == line_index[:-1])
+        self.segments = np.concatenate(
+            [
+                shapely.linestrings(
+                    np.stack([coords[starts], coords[starts + 1]], axis=1).reshape(-1, 2, 2)
+                ),
+                self.geometries[other_ids],
+            ]
+        )
+        self.tree = shapely.STRtree(self.segments)
+
+    def near(self, other, buffer_m):
+        # Whether each feature of the other index is within buffer_m of any
+        # feature of this one.
+        near = np.zeros(other.geometries.shape[0], dtype=bool)
+        if self.segments.shape[0] == 0 or other.valid.shape[0] == 0:
+            return near
+        hits = self.tree.query(
+            other.geometries[other.valid], predicate="dwithin", distance=buffer_m
+        )
+        near[other.valid[np.unique(hits[0])]] = True
+        return near
+
+
+def road_index_crs(geojson):
+    # UTM zone of the median vertex of the roads, or None without roads.
+    features = geojson.get("features", [])
+    coords = geojson_line_arrays(features)[0]
+    if coords.shape[0] == 0:
+        coords = shapely.get_coordinates(non_line_geometries(features)[1])
+    if coords.shape[0] == 0:
+        return None
+    lon, lat = np.median(coords, axis=0)
+    return utm_crs_for(lon, lat)
+
+
+def find_damaged_roads(pre_roads, post_roads, osm_geojson, buffer_m=DEFAULT_DAMAGE_BUFFER_M):
+    # A pre-event road is damaged if it is within buffer_m metres of an OSM
+    # road and not within buffer_m metres of any post-event road.
+    # pre_roads, post_roads: GeoJSON dicts, or RoadIndexes in the same CRS.
+    # Returns the damaged pre-event features, in their original order.
+    if not isinstance(pre_roads, RoadIndex):
+        crs = road_index_crs(pre_roads)
+        if crs is None:
+            return {"type": "FeatureCollection", "features": []}
+        pre_roads = RoadIndex(pre_roads, crs)
+    if not isinstance(post_roads, RoadIndex):
+        post_roads = RoadIndex(post_roads, pre_roads.crs)
+    osm_roads = RoadIndex(osm_geojson, pre_roads.crs)
+    damaged = osm_roads.near(pre_roads, buffer_m) & ~post_roads.near(pre_roads, buffer_m)
+    return {
+        "type": "FeatureCollection",
+        "features": [pre_roads.features[i] for i in np.flatnonzero(damaged).tolist()],
+    }
+
+
+
+class TestDamageAnalysis(unittest.TestCase):
+    def line(self, coords):
+        return {"type": "Feature", "properties": {}, "geometry": {"type": "LineString", "coordinates": coords}}
+
+    def test_find_damaged_roads(self):
+        osm = {"type": "FeatureCollection", "features": [self.line([[30.0, 40.0], [30.01, 40.0]])]}
+        # On OSM and lost, on OSM and still there, and not on OSM.
+        pre = {
+            "type": "FeatureCollection",
+            "features": [
+                self.line([[30.0, 40.0], [30.005, 40.0]]),
+                self.line([[30.005, 40.0], [30.01, 40.0]]),
+                self.line([[30.0, 40.01], [30.01, 40.01]]),
+            ],
+        }
+        post = {"type": "FeatureCollection", "features": [self.line([[30.006, 40.00002], [30.01, 40.00002]])]}
+        damaged = find_damaged_roads(pre, post, osm)
+        self.assertEqual(damaged["features"], pre["features"][:1])
+
+    def test_find_damaged_roads_polygon(self):
+        # An OSM area highway, a square of about 90 m, and a point. The first
+        # road lies inside the square without touching its outline.
+        square = [[30.0, 40.0], [30.001, 40.0], [30.001, 40.001], [30.0, 40.001], [30.0, 40.0]]
+        osm = {
+            "type": "FeatureCollection",
+            "features": [
+                {"type": "Feature", "properties": {}, "geometry": {"type": "Polygon", "coordinates": [square]}},
+                {"type": "Feature", "properties": {}, "geometry": {"type": "Point", "coordinates": [30.01, 40.01]}},
+            ],
+        }
+        pre = {
+            "type": "FeatureCollection",
+            "features": [
+                self.line([[30.0003, 40.0005], [30.0007, 40.0005]]),
+                self.line([[30.01, 40.01], [30.011, 40.01]]),
+                self.line([[30.005, 40.005], [30.006, 40.005]]),
+            ],
+        }
+        post = {"type": "FeatureCollection", "features": []}
+        damaged = find_damaged_roads(pre, post, osm)
+        self.assertEqual(damaged["features"], pre["features"][:2])
+        # Roads given only as polygons still get a UTM zone.
+        self.assertEqual(road_index_crs(osm), "EPSG:32636")
@@ -0,0 +1,63 @@
+# backend/utils/geo_transform.py
+import functools
+
+import numpy as np
+from pyproj import Transformer
+
+# Length of a degree of latitude, for rough metre sizes of geographic grids.
+METERS_PER_DEGREE = 111320.0
+
+
+@functools.lru_cache(maxsize=32)
+def _cached_transformer(src_crs, dst_crs):
+    return Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+
+def get_transformer(src_crs, dst_crs="EPSG:4326"):
+    # Transformers are slow to build, so they are shared per CRS pair.
+    # CRSs are keyed by their string form, which pyproj accepts back.
+    return _cached_transformer(str(src_crs), str(dst_crs))
+
+
+def pixels_to_lonlat(rows, cols, transform, crs):
+    # Maps pixel (row, col) coordinates to WGS84 at the pixel centres, in one
+    # affine and one pyproj call for all points.
+    # transform: affine.Affine from pixel (col, row) to crs coordinates.
+    # Returns: [N, 2] float64 (lon, lat) array.
+    cols = np.asarray(cols, dtype=np.float64) + 0.5
+    rows = np.asarray(rows, dtype=np.float64) + 0.5
+    x_proj = cols * transform.a + rows * transform.b + transform.c
+    y_proj = cols * transform.d + rows * transform.e + transform.f
+    lon, lat = get_transformer(crs).transform(x_proj, y_proj)
+    return np.stack([np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)], axis=-1)
+
+
+def geojson_line_arrays(features):
+    # Flattens the LineString and MultiLineString geometries of GeoJSON
+    # features. Other geometry types and lines under two points are skipped.
+    # Returns:
+    # coords: [N_vertex, 2] float64 (lon, lat) of all lines, line by line.
+    # line_index: [N_vertex] line of each vertex.
+    # line_feature: [N_line] feature index of each line.
+    lines, line_feature = [], []
+    for feature_idx, feature in enumerate(features):
+        geometry = feature.get("geometry") or {}
+        if geometry.get("type") == "LineString":
+            feature_lines = [geometry.get("coordinates")]
+        elif geometry.get("type") == "MultiLineString":
+            feature_lines = geometry.get("coordinates") or []
+        else:
+            continue
+        for line in feature_lines:
+            if line and len(line) >= 2:
+                lines.append(line)
+                line_feature.append(feature_idx)
+    vertices = [xy for line in lines for xy in line]
+    try:
+        coords = np.array(vertices, dtype=np.float64).reshape(len(vertices), -1)[:, :2]
+    except ValueError:
+        # Vertices with and without elevation mixed.
+        coords = np.array([xy[:2] for xy in vertices], dtype=np.float64).reshape(-1, 2)
+    line_index = np.repeat(np.arange(len(lines)), [len(line) for line in lines])
+    return coords, line_index, np.array(line_feature, dtype=np.int64)
+
@@ -0,0 +1,113 @@
+# backend/utils/geopackage.py
+# Layer listing and streamed feature reading for uploaded GeoPackages.
+# Features are read through fiona in batches, optionally restricted to a bbox
+# with the layer's spatial index, reprojected and simplified with vectorised
+# shapely calls, and written straight out as GeoJSON text.
+import json
+import math
+
+import fiona
+import numpy as np
+import shapely
+from pyproj import CRS
+from shapely.geometry import shape
+
+from utils.geo_transform import METERS_PER_DEGREE, get_transformer
+
+WGS84 = CRS.from_epsg(4326)
+
+
+def _layer_crs(src):
+    # Layers without a CRS are taken to be WGS84, as the upload always did.
+    if not src.crs:
+        return WGS84
+    return CRS.from_user_input(src.crs.to_wkt())
+
+
+def list_layers(path):
+    # Name, feature count, geometry type, CRS and WGS84 bounds of each layer.
+    layers = []
+    for name in fiona.listlayers(path):
+        with fiona.open(path, layer=name) as src:
+            crs = _layer_crs(src)
+            feature_count = len(src)
+            bounds = None
+            if feature_count:
+                bounds = list(src.bounds)
+                if crs != WGS84:
+                    bounds = list(get_transformer(crs.to_wkt()).transform_bounds(*bounds))
+            layers.append(
+                {
+                    "name": name,
+                    "feature_count": feature_count,
+                    "geometry_type": src.schema.get("geometry"),
+                    "crs": crs.to_string(),
+                    "bounds": bounds,
+                }
+            )
+    return layers
+
+
+def _json_properties(properties):
+    # NaN isn't valid JSON, dates and blobs are written as strings.
+    return json.dumps(
+        {
+            key: None if isinstance(value, float) and math.isnan(value) else value
+            for key, value in properties.items()
+        },
+        default=str,
+    )
+
+
+def _encode_batch(features, transformer, tolerance):
+    geometries = np.array(
+        [shape(feature.geometry) if feature.geometry else None for feature in features], dtype=object
+    )
+    if tolerance > 0:
+        geometries = shapely.simplify(geometries, tolerance, preserve_topology=True)
+    if transformer is not None:
+        # Elevations go through the transformer too and are kept. include_z
+        # None transforms 2D and 3D geometries separately, as pyproj turns
+        # the NaN z's that 2D ones would otherwise get into NaN x and y.
+        geometries = shapely.transform(
+            geometries,
+            lambda coords: np.stack(transformer.transform(*coords.T), axis=-1),
+            include_z=None,
+        )
+    geometry_json = shapely.to_geojson(geometries)
+    return ",".join(
+        '{"type": "Feature", "id": %s, "properties": %s, "geometry": %s}'
+        % (json.dumps(feature.id), _json_properties(feature.properties), geometry or "null")
+        for feature, geometry in zip(features, geometry_json.tolist())
+    )
+
+
+def iter_layer_geojson(path, layer, bbox=None, tolerance_m=0.0, batch_size=1000):
+    # Yields a WGS84 GeoJSON FeatureCollection of a layer as text chunks of
+    # batch_size features.
+    # bbox: optional WGS84 (min_lon, min_lat, max_lon, max_lat), only
+    # features whose extent intersects it are read.
+    # tolerance_m: simplification tolerance in metres, 0 to keep every
+    # vertex. Geometries are simplified in the layer's CRS.
+    with fiona.open(path, layer=layer) as src:
+        crs = _layer_crs(src)
+        transformer = get_transformer(crs.to_wkt()) if crs != WGS84 else None
+        tolerance = tolerance_m / METERS_PER_DEGREE if crs.is_geographic else tolerance_m
+        features = src
+        if bbox is not None:
+            if transformer is not None:
+                bbox = get_transformer("EPSG:4326", crs.to_wkt()).transform_bounds(*bbox)
+            features = src.filter(bbox=tuple(bbox))
+
+        yield '{"type": "FeatureCollection", "features": ['
+        first = True
+        batch = []
+        for feature in features:
+            batch.append(feature)
+            if len(batch) >= batch_size:
+                yield ("" if first else ",") + _encode_batch(batch, transformer, tolerance)
+                first = False
+                batch = []
+        if batch:
+            yield ("" if first else ",") + _encode_batch(batch, transformer, tolerance)
+        yield "]}"
@@ -0,0 +1,373 @@
+# backend/utils/overpass_cache.py
+# On-disk cache of OSM road queries. Query bboxes are snapped to a fixed
+# lon/lat tile grid, the parsed features of each tile are stored per road
+# types and date, and only tiles that are missing or expired are fetched.
+# Adjacent missing tiles are fetched together in blocks, so that panning over
+# uncached ground costs a few queries rather than one per tile. Ways crossing
+# tile borders are stored in every tile they touch and merged back by way id.
+import hashlib
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+# About 5.5 km at the equator.
+DEFAULT_TILE_SIZE_DEG = 0.05
+DEFAULT_TTL_S = 24 * 3600
+# Guards against fetching a continent when zoomed out.
+DEFAULT_MAX_TILES = 256
+# Side of the largest block of tiles fetched in one query, about 22 km.
+DEFAULT_BLOCK_SIZE = 4
+# Tiles not refetched for this long are deleted by prune.
+DEFAULT_MAX_AGE_S = 30 * 24 * 3600
+
+
+def tile_range(bbox, tile_size=DEFAULT_TILE_SIZE_DEG):
+    # (min_col, min_row, max_col, max_row) block of the grid tiles covering a
+    # (min_lon, min_lat, max_lon, max_lat) bbox.
+    # Raises ValueError for non-finite coordinates.
+    if not all(math.isfinite(coord) for coord in bbox):
+        raise ValueError(f"Invalid bbox {bbox}")
+    min_lon, min_lat, max_lon, max_lat = bbox
+    min_col, min_row = math.floor(min_lon / tile_size), math.floor(min_lat / tile_size)
+    # A bbox ending exactly on a tile border doesn't need the next tile.
+    max_col = max(min_col, math.ceil(max_lon / tile_size) - 1)
+    max_row = max(min_row, math.ceil(max_lat / tile_size) - 1)
+    return min_col, min_row, max_col, max_row
+
+
+def snap_to_tiles(bbox, tile_size=DEFAULT_TILE_SIZE_DEG):
+    # (col, row) indices of the grid tiles covering a bbox, row by row.
+    min_col, min_row, max_col, max_row = tile_range(bbox, tile_size)
+    return [
+        (col, row)
+        for row in range(min_row, max_row + 1)
+        for col in range(min_col, max_col + 1)
+    ]
+
+
+def block_bbox(block, tile_size=DEFAULT_TILE_SIZE_DEG):
+    # Lon/lat bbox of a (min_col, min_row, max_col, max_row) block of tiles.
+    min_col, min_row, max_col, max_row = block
+    return (min_col * tile_size, min_row * tile_size, (max_col + 1) * tile_size, (max_row + 1) * tile_size)
+
+
+def coalesce_tiles(tiles, block_size=DEFAULT_BLOCK_SIZE):
+    # Groups (col, row) tiles into rectangles of tiles at most block_size a
+    # side, greedily from the lowest row, widest first.
+    # Returns (min_col, min_row, max_col, max_row) blocks.
+    remaining = set(tiles)
+    blocks = []
+    for col, row in sorted(remaining, key=lambda tile: (tile[1], tile[0])):
+        if (col, row) not in remaining:
+            continue
+        max_col = col
+        while max_col - col + 1 < block_size and (max_col + 1, row) in remaining:
+            max_col += 1
+        max_row = row
+        while max_row - row + 1 < block_size and all(
+            (block_col, max_row + 1) in remaining for block_col in range(col, max_col + 1)
+        ):
+            max_row += 1
+        remaining.difference_update(
+            (block_col, block_row)
+            for block_row in range(row, max_row + 1)
+            for block_col in range(col, max_col + 1)
+        )
+        blocks.append((col, row, max_col, max_row))
+    return blocks
+
+
+def split_features(features, block, tile_size=DEFAULT_TILE_SIZE_DEG):
+    # Features of a block of tiles per tile of the block, by their bbox.
+    min_col, min_row, max_col, max_row = block
+    tile_features = {
+        (col, row): [] for row in range(min_row, max_row + 1) for col in range(min_col, max_col + 1)
+    }
+    for feature in features:
+        extent = feature_bbox(feature)
+        if extent is None:
+            continue
+        first_col = max(min_col, math.floor(extent[0] / tile_size))
+        last_col = min(max_col, math.floor(extent[2] / tile_size))
+        first_row = max(min_row, math.floor(extent[1] / tile_size))
+        last_row = min(max_row, math.floor(extent[3] / tile_size))
+        for row in range(first_row, last_row + 1):
+            for col in range(first_col, last_col + 1):
+                tile_features[(col, row)].append(feature)
+    return tile_features
+
+
+def feature_bbox(feature):
+    coords = (feature.get("geometry") or {}).get("coordinates") or []
+    if not coords:
+        return None
+    lons = [xy[0] for xy in coords]
+    lats = [xy[1] for xy in coords]
+    return min(lons), min(lats), max(lons), max(lats)
+
+
+def bboxes_intersect(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def merge_features(feature_lists, bbox=None):
+    # Concatenates feature lists keeping the first feature of each "id", and
+    # optionally only features whose bbox intersects bbox. Features without
+    # an id are all kept.
+    seen = set()
+    merged = []
+    for features in feature_lists:
+        for feature in features:
+            feature_id = feature.get("id")
+            if feature_id is not None:
+                if feature_id in seen:
+                    continue
+                seen.add(feature_id)
+            if bbox is not None:
+                extent = feature_bbox(feature)
+                if extent is None or not bboxes_intersect(extent, bbox):
+                    continue
+            merged.append(feature)
+    return merged
+
+
+class OverpassTileCache:
+    # fetch: called as fetch(bbox, types, query_date) to get the GeoJSON
+    # FeatureCollection of a block of tiles, with the OSM way id as each
+    # feature's "id". It may raise, e.g. when offline, in which case expired
+    # tiles are served rather than failing. Blocks are fetched concurrency at
+    # a time, so fetch must be thread-safe.
+    def __init__(
+        self,
+        cache_dir,
+        fetch,
+        ttl_s=DEFAULT_TTL_S,
+        tile_size=DEFAULT_TILE_SIZE_DEG,
+        max_tiles=DEFAULT_MAX_TILES,
+        block_size=DEFAULT_BLOCK_SIZE,
+        concurrency=1,
+    ):
+        self.cache_dir = cache_dir
+        self.fetch = fetch
+        self.ttl_s = ttl_s
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.block_size = block_size
+        self.concurrency = max(1, int(concurrency))
+
+    def _tile_path(self, tile, types, query_date):
+        # Types are a set, so their order doesn't split the cache.
+        types_key = hashlib.sha1(",".join(sorted(types)).encode("utf-8")).hexdigest()[:16]
+        grid_key = f"{self.tile_size:g}"
+        return os.path.join(
+            self.cache_dir, grid_key, query_date or "latest", types_key, f"{tile[0]}_{tile[1]}.json"
+        )
+
+    def _is_fresh(self, fetched_at, query_date):
+        # A snapshot of a day that is over doesn't change any more.
+        if query_date and query_date < date.today().isoformat():
+            return True
+        return time.time() - fetched_at < self.ttl_s
+
+    def _read(self, path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, path, entry):
+        # Written to a temporary file first, so that readers never see half a
+        # tile.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def get_roads(self, bbox, types, query_date=None):
+        # Returns the FeatureCollection of the ways of the given types
+        # intersecting bbox, and a dict of cache stats.
+        # Raises ValueError if the bbox covers more than max_tiles tiles, and
+        # whatever fetch raises for a tile that was never cached.
+        types = sorted(set(types))
+        # The tiles are counted before listing them, a world bbox has
+        # millions.
+        min_col, min_row, max_col, max_row = tile_range(bbox, self.tile_size)
+        tile_num = (max_col - min_col + 1) * (max_row - min_row + 1)
+        if tile_num > self.max_tiles:
+            raise ValueError(
+                f"The bbox covers {tile_num} cache tiles, more than the limit of {self.max_tiles}."
+            )
+        tiles = snap_to_tiles(bbox, self.tile_size)
+        tile_features = [None] * len(tiles)
+        stats = {"tiles": len(tiles), "hits": 0, "fetched": 0, "stale": 0, "queries": 0}
+        missing = {}
+        for i, tile in enumerate(tiles):
+            path = self._tile_path(tile, types, query_date)
+            entry = self._read(path)
+            if entry is not None and self._is_fresh(entry["fetched_at"], query_date):
+                stats["hits"] += 1
+                tile_features[i] = entry["features"]
+            else:
+                missing[tile] = (i, path, entry)
+
+        def fetch_block(block):
+            features = self.fetch(block_bbox(block, self.tile_size), types, query_date)["features"]
+            block_features = split_features(features, block, self.tile_size)
+            fetched_at = time.time()
+            for tile, features in block_features.items():
+                self._write(missing[tile][1], {"fetched_at": fetched_at, "features": features})
+            return block_features
+
+        blocks = coalesce_tiles(missing, self.block_size)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(fetch_block, block) for block in blocks]
+            for block, future in zip(blocks, futures):
+                stats["queries"] += 1
+                try:
+                    for tile, features in future.result().items():
+                        tile_features[missing[tile][0]] = features
+                        stats["fetched"] += 1
+                except Exception as e:
+                    min_col, min_row, max_col, max_row = block
+                    for row in range(min_row, max_row + 1):
+                        for col in range(min_col, max_col + 1):
+                            entry = missing[(col, row)][2]
+                            if entry is None:
+                                raise
+                            logging.warning(f"Serving expired OSM tile {(col, row)}, fetching it failed: {e}")
+                            stats["stale"] += 1
+                            tile_features[missing[(col, row)][0]] = entry["features"]
+        features = merge_features(tile_features, bbox)
+        return {"type": "FeatureCollection", "features": features}, stats
+
+    def prune(self, max_age_s=DEFAULT_MAX_AGE_S):
+        # Deletes tiles fetched more than max_age_s ago, temporary files left
+        # by interrupted writes and the directories this empties. Dated tiles
+        # never expire, so without pruning the cache only grows.
+        # Returns the number of deleted files.
+        deleted = 0
+        oldest = time.time() - max_age_s
+        for root, _, files in os.walk(self.cache_dir, topdown=False):
+            for name in files:
+                path = os.path.join(root, name)
+                if not name.endswith((".json", ".tmp")):
+                    continue
+                try:
+                    if os.path.getmtime(path) < oldest:
+                        os.remove(path)
+                        deleted += 1
+                except OSError:
+                    pass
+            if root != self.cache_dir:
+                try:
+                    os.rmdir(root)
+                except OSError:
+                    # Not empty.
+                    pass
+        return deleted
+
+
+class TestOverpassTileCache(unittest.TestCase):
+    def road(self, way_id, coords):
+        return {
+            "type": "Feature",
+            "id": way_id,
+            "properties": {"highway": "primary"},
+            "geometry": {"type": "LineString", "coordinates": coords},
+        }
+
+    def setUp(self):
+        # Two roads in tile (0, 0), one crossing into tile (1, 0), and one
+        # far away in tile (5, 5).
+        self.roads = [
+            self.road(1, [[0.01, 0.01], [0.02, 0.02]]),
+            self.road(2, [[0.04, 0.01], [0.06, 0.01]]),
+            self.road(3, [[0.26, 0.26], [0.27, 0.27]]),
+        ]
+        self.queries = []
+        self.offline = False
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cache_dir.cleanup)
+
+    def fetch(self, bbox, types, query_date):
+        if self.offline:
+            raise OSError("offline")
+        self.queries.append(bbox)
+        features = [road for road in self.roads if bboxes_intersect(feature_bbox(road), bbox)]
+        return {"type": "FeatureCollection", "features": features}
+
+    def cache(self, **kwargs):
+        return OverpassTileCache(self.cache_dir.name, self.fetch, **kwargs)
+
+    def test_snap_to_tiles(self):
+        self.assertEqual(snap_to_tiles((0.01, 0.01, 0.02, 0.02)), [(0, 0)])
+        # Ending on a tile border doesn't take in the next tile.
+        self.assertEqual(snap_to_tiles((0.01, 0.01, 0.1, 0.05)), [(0, 0), (1, 0)])
+        self.assertEqual(snap_to_tiles((-0.01, -0.01, 0.01, 0.01)), [(-1, -1), (0, -1), (-1, 0), (0, 0)])
+        self.assertEqual(tile_range((-0.01, -0.01, 0.1, 0.05)), (-1, -1, 1, 0))
+
+    def test_merge_features(self):
+        merged = merge_features([self.roads[:2], self.roads[1:]], bbox=(0.0, 0.0, 0.05, 0.05))
+        self.assertEqual([feature["id"] for feature in merged], [1, 2])
+
+    def test_coalesce_tiles(self):
+        tiles = snap_to_tiles((0.0, 0.0, 0.3, 0.1))
+        self.assertEqual(coalesce_tiles(tiles), [(0, 0, 3, 1), (4, 0, 5, 1)])
+        self.assertEqual(coalesce_tiles([(0, 0), (2, 0), (0, 1)]), [(0, 0, 0, 1), (2, 0, 2, 0)])
+
+    def test_get_roads(self):
+        cache = self.cache()
+        geojson, stats = cache.get_roads((0.0, 0.0, 0.3, 0.3), ["primary"])
+        self.assertEqual(sorted(feature["id"] for feature in geojson["features"]), [1, 2, 3])
+        # 6 x 6 tiles in blocks of at most 4 x 4.
+        self.assertEqual(stats, {"tiles": 36, "hits": 0, "fetched": 36, "stale": 0, "queries": 4})
+        # Road 2 is stored in both tiles it touches.
+        geojson, stats = cache.get_roads((0.055, 0.0, 0.07, 0.02), ["primary"])
+        self.assertEqual([feature["id"] for feature in geojson["features"]], [2])
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(len(self.queries), 4)
+        with self.assertRaises(ValueError):
+            cache.get_roads((0.0, 0.0, 1.0, 1.0), ["primary"])
+        # Refused without listing its tiles.
+        with self.assertRaises(ValueError):
+            cache.get_roads((-180.0, -90.0, 180.0, 90.0), ["primary"])
+        with self.assertRaises(ValueError):
+            cache.get_roads((0.0, 0.0, float("inf"), 0.05), ["primary"])
+        self.assertEqual(len(self.queries), 4)
+
+    def test_ttl_and_stale_fallback(self):
+        self.cache(ttl_s=3600).get_roads((0.0, 0.0, 0.05, 0.05), ["primary"])
+        # Expired tiles are fetched again, or served as they are when
+        # fetching fails.
+        cache = self.cache(ttl_s=0)
+        self.assertEqual(cache.get_roads((0.0, 0.0, 0.05, 0.05), ["primary"])[1]["fetched"], 1)
+        self.offline = True
+        geojson, stats = cache.get_roads((0.0, 0.0, 0.05, 0.05), ["primary"])
+        self.assertEqual(stats["stale"], 1)
+        self.assertEqual(sorted(feature["id"] for feature in geojson["features"]), [1, 2])
+        with self.assertRaises(OSError):
+            cache.get_roads((0.2, 0.2, 0.3, 0.3), ["primary"])
+        # Snapshots of past days never expire.
+        self.offline = False
+        self.assertEqual(cache.get_roads((0.0, 0.0, 0.05, 0.05), ["primary"], "2024-01-01")[1]["fetched"], 1)
+        self.assertEqual(cache.get_roads((0.0, 0.0, 0.05, 0.05), ["primary"], "2024-01-01")[1]["hits"], 1)
+
+    def test_prune(self):
+        cache = self.cache()
+        cache.get_roads((0.0, 0.0, 0.1, 0.05), ["primary"])
+        old_path = cache._tile_path((0, 0), ["primary"], None)
+        os.utime(old_path, (0, 0))
+        self.assertEqual(cache.prune(3600), 1)
+        self.assertFalse(os.path.exists(old_path))
+        self.assertEqual(cache.get_roads((0.0, 0.0, 0.1, 0.05), ["primary"])[1]["hits"], 1)
+        self.assertEqual(cache.prune(-1), 2)
+        self.assertEqual(os.listdir(self.cache_dir.name), [])
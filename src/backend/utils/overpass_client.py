@@ -0,0 +1,195 @@
+# backend/utils/overpass_client.py
+# Overpass road queries over a pooled HTTP session. Transient errors (rate
+# limiting, busy servers) are retried with exponential backoff, and queries
+# that time out are split into quadrants whose elements are merged by id.
+# Responses are parsed as they stream in, see utils.overpass_stream.
+import json
+import logging
+import re
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from utils.overpass_stream import RoadElements, iter_elements
+
+# Overpass answers 429 when the client is out of slots and 504 when the
+# server is overloaded, both worth retrying as is.
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+class OverpassQueryError(requests.exceptions.RequestException):
+    pass
+
+
+def split_bbox(bbox):
+    # The four quadrants of a (min_lon, min_lat, max_lon, max_lat) bbox.
+    min_lon, min_lat, max_lon, max_lat = bbox
+    mid_lon, mid_lat = (min_lon + max_lon) / 2, (min_lat + max_lat) / 2
+    return [
+        (min_lon, min_lat, mid_lon, mid_lat),
+        (mid_lon, min_lat, max_lon, mid_lat),
+        (min_lon, mid_lat, mid_lon, max_lat),
+        (mid_lon, mid_lat, max_lon, max_lat),
+    ]
+
+
+class OverpassClient:
+    def __init__(
+        self,
+        url,
+        timeout_s=25,
+        concurrency=2,
+        retries=3,
+        backoff_s=1.0,
+        max_split_depth=2,
+    ):
+        # concurrency: pooled connections, one per thread fetching at once.
+        # max_split_depth: how many times a timed out query is quartered.
+        self.url = url
+        self.timeout_s = timeout_s
+        self.concurrency = max(1, int(concurrency))
+        self.max_split_depth = max_split_depth
+        # Overpass gets a few seconds over its own timeout to report it.
+        self.http_timeout_s = timeout_s + 5
+        # Connection errors are retried once only, so that an unreachable
+        # server fails fast enough to fall back on cached tiles. Read timeouts
+        # aren't retried but raised, as the same query would time out again;
+        # fetch_roads splits it instead.
+        retry = Retry(
+            total=retries,
+            connect=1,
+            read=False,
+            backoff_factor=backoff_s,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=None,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=self.concurrency, pool_maxsize=self.concurrency, max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _roads_query(self, bbox, types, query_date):
+        min_lon, min_lat, max_lon, max_lat = bbox
+        overpass_bbox = f"{min_lat},{min_lon},{max_lat},{max_lon}"
+        overpass_types = "|".join(types)
+        date_setting = f'[date:"{query_date}T23:59:59Z"]' if query_date else ""
+        return f"""
+            [out:json][timeout:{self.timeout_s}]{date_setting};
+            (way["highway"~"^({overpass_types})$"]({overpass_bbox}););
+            out body;>;out skel qt;
+        """
+
+    def _post(self, bbox, types, query_date, elements):
+        # Streams the response elements into elements. Returns False if the
+        # query timed out on either side. Overpass reports its own timeouts
+        # and memory limits as a remark after the elements it managed to
+        # output. Connection errors are raised, as splitting the query
+        # wouldn't help.
+        try:
+            response = self.session.post(
+                self.url,
+                data={"data": self._roads_query(bbox, types, query_date)},
+                timeout=self.http_timeout_s,
+                stream=True,
+            )
+        except requests.exceptions.ReadTimeout:
+            return False
+        with response:
+            logging.info(f"Overpass API response status: {response.status_code}")
+            response.raise_for_status()
+            top_level = {}
+            try:
+                for element in iter_elements(response.iter_content(chunk_size=1 << 16), top_level):
+                    elements.add(element)
+            except requests.exceptions.ConnectionError as e:
+                # iter_content reports read timeouts as connection errors.
+                logging.warning(f"Reading the Overpass response over {bbox} failed: {e}")
+                return False
+        remark = top_level.get("remark") or ""
+        if "runtime error" in remark:
+            logging.warning(f"Overpass query over {bbox} failed: {remark}")
+            return False
+        return True
+
+    def fetch_roads(self, bbox, types, query_date=None, elements=None, depth=0):
+        # Adds the ways of the given highway types intersecting bbox, with
+        # their nodes, to elements, a new RoadElements by default.
+        # Elements of a partial response are kept, the quadrant queries
+        # only add what is missing.
+        if elements is None:
+            elements = RoadElements()
+        if self._post(bbox, types, query_date, elements):
+            return elements
+        if depth >= self.max_split_depth:
+            raise OverpassQueryError(f"Overpass query over {bbox} timed out even after splitting it.")
+        logging.info(f"Splitting the Overpass query over {bbox} into quadrants")
+        for quadrant in split_bbox(bbox):
+            self.fetch_roads(quadrant, types, query_date, elements, depth + 1)
+        return elements
+
+
+
+class _StubOverpassHandler(BaseHTTPRequestHandler):
+    # Answers each query with one way over its bbox, after a delay for
+    # bboxes wider than half a degree.
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8")
+        query = parse_qs(body)["data"][0]
+        min_lat, min_lon, max_lat, max_lon = map(float, re.search(r"\(([^()]*)\);\);", query).group(1).split(","))
+        self.server.queries.append((min_lon, min_lat, max_lon, max_lat))
+        if max_lon - min_lon > 0.5:
+            time.sleep(self.server.delay_s)
+        way_id = len(self.server.queries)
+        elements = [
+            {"type": "way", "id": way_id, "nodes": [2 * way_id, 2 * way_id + 1], "tags": {"highway": "primary"}},
+            {"type": "node", "id": 2 * way_id, "lat": min_lat, "lon": min_lon},
+            {"type": "node", "id": 2 * way_id + 1, "lat": max_lat, "lon": max_lon},
+        ]
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps({"elements": elements}).encode("utf-8"))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class TestOverpassClient(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _StubOverpassHandler)
+        self.server.queries = []
+        self.server.delay_s = 1.0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = OverpassClient(f"http://127.0.0.1:{self.server.server_port}/api/interpreter", backoff_s=0.0)
+        self.client.http_timeout_s = 0.3
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_split_on_timeout(self):
+        # The timed out query is sent once, not retried, and then quartered.
+        bbox = (0.0, 0.0, 1.0, 1.0)
+        elements = self.client.fetch_roads(bbox, ["primary"])
+        self.assertEqual(self.server.queries[0], bbox)
+        self.assertEqual(sorted(self.server.queries[1:]), sorted(split_bbox(bbox)))
+        self.assertEqual(len(elements.way_ids), 4)
+
+    def test_split_depth(self):
+        self.client.max_split_depth = 0
+        with self.assertRaises(OverpassQueryError):
+            self.client.fetch_roads((0.0, 0.0, 1.0, 1.0), ["primary"])
+        self.assertEqual(len(self.server.queries), 1)
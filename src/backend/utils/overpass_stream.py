@@ -0,0 +1,240 @@
+# backend/utils/overpass_stream.py
+# Compact handling of Overpass road responses. The JSON body is decoded one
+# element at a time as it arrives instead of being read whole, node
+# coordinates go into flat arrays instead of per-node dicts, and features are
+# written to responses in batches rather than as one big string. The roads of
+# a query are still all held in memory: the tile cache and the vector tile
+# store both keep whole feature lists.
+import codecs
+import json
+import re
+import unittest
+from array import array
+
+import numpy as np
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_DELIMITERS = frozenset(",:]} \t\n\r")
+
+
+def iter_elements(chunks, top_level=None):
+    # Yields the items of the top-level "elements" array of a JSON object
+    # read from an iterable of bytes or str chunks, decoding one item at a
+    # time. Other top-level keys, e.g. Overpass's "remark", are stored in the
+    # top_level dict.
+    # Raises json.JSONDecodeError on malformed or truncated input.
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    state = {"buffer": "", "pos": 0, "eof": False}
+    if top_level is None:
+        top_level = {}
+
+    def read_more():
+        chunk = next(chunks, None)
+        if chunk is None:
+            text = utf8.decode(b"", final=True)
+            state["eof"] = True
+        else:
+            text = utf8.decode(chunk) if isinstance(chunk, bytes) else chunk
+        state["buffer"] = state["buffer"][state["pos"]:] + text
+        state["pos"] = 0
+
+    def peek():
+        # Next non-whitespace character, "" at the end of the input.
+        while True:
+            state["pos"] = _WHITESPACE.match(state["buffer"], state["pos"]).end()
+            if state["pos"] < len(state["buffer"]):
+                return state["buffer"][state["pos"]]
+            if state["eof"]:
+                return ""
+            read_more()
+
+    def expect(chars):
+        char = peek()
+        if not char or char not in chars:
+            raise json.JSONDecodeError(f"Expecting one of {chars!r}", state["buffer"], state["pos"])
+        state["pos"] += 1
+        return char
+
+    def value():
+        peek()
+        while True:
+            try:
+                result, end = decoder.raw_decode(state["buffer"], state["pos"])
+                # A number cut by the end of a chunk decodes too, "12" of
+                # "12.5", so values must be followed by a delimiter.
+                if state["eof"] or (end < len(state["buffer"]) and state["buffer"][end] in _DELIMITERS):
+                    state["pos"] = end
+                    return result
+            except json.JSONDecodeError:
+                if state["eof"]:
+                    raise
+            read_more()
+
+    expect("{")
+    if peek() == "}":
+        return
+    while True:
+        key = value()
+        expect(":")
+        if key == "elements":
+            expect("[")
+            if peek() == "]":
+                state["pos"] += 1
+            else:
+                while True:
+                    yield value()
+                    if expect(",]") == "]":
+                        break
+        else:
+            top_level[key] = value()
+        if expect(",}") == "}":
+            return
+
+
+class RoadElements:
+    # Accumulates Overpass nodes and ways compactly: node ids and coordinates
+    # in typed arrays, way node ids in one flat array. Ways are kept once per
+    # id, so responses of overlapping queries can be added one after another.
+    def __init__(self):
+        self.node_ids = array("q")
+        self.node_lons = array("d")
+        self.node_lats = array("d")
+        self.way_ids = []
+        self.way_tags = []
+        self.way_refs = array("q")
+        self.way_lengths = array("q")
+        self._seen_ways = set()
+
+    def add(self, element):
+        if element["type"] == "node":
+            self.node_ids.append(element["id"])
+            self.node_lons.append(element["lon"])
+            self.node_lats.append(element["lat"])
+        elif element["type"] == "way" and element["id"] not in self._seen_ways:
+            self._seen_ways.add(element["id"])
+            refs = element.get("nodes", [])
+            self.way_ids.append(element["id"])
+            self.way_tags.append(element.get("tags", {}))
+            self.way_refs.extend(refs)
+            self.way_lengths.append(len(refs))
+
+    def extend(self, elements):
+        for element in elements:
+            self.add(element)
+        return self
+
+    def features(self):
+        # Yields the ways as GeoJSON LineString features, in the order they
+        # were added. Nodes missing from the responses are left out.
+        if not self.way_ids:
+            return
+        node_ids = np.frombuffer(self.node_ids, dtype=np.int64)
+        order = np.argsort(node_ids, kind="stable")
+        sorted_ids = node_ids[order]
+        refs = np.frombuffer(self.way_refs, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(sorted_ids, refs), max(sorted_ids.shape[0] - 1, 0))
+        if sorted_ids.shape[0]:
+            found = sorted_ids[positions] == refs
+            nodes = order[positions]
+            coords = np.stack(
+                [np.frombuffer(self.node_lons)[nodes], np.frombuffer(self.node_lats)[nodes]], axis=-1
+            )
+        else:
+            found = np.zeros(refs.shape[0], dtype=bool)
+            coords = np.zeros((refs.shape[0], 2))
+        ends = np.cumsum(np.frombuffer(self.way_lengths, dtype=np.int64)).tolist()
+        starts = [0] + ends[:-1]
+        all_found = bool(found.all())
+        coords = coords.tolist()
+        found = found.tolist()
+        for way_id, tags, start, end in zip(self.way_ids, self.way_tags, starts, ends):
+            way_coords = coords[start:end]
+            if not all_found:
+                way_coords = [xy for xy, is_found in zip(way_coords, found[start:end]) if is_found]
+            yield {
+                "type": "Feature",
+                "id": way_id,
+                "properties": tags,
+                "geometry": {"type": "LineString", "coordinates": way_coords},
+            }
+
+    def to_geojson(self):
+        return {"type": "FeatureCollection", "features": list(self.features())}
+
+
+def stream_feature_collection(features, batch_size=1000):
+    # Yields a GeoJSON FeatureCollection as text chunks of batch_size
+    # features, for a streamed HTTP response.
+    yield '{"type": "FeatureCollection", "features": ['
+    batch = []
+    first = True
+    for feature in features:
+        batch.append(json.dumps(feature))
+        if len(batch) >= batch_size:
+            yield ("" if first else ",") + ",".join(batch)
+            first = False
+            batch = []
+    if batch:
+        yield ("" if first else ",") + ",".join(batch)
+    yield "]}"
+
+
+class TestOverpassStream(unittest.TestCase):
+    def chunked(self, text, size):
+        data = text.encode("utf-8")
+        return [data[i : i + size] for i in range(0, len(data), size)]
+
+    def test_iter_elements_chunks(self):
+        response = {
+            "version": 0.6,
+            "elements": [
+                {"type": "node", "id": 1, "lat": 12.3456789, "lon": -0.000123, "visible": True},
+                {"type": "way", "id": 10, "nodes": [1, 2], "tags": {"name": "Straße – ☃"}, "note": None},
+                {"type": "node", "id": 2, "lat": 1e-05, "lon": 1.5E+2, "deleted": False},
+            ],
+            "remark": "runtime error: Query timed out",
+        }
+        text = json.dumps(response, ensure_ascii=False)
+        # Every chunk size splits some number, literal or UTF-8 character.
+        for size in range(1, 24):
+            top_level = {}
+            elements = list(iter_elements(self.chunked(text, size), top_level))
+            self.assertEqual(elements, response["elements"])
+            self.assertEqual(top_level, {"version": 0.6, "remark": response["remark"]})
+        self.assertEqual(list(iter_elements([text])), response["elements"])
+
+    def test_iter_elements_empty(self):
+        self.assertEqual(list(iter_elements([b'{"elements": []}'])), [])
+        self.assertEqual(list(iter_elements([b"{}"])), [])
+
+    def test_iter_elements_truncated(self):
+        text = '{"elements": [{"type": "node", "id": 1, "lat": 12.5, "lon": 3}, {"type": "node", "id": 22'
+        for end in [len(text), text.index("12.5") + 2, text.index("}") + 1, 1]:
+            with self.assertRaises(json.JSONDecodeError):
+                list(iter_elements(self.chunked(text[:end], 7)))
+        with self.assertRaises(json.JSONDecodeError):
+            list(iter_elements([b'{"elements": [1 2]}']))
+
+    def test_road_elements(self):
+        elements = RoadElements().extend(
+            [
+                {"type": "way", "id": 10, "nodes": [2, 1, 3], "tags": {"highway": "primary"}},
+                {"type": "node", "id": 1, "lat": 1.0, "lon": 2.0},
+                {"type": "node", "id": 2, "lat": 3.0, "lon": 4.0},
+                {"type": "way", "id": 10, "nodes": [1], "tags": {}},
+            ]
+        )
+        # Node 3 is missing and the repeated way is ignored.
+        self.assertEqual(
+            elements.to_geojson()["features"],
+            [
+                {
+                    "type": "Feature",
+                    "id": 10,
+                    "properties": {"highway": "primary"},
+                    "geometry": {"type": "LineString", "coordinates": [[4.0, 3.0], [2.0, 1.0]]},
+                }
+            ],
+        )
@@ -0,0 +1,46 @@
+# backend/utils/prediction_cache.py
+import os
+import threading
+
+
+def file_stamp(path):
+    # (mtime, size) of a file, None if it doesn't exist.
+    if path is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class PredictionCache:
+    # In-memory memo of values derived from prediction files: converted
+    # GeoJSON, spatial indexes, levels of detail. An entry is reused while
+    # the mtime and size of every file it was built from are unchanged, so a
+    # new detection run invalidates it without any bookkeeping.
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, paths, build):
+        # key: tuple whose first item is the prediction prefix, or the file
+        # for predictions outside the save directory.
+        # paths: files the value is derived from.
+        # build: called without arguments to compute the value on a miss.
+        stamp = tuple(file_stamp(path) for path in paths)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+        value = build()
+        with self._lock:
+            self._entries[key] = (stamp, value)
+        return value
+
+    def invalidate(self, prefix):
+        # Drops every entry of a prefix, e.g. before a detection run rewrites
+        # its files.
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == prefix]:
+                del self._entries[key]
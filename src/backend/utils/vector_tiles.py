@@ -0,0 +1,264 @@
+# backend/utils/vector_tiles.py
+# Mapbox Vector Tiles (MVT 2.1) for the GeoJSON road layers served by the app.
+# Layers are indexed once per version, tiles are clipped from the index on
+# demand and kept in a bounded LRU cache keyed by layer version.
+import struct
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import shapely
+
+from utils.geo_transform import geojson_line_arrays
+
+TILE_EXTENT = 4096
+# Geometry is clipped slightly outside the tile so that line joins and widths
+# render without seams between neighbouring tiles.
+TILE_BUFFER = 64
+WEB_MERCATOR_HALF_SIZE = 20037508.342789244
+MAX_ZOOM = 24
+
+# Protobuf wire types.
+_VARINT = 0
+_FIXED64 = 1
+_LENGTH_DELIMITED = 2
+
+# MVT geometry commands and types.
+_MOVE_TO = 1
+_LINE_TO = 2
+_LINESTRING = 2
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _key(field, wire_type):
+    return _varint((field << 3) | wire_type)
+
+
+def _length_delimited(field, payload):
+    return _key(field, _LENGTH_DELIMITED) + _varint(len(payload)) + payload
+
+
+def _varint_bytes(values):
+    # values: non-negative ints below 2**64, encoded all at once.
+    # Returns the concatenated varints and the byte length of each.
+    values = np.asarray(values, dtype=np.uint64).reshape(-1)
+    shifts = np.arange(0, 70, 7, dtype=np.uint64)
+    groups = (values[:, None] >> shifts[None, :]) & np.uint64(0x7F)
+    # Every value takes at least one 7-bit group.
+    lengths = 1 + np.count_nonzero((values[:, None] >> shifts[None, 1:]) > 0, axis=1)
+    in_value = np.arange(10)[None, :] < lengths[:, None]
+    continued = np.arange(10)[None, :] < (lengths - 1)[:, None]
+    groups |= continued.astype(np.uint64) << np.uint64(7)
+    return groups[in_value].astype(np.uint8).tobytes(), lengths
+
+
+def _packed_varints(values):
+    # For short lists, where numpy's per-call overhead dominates.
+    return b"".join(_varint(v) for v in values)
+
+
+def _zigzag(values):
+    return (values << 1) ^ (values >> 63)
+
+
+def _encode_value(value):
+    # tile.Value: string_value = 1, double_value = 3, int_value = 4,
+    # bool_value = 7.
+    if isinstance(value, bool):
+        return _key(7, _VARINT) + _varint(int(value))
+    if isinstance(value, int) and -(2 ** 63) <= value < 2 ** 63:
+        return _key(4, _VARINT) + _varint(value & 0xFFFFFFFFFFFFFFFF)
+    if isinstance(value, float):
+        return _key(3, _FIXED64) + struct.pack("<d", value)
+    return _length_delimited(1, str(value).encode("utf-8"))
+
+
+def encode_geometries(coords, part_lengths, part_feature):
+    # Encodes line geometries for many features in one pass. Each part is a
+    # MoveTo to its first vertex and one LineTo over the rest, coordinates are
+    # zigzag deltas from the previous vertex of the same feature.
+    # coords: [N_vertex, 2] int64 tile coordinates, grouped by part.
+    # part_lengths: [N_part] vertex count of each part, all >= 2.
+    # part_feature: [N_part] non-decreasing feature index of each part.
+    # Returns: list of encoded geometry bytes, one per distinct feature.
+    part_num = part_lengths.shape[0]
+    part_starts = np.concatenate([[0], np.cumsum(part_lengths)[:-1]]).astype(np.int64)
+    first_part = np.ones(part_num, dtype=bool)
+    first_part[1:] = part_feature[1:] != part_feature[:-1]
+    deltas = np.diff(coords, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+    deltas[part_starts[first_part]] = coords[part_starts[first_part]]
+    # Part p starts at command 2 * start + 2 * p, as MoveTo, x, y, LineTo,
+    # followed by the x, y pairs of its other vertices.
+    part_offsets = 2 * part_starts + 2 * np.arange(part_num)
+    vertex_part = np.repeat(np.arange(part_num), part_lengths)
+    vertex_pos = 2 * np.arange(coords.shape[0]) + 2 * vertex_part + 2
+    vertex_pos[part_starts] -= 1
+    commands = np.empty(2 * coords.shape[0] + 2 * part_num, dtype=np.int64)
+    commands[vertex_pos] = _zigzag(deltas[:, 0])
+    commands[vertex_pos + 1] = _zigzag(deltas[:, 1])
+    commands[part_offsets] = (1 << 3) | _MOVE_TO
+    commands[part_offsets + 3] = ((part_lengths - 1) << 3) | _LINE_TO
+    encoded, lengths = _varint_bytes(commands)
+    byte_offsets = np.concatenate([[0], np.cumsum(lengths)]).tolist()
+    bounds = part_offsets[first_part].tolist() + [commands.shape[0]]
+    return [encoded[byte_offsets[a] : byte_offsets[b]] for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def encode_layer(name, features, extent=TILE_EXTENT):
+    # features: list of (geometry, properties) with geometry as returned by
+    # encode_geometries.
+    keys, values = {}, {}
+    encoded_features = []
+    for geometry, properties in features:
+        tags = []
+        for key, value in properties.items():
+            if value is None or isinstance(value, (dict, list)):
+                continue
+            value_key = (type(value).__name__, value)
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault(value_key, len(values)))
+        feature = b""
+        if tags:
+            feature += _length_delimited(2, _packed_varints(tags))
+        feature += _key(3, _VARINT) + _varint(_LINESTRING)
+        feature += _length_delimited(4, geometry)
+        encoded_features.append(_length_delimited(2, feature))
+
+    layer = _key(15, _VARINT) + _varint(2)
+    layer += _length_delimited(1, name.encode("utf-8"))
+    layer += b"".join(encoded_features)
+    layer += b"".join(_length_delimited(3, key.encode("utf-8")) for key in keys)
+    layer += b"".join(_length_delimited(4, _encode_value(value)) for _, value in values)
+    layer += _key(5, _VARINT) + _varint(extent)
+    return _length_delimited(3, layer)
+
+
+def lonlat_to_mercator(coords):
+    # coords: [N, 2] (lon, lat). Returns [N, 2] EPSG:3857 (x, y) in metres.
+    lon = np.radians(coords[:, 0])
+    lat = np.radians(np.clip(coords[:, 1], -85.0511287798, 85.0511287798))
+    x = lon * 6378137.0
+    y = np.log(np.tan(np.pi / 4 + lat / 2)) * 6378137.0
+    return np.stack([x, y], axis=-1)
+
+
+def check_tile(z, x, y):
+    # Raises ValueError for tile coordinates outside the XYZ grid.
+    if not (0 <= z <= MAX_ZOOM and 0 <= x < (1 << z) and 0 <= y < (1 << z)):
+        raise ValueError(f"Invalid tile {z}/{x}/{y}")
+
+
+def tile_bounds(z, x, y):
+    # EPSG:3857 (min_x, min_y, max_x, max_y) of an XYZ tile.
+    tile_size = 2 * WEB_MERCATOR_HALF_SIZE / (1 << z)
+    min_x = -WEB_MERCATOR_HALF_SIZE + x * tile_size
+    max_y = WEB_MERCATOR_HALF_SIZE - y * tile_size
+    return min_x, max_y - tile_size, min_x + tile_size, max_y
+
+
+class _IndexedLayer:
+    # Line geometries of one layer version, in Web Mercator, with an STRtree.
+    def __init__(self, geojson):
+        features = geojson.get("features", [])
+        coords, line_index, line_feature = geojson_line_arrays(features)
+        # Keeps only features with lines, in their original order.
+        feature_ids, line_feature = np.unique(line_feature, return_inverse=True)
+        self.properties = [features[i].get("properties") or {} for i in feature_ids.tolist()]
+        if coords.shape[0]:
+            line_strings = shapely.linestrings(lonlat_to_mercator(coords), indices=line_index)
+            self.geometries = shapely.multilinestrings(line_strings, indices=line_feature)
+        else:
+            self.geometries = np.empty(0, dtype=object)
+        self.tree = shapely.STRtree(self.geometries)
+
+
+class VectorTileStore:
+    # Holds the current version of each named GeoJSON layer and serves MVT
+    # tiles for them. Setting a layer bumps its version, which retires all of
+    # its cached tiles.
+    def __init__(self, cache_size=2048):
+        self._layers = {}
+        self._versions = {}
+        self._tile_cache = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    def set_layer(self, name, geojson):
+        layer = _IndexedLayer(geojson)
+        with self._lock:
+            self._versions[name] = self._versions.get(name, 0) + 1
+            self._layers[name] = layer
+            return self._versions[name]
+
+    def layer_versions(self):
+        return dict(self._versions)
+
+    def get_tile(self, name, z, x, y):
+        # Returns the encoded tile, or None if the layer is unknown.
+        # Raises ValueError for tile coordinates outside the XYZ grid.
+        check_tile(z, x, y)
+        with self._lock:
+            layer = self._layers.get(name)
+            version = self._versions.get(name)
+            cache_key = (name, version, z, x, y)
+            tile = self._tile_cache.get(cache_key)
+            if tile is not None:
+                self._tile_cache.move_to_end(cache_key)
+                return tile
+        if layer is None:
+            return None
+        tile = self._render_tile(name, layer, z, x, y)
+        with self._lock:
+            self._tile_cache[cache_key] = tile
+            self._tile_cache.move_to_end(cache_key)
+            while len(self._tile_cache) > self._cache_size:
+                self._tile_cache.popitem(last=False)
+        return tile
+
+    def _render_tile(self, name, layer, z, x, y):
+        min_x, min_y, max_x, max_y = tile_bounds(z, x, y)
+        scale = TILE_EXTENT / (max_x - min_x)
+        pad = TILE_BUFFER / scale
+        clip_box = (min_x - pad, min_y - pad, max_x + pad, max_y + pad)
+        hits = np.sort(layer.tree.query(shapely.box(*clip_box)))
+        if hits.shape[0] == 0:
+            return encode_layer(name, [])
+        clipped = shapely.clip_by_rect(layer.geometries[hits], *clip_box)
+        parts, feature_index = shapely.get_parts(clipped, return_index=True)
+        coords, part_index = shapely.get_coordinates(parts, return_index=True)
+        # Tile coordinates have y pointing down.
+        tile_coords = np.empty(coords.shape, dtype=np.int64)
+        tile_coords[:, 0] = np.round((coords[:, 0] - min_x) * scale)
+        tile_coords[:, 1] = np.round((max_y - coords[:, 1]) * scale)
+        # Drops vertices that collapsed onto the previous one, then parts left
+        # with fewer than two vertices.
+        keep = np.ones(coords.shape[0], dtype=bool)
+        keep[1:] = (part_index[1:] != part_index[:-1]) | np.any(
+            tile_coords[1:] != tile_coords[:-1], axis=1
+        )
+        tile_coords, part_index = tile_coords[keep], part_index[keep]
+        part_lengths = np.bincount(part_index, minlength=parts.shape[0])
+        keep_part = part_lengths >= 2
+        keep_vertex = keep_part[part_index]
+        tile_coords = tile_coords[keep_vertex]
+        part_lengths = part_lengths[keep_part]
+        part_feature = feature_index[keep_part]
+        if part_lengths.shape[0] == 0:
+            return encode_layer(name, [])
+        geometries = encode_geometries(tile_coords, part_lengths, part_feature)
+        feature_ids = np.unique(part_feature).tolist()
+        return encode_layer(
+            name,
+            [(geometry, layer.properties[hits[i]]) for geometry, i in zip(geometries, feature_ids)],
+        )
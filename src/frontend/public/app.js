@@ -316,6 +316,47 @@ document.addEventListener('DOMContentLoaded', () => {
 
 // --- Updated GeoPackage Upload Logic ---
 
+    // Metres per screen pixel at the current zoom, the simplification
+    // tolerance of GeoPackage features.
+    function gpkgTolerance() {
+        const lat = map.getCenter().lat * Math.PI / 180;
+        return 40075016.686 * Math.cos(lat) / (256 * Math.pow(2, map.getZoom()));
+    }
+
+    // Features of one GeoPackage layer within the current map view.
+    async function fetchGpkgFeatures(id, layerName) {
+        const params = new URLSearchParams({
+            id: id,
+            layer: layerName,
+            bbox: map.getBounds().toBBoxString(),
+            tolerance: gpkgTolerance().toFixed(2)
+        });
+        const res = await fetch(`${API_BASE_URL}/get_geopackage_features?${params}`);
+        if (!res.ok) {
+            const errorData = await res.json();
+            throw new Error(errorData.details || errorData.error || `Failed to load layer ${layerName}.`);
+        }
+        return res.json();
+    }
+
+    // Layers only hold the features of the view they were loaded for, so
+    // they are reloaded when the map moves. Responses to earlier moves are
+    // dropped.
+    map.on('moveend', () => {
+        analysisState.gpkg.layers.forEach(async layerObj => {
+            const requestId = (layerObj.requestId || 0) + 1;
+            layerObj.requestId = requestId;
+            try {
+                const geojson = await fetchGpkgFeatures(layerObj.gpkgId, layerObj.name);
+                if (layerObj.requestId !== requestId) return;
+                layerObj.layer.clearLayers();
+                layerObj.layer.addData(geojson);
+            } catch (error) {
+                console.warn(`Could not reload GeoPackage layer ${layerObj.name}:`, error);
+            }
+        });
+    });
+
     geoPackageUploadInput.addEventListener('change', async function() {
         if (this.files.length === 0) return;
         const file = this.files[0];
@@ -335,14 +376,34 @@ document.addEventListener('DOMContentLoaded', () => {
                 throw new Error(errorData.details || errorData.error || 'Failed to process GeoPackage.');
             }
 
-            const layersData = await response.json();
+            // The upload lists the layers with their bounds. The map is fitted
+            // to them first, then the features in view are streamed one layer
+            // at a time.
+            const { id, layers } = await response.json();
+            const nonEmptyLayers = layers.filter(layer => layer.feature_count > 0);
+            const combinedBounds = L.latLngBounds([]);
+            nonEmptyLayers.forEach(layer => {
+                if (layer.bounds) {
+                    const [minLon, minLat, maxLon, maxLat] = layer.bounds;
+                    combinedBounds.extend([[minLat, minLon], [maxLat, maxLon]]);
+                }
+            });
+            if (combinedBounds.isValid()) {
+                // Without animation, so that the view is final when the
+                // features are requested.
+                map.fitBounds(combinedBounds, { animate: false });
+            }
+            const layersData = await Promise.all(
+                nonEmptyLayers.map(async layer => ({
+                    name: layer.name,
+                    geojson: await fetchGpkgFeatures(id, layer.name)
+                }))
+            );
 
             if (layersData.length > 0) {
                 document.getElementById('gpkgLayerControls').style.display = 'block';
             }
 
-            let combinedBounds = L.latLngBounds([]);
-
             layersData.forEach(layerData => {
                 const gpkgLayer = L.geoJSON(layerData.geojson, {
                     style: (feature) => getGpkgStyle(layerData.name),
@@ -361,25 +422,12 @@ document.addEventListener('DOMContentLoaded', () => {
                 }).addTo(map);
 
                 const defaultColor = getGpkgStyle(layerData.name).color || '#ffc107';
-                const layerObj = { name: layerData.name, layer: gpkgLayer, color: defaultColor };
+                const layerObj = { name: layerData.name, gpkgId: id, layer: gpkgLayer, color: defaultColor };
                 analysisState.gpkg.layers.push(layerObj);
 
                 createGpkgLayerRow(layerObj);
-
-                try {
-                    const layerBounds = gpkgLayer.getBounds();
-                    if (layerBounds.isValid()) {
-                        combinedBounds.extend(layerBounds);
-                    }
-                } catch(e) {
-                    console.warn(`Could not get bounds for layer ${layerData.name}`);
-                }
             });
 
-            if (combinedBounds.isValid()) {
-                map.fitBounds(combinedBounds);
-            }
-
         } catch (error) {
             console.error('GeoPackage Upload Error:', error);
             alert(`Could not load GeoPackage: ${error.message}`);
@@ -624,7 +672,11 @@ document.addEventListener('DOMContentLoaded', () => {
             const res = await fetch(`${API_BASE_URL}/generate_osm_mask`, {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ osm_data: osmData, image_bounds: image_bounds })
+                body: JSON.stringify({
+                    osm_data: osmData,
+                    image_bounds: image_bounds,
+                    prefix: imageState === analysisState.pre ? 'pre' : 'post'
+                })
             });
             if (!res.ok) throw new Error((await res.json()).error);
             const data = await res.json();